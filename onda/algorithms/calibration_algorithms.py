@@ -21,9 +21,26 @@ design or operation (i.e., not sample- or experiment-related).
 """
 from __future__ import absolute_import, division, print_function
 
+import getpass
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+from typing import (  # pylint: disable=unused-import
+    Any,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import h5py
 import numpy
+from future.utils import raise_from
 
-from onda.utils import exceptions, named_tuples, hdf5  # pylint: disable=unused-import
+from onda.utils import exceptions, named_tuples  # pylint: disable=unused-import
 
 
 class Agipd1MCalibration(object):
@@ -31,17 +48,27 @@ class Agipd1MCalibration(object):
     See documentation of the '__init__' function.
     """
 
-    def __init__(self, calibration_filename, cellid_list):
-        # type: (str, List[int]) -> None
+    def __init__(self, calibration_filename, cellid_list, cache_directory=None):
+        # type: (str, List[int], Optional[str]) -> None
         """
         Calibration of the AGIPD 1M detector.
 
         This algorithm stores the calibration parameters for an AGIPD 1M detector and
         applies the calibration to a detector data frame upon request. Since the the
         full set of correction parameters for the AGIPD 1M detector takes up a lot of
-        memory, only the parameters needed to correct frames originating from a subset
-        of cells care loaded. This algorithm will be able to correct only frames that
-        originate from the cells specified in the cellid_list parameter.
+        memory, the parameters are not loaded from the HDF5 file directly. The
+        parameters for the cells specified in the cellid_list parameter are instead
+        converted, the first time they are used, to a cache of binary files with the
+        same layout used to calibrate the data frames. The cache files are then
+        memory-mapped: the parameters for each cell are paged in only when a frame
+        originating from that cell is first calibrated, and the memory pages are
+        shared by all the processes, on the same machine, that use the same cache. If
+        the cache cannot be written to the requested directory, a directory specific
+        to the current user, in the temporary directory of the system, is used
+        instead. If the cache cannot be written there either, the parameters for the
+        cells specified in the cellid_list parameter are loaded in memory. This
+        algorithm will be able to correct only frames that originate from the cells
+        specified in the cellid_list parameter.
 
         Arguments:
 
@@ -56,62 +83,52 @@ class Agipd1MCalibration(object):
                 TODO: describe file structure.
 
             cellid_list (Tuple[int]): list of cells for which the correction parameters
-                should be loaded.
+                should be used.
+
+            cache_directory (Optional[str]): the absolute or relative path to the
+                directory where the cache of converted calibration parameters should
+                be stored. The cache is automatically regenerated when the HDF5 file
+                changes. If this argument is None, the directory where the HDF5 file
+                is located is used. Defaults to None.
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaDetectorCalibrationError`: if the
+                calibration file does not contain parameters for all the cells in the
+                cellid_list parameter.
         """
-        self._offset = numpy.ndarray(
-            (3, len(cellid_list), 8192, 128), dtype=numpy.int16
-        )
-        self._digital_gain = numpy.ndarray(
-            (3, len(cellid_list), 8192, 128), dtype=numpy.int16
-        )
-        self._relative_gain = numpy.ndarray(
-            (3, len(cellid_list), 8192, 128), dtype=numpy.float32
+        num_pixels = 8192 * 128
+        constants = _load_agipd1m_calibration_constants(
+            calibration_filename=calibration_filename,
+            cellid_list=cellid_list,
+            cache_directory=cache_directory,
         )
 
-        for index, cell in enumerate(cellid_list):
-            self._offset[:, index, ...] = numpy.squeeze(
-                hdf5.load_hdf5_data(
-                    hdf5_filename=calibration_filename,
-                    hdf5_path="/AnalogOffset",
-                    selection=(
-                        slice(0, 3),
-                        slice(cell, cell + 1),
-                        slice(0, 16),
-                        slice(0, 512),
-                        slice(0, 128),
-                    ),
-                )
-            ).reshape(3, 8192, 128)
-            self._digital_gain[:, index, ...] = numpy.squeeze(
-                hdf5.load_hdf5_data(
-                    hdf5_filename=calibration_filename,
-                    hdf5_path="/DigitalGainLevel",
-                    selection=(
-                        slice(0, 3),
-                        slice(cell, cell + 1),
-                        slice(0, 16),
-                        slice(0, 512),
-                        slice(0, 128),
-                    ),
-                )
-            ).reshape(3, 8192, 128)
-            self._relative_gain[:, index, ...] = numpy.squeeze(
-                hdf5.load_hdf5_data(
-                    hdf5_filename=calibration_filename,
-                    hdf5_path="/RelativeGain",
-                    selection=(
-                        slice(0, 3),
-                        slice(cell, cell + 1),
-                        slice(0, 16),
-                        slice(0, 512),
-                        slice(0, 128),
-                    ),
-                )
-            ).reshape(3, 8192, 128)
-            self._detector_mask = hdf5.load_hdf5_data(
-                hdf5_filename=calibration_filename, hdf5_path="/DetectorMask"
-            ).reshape(16, 512, 128)
+        # The calibration constants for each cell are stored with layout (pixel,
+        # stage), so that the offset and the gain for all the pixels of a frame can be
+        # retrieved with a single lookup, using the index pixel * 3 + stage. The
+        # thresholds that separate the gain stages are stored with layout (threshold,
+        # pixel). The constants for the cells are stored in the same order as in the
+        # cellid_list parameter.
+        self._offset = constants["offset"]
+        self._relative_gain = constants["relative_gain"]
+        self._gain_thresholds = constants["gain_thresholds"]
+        self._detector_mask = constants["detector_mask"]
+
         self._cellid_list = cellid_list
+        self._cell_indexes = {
+            cell: cell_index for cell_index, cell in enumerate(cellid_list)
+        }
+
+        # Buffers used to calibrate a frame: they are allocated only once and reused
+        # for every frame.
+        self._pixel_index_base = numpy.arange(0, num_pixels * 3, 3, dtype=numpy.intp)
+        self._gain_stage = numpy.empty(num_pixels, dtype=numpy.intp)
+        self._stage_buffer = numpy.empty(num_pixels, dtype=bool)
+        self._offset_buffer = numpy.empty(num_pixels, dtype=numpy.int16)
+        self._gain_buffer = numpy.empty(num_pixels, dtype=numpy.float32)
+        self._median_buffer = numpy.empty((16, 512 * 128), dtype=numpy.float32)
+        self._calibrated_data = numpy.empty((16, 512 * 128), dtype=numpy.float32)
 
     def apply_calibration(self, data_and_calib_info):
         # type: (named_tuples.DataAndCalibrationInfo) -> numpy.ndarray
@@ -119,7 +136,13 @@ class Agipd1MCalibration(object):
         Applies the calibration to a detector data frame.
 
         This function determines the gain stage of each pixel in the data frame, and
-        applies the relevant gain and offset corrections.
+        applies the relevant gain and offset corrections. The median value of each
+        module is then subtracted from the module.
+
+        The calibrated data is stored in an array that is allocated only once, and
+        reused for every frame: its content is overwritten at the next call of this
+        function. A copy of the returned array must be made if the calibrated data
+        needs to be retained.
 
         Arguments:
 
@@ -142,58 +165,299 @@ class Agipd1MCalibration(object):
 
         Returns:
 
-            numpy.ndarray:  the corrected data frame.
+            numpy.ndarray: the corrected data frame, with shape (8192, 128).
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaDetectorCalibrationError`: if the
+                calibration parameters for the cell from which the frame originates
+                are not used by this algorithm.
         """
-        gain_state = numpy.zeros_like(data_and_calib_info.data, dtype=int)
-        gain = data_and_calib_info.info["gain"]
         try:
-            num_frame = self._cellid_list.index(data_and_calib_info.info["cell"])
-        except ValueError:
+            cell_index = self._cell_indexes[data_and_calib_info.info["cell"]]
+        except KeyError:
             raise exceptions.OndaDetectorCalibrationError(
                 "Cannot find calibration parameters for cell {0}".format(
                     data_and_calib_info.info["cell"]
                 )
             )
+        data = data_and_calib_info.data.reshape(-1)
+        gain = data_and_calib_info.info["gain"].reshape(-1)
 
-        gain_state[
-            numpy.where(gain > numpy.squeeze(self._digital_gain[1, num_frame, ...]))
-        ] = 1
-        gain_state[
-            numpy.where(gain > numpy.squeeze(self._digital_gain[2, num_frame, ...]))
-        ] = 2
-
-        _value, _count = numpy.unique(gain_state, return_counts=True)
-        print("number of pixels in gain 1/0 is {}/{}...".format(_count[1], _count[0]))
-
-        gain_states, gain_pixel_counts = numpy.unique(gain_state)
-
-        gain_offset_correction = (
-            (
-                data_and_calib_info.data
-                - numpy.choose(
-                    gain_state,
-                    (
-                        numpy.squeeze(self._offset[0, num_frame, ...]),
-                        numpy.squeeze(self._offset[1, num_frame, ...]),
-                        numpy.squeeze(self._offset[2, num_frame, ...]),
-                    ),
-                )
-            )
-            * numpy.choose(
-                gain_state,
-                (
-                    numpy.squeeze(self._relative_gain[0, num_frame, ...]),
-                    numpy.squeeze(self._relative_gain[1, num_frame, ...]),
-                    numpy.squeeze(self._relative_gain[2, num_frame, ...]),
-                ),
+        # Gain stage: number of thresholds exceeded by the gain value of each pixel.
+        numpy.greater(
+            gain, self._gain_thresholds[cell_index][0], out=self._stage_buffer
+        )
+        numpy.add(self._pixel_index_base, self._stage_buffer, out=self._gain_stage)
+        numpy.greater(
+            gain, self._gain_thresholds[cell_index][1], out=self._stage_buffer
+        )
+        numpy.add(self._gain_stage, self._stage_buffer, out=self._gain_stage)
+
+        # Offset and gain lookup, using the same (pixel, stage) index for both.
+        numpy.take(self._offset[cell_index], self._gain_stage, out=self._offset_buffer)
+        numpy.take(
+            self._relative_gain[cell_index], self._gain_stage, out=self._gain_buffer
+        )
+        calibrated_data = self._calibrated_data.reshape(-1)
+        numpy.subtract(data, self._offset_buffer, out=calibrated_data, casting="unsafe")
+        numpy.multiply(calibrated_data, self._gain_buffer, out=calibrated_data)
+
+        numpy.multiply(
+            self._calibrated_data, self._detector_mask, out=self._median_buffer
+        )
+        for module_index in range(self._calibrated_data.shape[0]):
+            self._calibrated_data[module_index] -= _median_of_buffer(
+                self._median_buffer[module_index]
             )
-        ).reshape(16, 512, 128)
 
-        masked_image = gain_offset_correction * self._detector_mask
-        median_mask = numpy.median(masked_image, axis=(1, 2))
+        return self._calibrated_data.reshape(8192, 128)
+
+
+def _median_of_buffer(values):
+    # Computes the median of a 1D array, whose content is overwritten. The values
+    # around the median are first isolated using the quantiles of a small sample of
+    # the array, so that only a few of them need to be partitioned (Floyd-Rivest
+    # selection). If the sample is not representative, a full partition is performed.
+    # The result is the same as that of numpy.median, including when the array contains
+    # NaN values: the median is then NaN, which the comparisons below would miss.
+    if values.dtype.kind == "f" and numpy.isnan(values.max()):
+        return values.dtype.type(numpy.nan)
+    num_values = values.shape[0]
+    lower_k = (num_values - 1) // 2
+    upper_k = num_values // 2
+    sample = numpy.sort(values[:: max(1, num_values // 1024) | 1])
+    sample_size = sample.shape[0]
+    margin = int(3 * numpy.sqrt(sample_size)) + 1
+    lower_bound = sample[max(0, sample_size // 2 - margin)]
+    upper_bound = sample[min(sample_size - 1, sample_size // 2 + margin)]
+
+    num_below = numpy.count_nonzero(values < lower_bound)
+    middle_values = values[(values >= lower_bound) & (values <= upper_bound)]
+    if num_below <= lower_k and upper_k < num_below + middle_values.shape[0]:
+        middle_values.partition((lower_k - num_below, upper_k - num_below))
         return (
-            (gain_offset_correction[:, :, :] - median_mask[:, None, None]).reshape(
-                8192, 128
-            ),
-            (gain_states, gain_pixel_counts),
+            middle_values[lower_k - num_below] + middle_values[upper_k - num_below]
+        ) / 2
+
+    values.partition((lower_k, upper_k))
+    return (values[lower_k] + values[upper_k]) / 2
+
+
+# Names of the files, in the cache of converted AGIPD 1M calibration constants, that
+# store the constants for a single cell.
+_AGIPD1M_CELL_CACHE_FILES = ("offset", "relative_gain", "gain_thresholds")
+
+
+def _load_agipd1m_calibration_constants(
+    calibration_filename,  # type: str
+    cellid_list,  # type: List[int]
+    cache_directory,  # type: Optional[str]
+):
+    # type: (...) -> Dict[str, Any]
+    # Memory-maps, read-only, the cached AGIPD 1M calibration constants for the cells
+    # in cellid_list, converting first the constants for the cells that are not in the
+    # cache yet. The name of the cache depends on the path, size and modification time
+    # of the calibration file, so that a stale cache is never used. If the cache
+    # cannot be written to the requested directory (by default, the directory where
+    # the calibration file is located), a directory specific to the current user, in
+    # the temporary directory of the system, is used instead. If that fails as well,
+    # the constants are loaded in memory. For each type of constants, a list with one
+    # array per cell, in the same order as in cellid_list, is returned.
+    calibration_filename = os.path.abspath(calibration_filename)
+    try:
+        file_stat = os.stat(calibration_filename)
+    except OSError as exc:
+        _raise_calibration_file_reading_error(calibration_filename, exc)
+    if cache_directory is None:
+        cache_directory = os.path.dirname(calibration_filename)
+    cache_key = hashlib.sha1(
+        "{0}:{1}:{2}".format(
+            calibration_filename, file_stat.st_size, file_stat.st_mtime
+        ).encode("utf-8")
+    ).hexdigest()[:16]
+    cache_name = ".{0}.{1}.onda_cache".format(
+        os.path.basename(calibration_filename), cache_key
+    )
+
+    for directory in (cache_directory, _get_user_cache_directory()):
+        cache_path = os.path.join(directory, cache_name)
+        try:
+            _update_agipd1m_calibration_cache(
+                calibration_filename=calibration_filename,
+                cellid_list=cellid_list,
+                cache_path=cache_path,
+            )
+        except (IOError, OSError) as exc:
+            print(
+                "OnDA Warning: Cannot write the calibration cache to the {0} "
+                "directory: {1}: {2}".format(directory, type(exc).__name__, exc)
+            )
+            continue
+        constants = {
+            name: [
+                numpy.load(
+                    os.path.join(cache_path, "cell{0}".format(cell), name + ".npy"),
+                    mmap_mode="r",
+                )
+                for cell in cellid_list
+            ]
+            for name in _AGIPD1M_CELL_CACHE_FILES
+        }  # type: Dict[str, Any]
+        constants["detector_mask"] = numpy.load(
+            os.path.join(cache_path, "detector_mask.npy"), mmap_mode="r"
+        )
+        return constants
+
+    print(
+        "OnDA Warning: Cannot write the calibration cache to any directory. The "
+        "calibration constants are loaded in memory."
+    )
+    constants = {name: [] for name in _AGIPD1M_CELL_CACHE_FILES}
+    for _, cell_constants in _read_agipd1m_cell_constants(
+        calibration_filename=calibration_filename, cellid_list=cellid_list
+    ):
+        for name in _AGIPD1M_CELL_CACHE_FILES:
+            constants[name].append(cell_constants[name])
+    constants["detector_mask"] = _read_agipd1m_detector_mask(
+        calibration_filename=calibration_filename
+    )
+    return constants
+
+
+def _get_user_cache_directory():
+    # type: () -> str
+    # Returns the path to a directory, specific to the current user, in the temporary
+    # directory of the system.
+    try:
+        user_name = getpass.getuser()
+    except (ImportError, KeyError, OSError):
+        user_name = "unknown"
+    return os.path.join(tempfile.gettempdir(), "onda_cache_{0}".format(user_name))
+
+
+def _update_agipd1m_calibration_cache(calibration_filename, cellid_list, cache_path):
+    # type: (str, List[int], str) -> None
+    # Converts the constants for the cells in cellid_list that are not in the cache
+    # yet, and the detector mask if needed, and adds them to the cache. The constants
+    # for each cell are written to a temporary directory which is then atomically
+    # renamed, so that processes starting at the same time never see an incomplete
+    # cache. Errors raised while writing the cache are not caught.
+    missing_cells = [
+        cell
+        for cell in cellid_list
+        if not os.path.isdir(os.path.join(cache_path, "cell{0}".format(cell)))
+    ]
+    mask_is_missing = not os.path.isfile(os.path.join(cache_path, "detector_mask.npy"))
+    if not missing_cells and not mask_is_missing:
+        return
+    try:
+        os.makedirs(cache_path)
+    except OSError:
+        if not os.path.isdir(cache_path):
+            raise
+
+    for cell, cell_constants in _read_agipd1m_cell_constants(
+        calibration_filename=calibration_filename, cellid_list=missing_cells
+    ):
+        temporary_path = tempfile.mkdtemp(prefix=".onda_cache_tmp_", dir=cache_path)
+        try:
+            for name in _AGIPD1M_CELL_CACHE_FILES:
+                numpy.save(
+                    os.path.join(temporary_path, name + ".npy"), cell_constants[name]
+                )
+            # The temporary directory is only accessible by its creator.
+            os.chmod(temporary_path, 0o755)
+            os.rename(temporary_path, os.path.join(cache_path, "cell{0}".format(cell)))
+        except OSError:
+            # Another process has added the cell to the cache in the meantime.
+            if not os.path.isdir(os.path.join(cache_path, "cell{0}".format(cell))):
+                raise
+        finally:
+            if os.path.isdir(temporary_path):
+                shutil.rmtree(temporary_path, ignore_errors=True)
+
+    if mask_is_missing:
+        detector_mask = _read_agipd1m_detector_mask(
+            calibration_filename=calibration_filename
+        )
+        fdesc, temporary_filename = tempfile.mkstemp(
+            prefix=".onda_cache_tmp_", suffix=".npy", dir=cache_path
         )
+        try:
+            with os.fdopen(fdesc, "wb") as fhandle:
+                numpy.save(fhandle, detector_mask)
+            os.chmod(temporary_filename, 0o644)
+            os.rename(temporary_filename, os.path.join(cache_path, "detector_mask.npy"))
+        finally:
+            if os.path.isfile(temporary_filename):
+                os.remove(temporary_filename)
+
+
+def _read_agipd1m_cell_constants(
+    calibration_filename,  # type: str
+    cellid_list,  # type: List[int]
+):
+    # type: (...) -> Generator[Tuple[int, Dict[str, numpy.ndarray]], None, None]
+    # Reads the constants for the cells in cellid_list from an AGIPD 1M calibration
+    # file, and converts them to the layout used by the Agipd1MCalibration algorithm.
+    # The constants are yielded one cell at a time, so that only the constants for a
+    # single cell are in memory at any time.
+    num_pixels = 8192 * 128
+    try:
+        with h5py.File(name=calibration_filename, mode="r") as fhandle:
+            num_cells = fhandle["/AnalogOffset"].shape[1]
+            for cell in cellid_list:
+                if not 0 <= cell < num_cells:
+                    raise exceptions.OndaDetectorCalibrationError(
+                        "The {0} calibration file does not contain parameters for "
+                        "cell {1}".format(calibration_filename, cell)
+                    )
+                offset = (
+                    fhandle["/AnalogOffset"][0:3, cell].reshape(3, num_pixels).T.ravel()
+                )
+                relative_gain = (
+                    fhandle["/RelativeGain"][0:3, cell].reshape(3, num_pixels).T.ravel()
+                )
+                digital_gain = fhandle["/DigitalGainLevel"][0:3, cell].reshape(
+                    3, num_pixels
+                )
+                # In the original constants a pixel is in gain stage 2 when its gain
+                # value is above the stage 2 threshold, whatever the stage 1 threshold
+                # is. Using the lowest of the two thresholds as stage 1 threshold
+                # allows the gain stage to be computed as the number of thresholds
+                # exceeded.
+                gain_thresholds = numpy.empty((2, num_pixels), dtype=numpy.int16)
+                numpy.minimum(digital_gain[1], digital_gain[2], out=gain_thresholds[0])
+                gain_thresholds[1] = digital_gain[2]
+                yield cell, {
+                    "offset": offset.astype(numpy.int16, copy=False),
+                    "relative_gain": relative_gain.astype(numpy.float32, copy=False),
+                    "gain_thresholds": gain_thresholds,
+                }
+    except (IOError, OSError, KeyError) as exc:
+        _raise_calibration_file_reading_error(calibration_filename, exc)
+
+
+def _read_agipd1m_detector_mask(calibration_filename):
+    # type: (str) -> numpy.ndarray
+    # Reads the detector mask from an AGIPD 1M calibration file.
+    try:
+        with h5py.File(name=calibration_filename, mode="r") as fhandle:
+            return fhandle["/DetectorMask"][:].reshape(16, 512 * 128)
+    except (IOError, OSError, KeyError) as exc:
+        _raise_calibration_file_reading_error(calibration_filename, exc)
+
+
+def _raise_calibration_file_reading_error(calibration_filename, exc):
+    # type: (str, Exception) -> None
+    # Re-raises an error that occurred while reading a calibration file as an OnDA
+    # exception.
+    exc_type, exc_value = sys.exc_info()[:2]
+    raise_from(
+        exc=exceptions.OndaHdf5FileReadingError(
+            "The following error occurred while reading the {0} HDF5 "
+            "file: {1}: {2}".format(calibration_filename, exc_type.__name__, exc_value)
+        ),
+        cause=exc,
+    )
@@ -23,7 +23,7 @@ from __future__ import absolute_import, division, print_function
 
 import numpy
 
-from onda.algorithms.peakfinder8_extension import peakfinder_8
+from onda.algorithms.peakfinder8_extension import Peakfinder8Context
 from onda.utils import hdf5, named_tuples
 
 
@@ -49,6 +49,8 @@ class Peakfinder8PeakDetection(object):
         bad_pixel_map_filename,  # type: Union[str, None]
         bad_pixel_map_hdf5_path,  # type: Union[str, None]
         radius_pixel_map,  # type: numpy.ndarray
+        num_threads=1,  # type: int
+        warm_start_background_estimation=False,  # type: bool
     ):
         # type: (...) -> None
         """
@@ -124,6 +126,19 @@ class Peakfinder8PeakDetection(object):
                 * Each element of the array must store the distance in pixels from
                   the center of the detector of the corresponding pixel in the data
                   frame.
+
+            num_threads (int): the number of threads used to process the ASICs of the
+                data frame concurrently. The result of the peak search does not
+                depend on the number of threads. This argument has an effect only if
+                the peakfinder8 extension has been compiled with OpenMP support.
+                Defaults to 1.
+
+            warm_start_background_estimation (bool): whether the iterative estimation
+                of the radial background of each frame should start from the values
+                computed for the previous frame. This makes the estimation faster
+                (fewer iterations are needed), at the cost of results that can differ
+                slightly from those of an estimation started from scratch. Defaults to
+                False.
         """
         self._max_num_peaks = max_num_peaks
         self._asic_nx = asic_nx
@@ -135,17 +150,80 @@ class Peakfinder8PeakDetection(object):
         self._min_pixel_count = min_pixel_count
         self._max_pixel_count = max_pixel_count
         self._local_bg_radius = local_bg_radius
-        self._radius_pixel_map = radius_pixel_map
         self._min_res = min_res
         self._max_res = max_res
-        self._mask_initialized = False
+        self._num_threads = num_threads
+        self._warm_start_background_estimation = warm_start_background_estimation
+
+        # The radius map, the resolution mask and the buffer used to convert the data
+        # frames to float32 are computed and allocated only once, and reused for
+        # every frame. The same is true for the peakfinder8 search context, which is
+        # created when the bad pixel map is loaded.
+        self._radius_pixel_map = numpy.ascontiguousarray(
+            radius_pixel_map, dtype=numpy.float32
+        )
+        self._resolution_mask = numpy.ones(
+            shape=self._radius_pixel_map.shape, dtype=numpy.int8
+        )
+        self._resolution_mask[self._radius_pixel_map < self._min_res] = 0
+        self._resolution_mask[self._radius_pixel_map > self._max_res] = 0
+        self._data_buffer = numpy.empty(
+            shape=self._radius_pixel_map.shape, dtype=numpy.float32
+        )
+        self.load_bad_pixel_map(
+            bad_pixel_map_filename=bad_pixel_map_filename,
+            bad_pixel_map_hdf5_path=bad_pixel_map_hdf5_path,
+        )
+
+    def load_bad_pixel_map(self, bad_pixel_map_filename, bad_pixel_map_hdf5_path):
+        # type: (Union[str, None], Union[str, None]) -> None
+        """
+        Loads a new bad pixel map.
 
+        This function replaces the bad pixel map used by the algorithm. The new map is
+        combined with the resolution limits once, when it is loaded, and then used for
+        all the following frames. The peakfinder8 search context is recreated with
+        the new map.
+
+        Arguments:
+
+            bad_pixel_map_filename (Union[str, None): the absolute or relative path to
+                an HDF5 file containing a bad pixel map. If this argument is None, no
+                area of the data frame is excluded from the peak search (apart from the
+                areas outside the resolution limits). See the documentation of the
+                '__init__' function for the format of the map.
+
+            bad_pixel_map_hdf5_path (Union[str, None]): the internal HDF5 path to the
+                data block where the bad pixel map is stored. If the
+                'bad_pixel_map_filename' argument is not None, this argument must also
+                be provided, and cannot be None. Otherwise it is ignored.
+        """
         if bad_pixel_map_filename is not None:
-            self._mask = hdf5.load_hdf5_data(
+            bad_pixel_map = hdf5.load_hdf5_data(
                 hdf5_filename=bad_pixel_map_filename, hdf5_path=bad_pixel_map_hdf5_path
             )
+            self._mask = numpy.ascontiguousarray(
+                bad_pixel_map.astype(numpy.int8) * self._resolution_mask
+            )
         else:
-            self._mask = None
+            self._mask = self._resolution_mask.copy()
+
+        self._context = Peakfinder8Context(
+            self._max_num_peaks,
+            self._mask,
+            self._radius_pixel_map,
+            self._asic_nx,
+            self._asic_ny,
+            self._nasics_x,
+            self._nasics_y,
+            self._adc_thresh,
+            self._minimum_snr,
+            self._min_pixel_count,
+            self._max_pixel_count,
+            self._local_bg_radius,
+            self._num_threads,
+            self._warm_start_background_estimation,
+        )
 
     def find_peaks(self, data):
         # type (numpy.ndarray) -> named_tuples.PeakList
@@ -165,31 +243,40 @@ class Peakfinder8PeakDetection(object):
             :class:`~onda.utils.named_tuples.PeakList`: a named tuple with the
             information about the detected peaks.
         """
-        if not self._mask_initialized:
-            if self._mask is None:
-                self._mask = numpy.ones_like(data, dtype=numpy.int8)
-            else:
-                self._mask = self._mask.astype(numpy.int8)
-
-            res_mask = numpy.ones(shape=self._mask.shape, dtype=numpy.int8)
-            res_mask[numpy.where(self._radius_pixel_map < self._min_res)] = 0
-            res_mask[numpy.where(self._radius_pixel_map > self._max_res)] = 0
-            self._mask *= res_mask
-
-        peak_list = peakfinder_8(
-            self._max_num_peaks,
-            data.astype(numpy.float32),
-            self._mask,
-            self._radius_pixel_map,
-            self._asic_nx,
-            self._asic_ny,
-            self._nasics_x,
-            self._nasics_y,
-            self._adc_thresh,
-            self._minimum_snr,
-            self._min_pixel_count,
-            self._max_pixel_count,
-            self._local_bg_radius,
-        )
+        if data.dtype == numpy.float32 and data.flags["C_CONTIGUOUS"]:
+            float_data = data
+        else:
+            numpy.copyto(self._data_buffer, data, casting="unsafe")
+            float_data = self._data_buffer
+
+        peak_list = self._context.find_peaks(float_data)
 
         return named_tuples.PeakList(*peak_list[0:3])
+
+    def find_peaks_in_batch(self, data):
+        # type (numpy.ndarray) -> named_tuples.PeakListBatch
+        """
+        Finds peaks in a stack of detector data frames.
+
+        This function performs the peak finding on several data frames with a single
+        call to the peakfinder8 extension (for example, on all the frames of a
+        detector train). The buffers used by the algorithm are allocated only once
+        for the whole stack, and the peaks are returned in flat numpy arrays.
+
+        Arguments:
+
+            data (numpy.ndarray): a 3D array (frame, ss, fs) containing the stack of
+                detector data frames on which the peak finding must be performed.
+                Each frame must have the same shape as the radius pixel map.
+
+        Returns:
+
+            :class:`~onda.utils.named_tuples.PeakListBatch`: a named tuple with the
+            information about the detected peaks. For each peak, the tuple also stores
+            the index of the frame, in the stack, where the peak was found.
+        """
+        peak_list = self._context.find_peaks_in_batch(
+            numpy.ascontiguousarray(data, dtype=numpy.float32)
+        )
+
+        return named_tuples.PeakListBatch(*peak_list[0:4])
@@ -22,9 +22,17 @@ etc.).
 """
 from __future__ import absolute_import, division, print_function
 
-from typing import Any, Dict, List, Optional, Union  # pylint: disable=unused-import
-
-import numpy  # pylint: disable=unused-import
+import math
+from typing import (  # pylint: disable=unused-import
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import numpy
 
 from onda.utils import exceptions, hdf5
 
@@ -105,53 +113,69 @@ class Correction(object):
                 * If the 'gain_filename' argument is not None, this argument must also
                   be provided, and cannot be None. Otherwise it is ignored.
         """
-        if mask_filename is not None:
-            if mask_hdf5_path is not None:
-                self._mask = hdf5.load_hdf5_data(
-                    hdf5_filename=mask_filename, hdf5_path=mask_hdf5_path
-                )
+        # The mask, the dark frame and the gain map are often stored in the same file,
+        # which is then opened only once.
+        with hdf5.Hdf5Reader() as reader:
+            if mask_filename is not None:
+                if mask_hdf5_path is not None:
+                    mask = reader.load_data(
+                        hdf5_filename=mask_filename, hdf5_path=mask_hdf5_path
+                    )
+                else:
+                    raise exceptions.OndaMissingHdf5PathError(
+                        "Correction Algorithm: missing HDF5 path for mask."
+                    )
             else:
-                raise exceptions.OndaMissingHdf5PathError(
-                    "Correction Algorithm: missing HDF5 path for mask."
-                )
-        else:
-            # True here is equivalent to an all-one mask.
-            self._mask = True
+                mask = None
 
-        if dark_filename is not None:
-            if dark_hdf5_path is not None:
-                self._dark = (
-                    hdf5.load_hdf5_data(
+            if dark_filename is not None:
+                if dark_hdf5_path is not None:
+                    dark = reader.load_data(
                         hdf5_filename=dark_filename, hdf5_path=dark_hdf5_path
                     )
-                    * self._mask
-                )
+                else:
+                    raise exceptions.OndaMissingHdf5PathError(
+                        "Correction Algorithm: missing HDF5 path for dark frame data."
+                    )
             else:
-                raise exceptions.OndaMissingHdf5PathError(
-                    "Correction Algorithm: missing HDF5 path for dark frame data."
-                )
-        else:
-            # False here is equivalent to an all-zero mask.
-            self._dark = False
+                dark = None
 
-        if gain_filename is not None:
-            if gain_hdf5_path is not None:
-                self._gain = (
-                    hdf5.load_hdf5_data(
+            if gain_filename is not None:
+                if gain_hdf5_path is not None:
+                    gain = reader.load_data(
                         hdf5_filename=gain_filename, hdf5_path=gain_hdf5_path
                     )
-                    * self._mask
-                )
+                else:
+                    raise exceptions.OndaMissingHdf5PathError(
+                        "Correction Algorithm: missing HDF5 path for gain map."
+                    )
             else:
-                raise exceptions.OndaMissingHdf5PathError(
-                    "Correction Algorithm: missing HDF5 path for gain map."
-                )
+                gain = None
+
+        # Since the mask only contains zeros and ones, (data * mask - dark * mask) *
+        # gain * mask is equal to (data - dark) * (gain * mask). The mask and the gain
+        # map are therefore combined into a single multiplicative map, computed only
+        # once. The stages that are not configured are skipped entirely (None).
+        if dark is not None:
+            self._dark = numpy.ascontiguousarray(dark, dtype=numpy.float32)
+        else:
+            self._dark = None
+
+        if mask is not None and gain is not None:
+            self._gain_map = numpy.ascontiguousarray(
+                gain * (mask != 0), dtype=numpy.float32
+            )
+        elif mask is not None:
+            self._gain_map = numpy.ascontiguousarray(mask != 0, dtype=numpy.float32)
+        elif gain is not None:
+            self._gain_map = numpy.ascontiguousarray(gain, dtype=numpy.float32)
         else:
-            # True here is equivalent to an all-one map.
-            self._gain_map = True
+            self._gain_map = None
+
+        self._output_buffer = None  # type: Optional[numpy.ndarray]
 
-    def apply_correction(self, data):
-        # type (numpy.ndarray) -> numpy.ndarray
+    def apply_correction(self, data, in_place=False):
+        # type (numpy.ndarray, bool) -> numpy.ndarray
         """
         Applies the corrections to a detector data frame.
 
@@ -159,17 +183,42 @@ class Correction(object):
         dark data, if provided, is then subtracted. Finally, the result is multiplied
         by the gain map (if provided).
 
+        The corrected data is stored in a float32 array that is allocated only once,
+        and reused for every frame: its content is overwritten at the next call of
+        this function. A copy of the returned array must be made if the corrected data
+        needs to be retained.
+
         Arguments:
 
             data (numpy.ndarray): the detector data frame on which the correction
                 must be applied.
 
+            in_place (bool): if True, and if the data frame is a writable float32
+                array, the corrected data is written directly into the data frame,
+                which is then returned. Otherwise, this argument is ignored. Defaults
+                to False.
+
         Returns:
 
             numpy.ndarray: the corrected data.
 
         """
-        return (data * self._mask - self._dark) * self._gain_map
+        if in_place and data.dtype == numpy.float32 and data.flags["WRITEABLE"]:
+            corrected_data = data
+        else:
+            if self._output_buffer is None or self._output_buffer.shape != data.shape:
+                self._output_buffer = numpy.empty(shape=data.shape, dtype=numpy.float32)
+            corrected_data = self._output_buffer
+
+        if self._dark is not None:
+            numpy.subtract(data, self._dark, out=corrected_data, casting="unsafe")
+        elif corrected_data is not data:
+            numpy.copyto(corrected_data, data, casting="unsafe")
+
+        if self._gain_map is not None:
+            numpy.multiply(corrected_data, self._gain_map, out=corrected_data)
+
+        return corrected_data
 
 
 class DataAccumulator(object):
@@ -224,3 +273,289 @@ class DataAccumulator(object):
             return data_to_return
 
         return None
+
+
+class ColumnarDataAccumulator(object):
+    """
+    See documentation of the '__init__' function.
+    """
+
+    def __init__(self, num_events_to_accumulate):
+        # type: (int) -> None
+        """
+        Data accumulation and bulk retrieval in columnar format.
+
+        This algorithm accumulates a predefined number of data entries, like the
+        :class:`DataAccumulator` algorithm. However, when the accumulator is 'full',
+        the accumulated data is returned as a set of columns, each stored in a
+        contiguous numpy array, instead of a list of entries.
+
+        Each data entry is made of scalar values (numbers or booleans) and,
+        optionally, of one-dimensional arrays, whose length can change from entry to
+        entry (for example, lists of peaks). The scalar values with the same name in
+        all the accumulated entries are stored in a single column. The arrays with the
+        same name are concatenated into a single column. For each of them, an
+        additional column, named after the array with the suffix '_offsets', stores
+        the position at which the array from each entry starts in the concatenated
+        column: the array from the entry i is stored between the positions offsets[i]
+        and offsets[i+1].
+
+        Arguments:
+
+            num_events_to_accumulate (int): the number of data entries that can be
+                added to the accumulator before it is 'full'.
+        """
+        self._num_events_to_accumulate = num_events_to_accumulate
+        self._scalar_columns = {}  # type: Dict[str, List[Any]]
+        self._array_columns = {}  # type: Dict[str, List[numpy.ndarray]]
+        self._num_events_in_accumulator = 0
+
+    def add_data(
+        self,
+        scalar_data,  # type: Dict[str, Any]
+        array_data=None,  # type: Optional[Dict[str, numpy.ndarray]]
+    ):
+        # type: (...) -> Optional[Dict[str, numpy.ndarray]]
+        """
+        Adds data to the accumulator.
+
+        If the addition of data 'fills' the accumulator, this function additionally
+        empties it, returning the accumulated data to the user. All the data entries
+        added to the accumulator must contain the same scalar values and arrays.
+
+        Arguments:
+
+            scalar_data (Dict[str, Any]): a dictionary storing the scalar values of
+                the data entry.
+
+            array_data (Optional[Dict[str, numpy.ndarray]]): a dictionary storing the
+                one-dimensional arrays of the data entry, or None if the entry has no
+                arrays. Defaults to None.
+
+        Returns:
+
+            Optional[Dict[str, numpy.ndarray]]: either a dictionary containing the
+            accumulated data columns (if the accumulator is emptied), or None, if more
+            data entries can still be added to the accumulator.
+        """
+        for name, value in scalar_data.items():
+            self._scalar_columns.setdefault(name, []).append(value)
+        if array_data is not None:
+            for name, array in array_data.items():
+                self._array_columns.setdefault(name, []).append(array)
+        self._num_events_in_accumulator += 1
+
+        if self._num_events_in_accumulator < self._num_events_to_accumulate:
+            return None
+
+        columns = {}  # type: Dict[str, numpy.ndarray]
+        for name, values in self._scalar_columns.items():
+            columns[name] = numpy.array(values)
+        for name, arrays in self._array_columns.items():
+            columns[name] = numpy.concatenate(arrays)
+            offsets = numpy.zeros(len(arrays) + 1, dtype=numpy.int64)
+            numpy.cumsum([len(array) for array in arrays], out=offsets[1:])
+            columns[name + "_offsets"] = offsets
+
+        self._scalar_columns = {}
+        self._array_columns = {}
+        self._num_events_in_accumulator = 0
+        return columns
+
+
+class RunningStatistics(object):
+    """
+    See documentation of the '__init__' function.
+    """
+
+    def __init__(
+        self,
+        window_size,  # type: int
+        exponential_average_factor=0.01,  # type: float
+        histogram_range=None,  # type: Optional[Tuple[float, float]]
+        num_histogram_bins=1000,  # type: int
+    ):
+        # type: (...) -> None
+        """
+        Running statistics over a sliding window of values.
+
+        This algorithm computes statistics on a stream of values (for example, the hit
+        rate, the saturation rate or the number of peaks found in each frame): the
+        average of the most recent values, falling within a window of fixed size, an
+        exponentially weighted average of all the values, and, optionally, percentiles
+        of the values in the window. All the statistics are updated incrementally,
+        with a cost that does not depend on the size of the window. The window is
+        initially filled with zeros.
+
+        Percentiles are computed from a histogram of the values in the window, with a
+        fixed number of bins spanning a fixed range. Their precision is therefore
+        limited by the width of the histogram bins. Values outside the range of the
+        histogram are counted in the first or last bin.
+
+        Values that are not finite (NaN or infinite) are ignored, and do not change
+        any of the statistics.
+
+        Arguments:
+
+            window_size (int): the number of most recent values over which the
+                average and the percentiles are computed.
+
+            exponential_average_factor (float): the weight given to each new value in
+                the exponentially weighted average. Defaults to 0.01.
+
+            histogram_range (Optional[Tuple[float, float]]): the minimum and maximum
+                values covered by the histogram used to compute percentiles. If this
+                argument is None, percentiles are not computed. Defaults to None.
+
+            num_histogram_bins (int): the number of bins in the histogram used to
+                compute percentiles. Defaults to 1000.
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaRunningStatisticsError`: if the window
+                size or the number of histogram bins is not positive, or if the
+                maximum of the histogram range is not larger than the minimum.
+        """
+        if window_size <= 0:
+            raise exceptions.OndaRunningStatisticsError(
+                "RunningStatistics Algorithm: the window size must be positive."
+            )
+        if histogram_range is not None:
+            if not float(histogram_range[1]) > float(histogram_range[0]):
+                raise exceptions.OndaRunningStatisticsError(
+                    "RunningStatistics Algorithm: the maximum of the histogram range "
+                    "must be larger than the minimum."
+                )
+            if num_histogram_bins <= 0:
+                raise exceptions.OndaRunningStatisticsError(
+                    "RunningStatistics Algorithm: the number of histogram bins must be "
+                    "positive."
+                )
+        self._window_size = window_size
+        self._exponential_average_factor = exponential_average_factor
+        self._window = [0.0] * window_size
+        self._window_position = 0
+        self._window_sum = 0.0
+        self._exponential_average = None  # type: Optional[float]
+
+        if histogram_range is not None:
+            self._histogram_min = float(histogram_range[0])
+            self._histogram_bin_width = (
+                float(histogram_range[1]) - self._histogram_min
+            ) / num_histogram_bins
+            self._num_histogram_bins = num_histogram_bins
+            self._histogram = [0] * num_histogram_bins
+            self._window_bins = [self._get_bin(0.0)] * window_size
+            self._histogram[self._window_bins[0]] = window_size
+        else:
+            self._histogram = None
+
+    def add_value(self, value):
+        # type: (float) -> None
+        """
+        Adds a value to the running statistics.
+
+        The value is added to the window, replacing the oldest value in it, and all
+        the statistics are updated. Values that are not finite are ignored.
+
+        Arguments:
+
+            value (float): the value to add.
+        """
+        value = float(value)
+        if math.isnan(value) or math.isinf(value):
+            return
+        position = self._window_position
+        self._window_sum += value - self._window[position]
+        self._window[position] = value
+        if self._histogram is not None:
+            self._histogram[self._window_bins[position]] -= 1
+            value_bin = self._get_bin(value)
+            self._histogram[value_bin] += 1
+            self._window_bins[position] = value_bin
+
+        position += 1
+        if position == self._window_size:
+            position = 0
+            # The sum is recomputed once per window, so that floating point rounding
+            # errors do not accumulate.
+            self._window_sum = math.fsum(self._window)
+        self._window_position = position
+
+        if self._exponential_average is None:
+            self._exponential_average = value
+        else:
+            self._exponential_average += self._exponential_average_factor * (
+                value - self._exponential_average
+            )
+
+    def get_average(self):
+        # type: () -> float
+        """
+        Returns the average of the values in the window.
+
+        Returns:
+
+            float: the average of the values in the window.
+        """
+        return self._window_sum / self._window_size
+
+    def get_exponential_average(self):
+        # type: () -> float
+        """
+        Returns the exponentially weighted average of all the values added so far.
+
+        Returns:
+
+            float: the exponentially weighted average, or 0.0 if no value has been
+            added yet.
+        """
+        if self._exponential_average is None:
+            return 0.0
+        return self._exponential_average
+
+    def get_percentiles(self, percentiles):
+        # type: (List[float]) -> List[float]
+        """
+        Returns percentiles of the values in the window.
+
+        Each percentile is approximated by the center of the histogram bin in which
+        it falls.
+
+        Arguments:
+
+            percentiles (List[float]): the percentiles to compute, each between 0 and
+                100.
+
+        Returns:
+
+            List[float]: the requested percentiles, in the same order as in the
+            percentiles argument.
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaRunningStatisticsError`: if the
+                algorithm was created without a histogram range.
+        """
+        if self._histogram is None:
+            raise exceptions.OndaRunningStatisticsError(
+                "RunningStatistics Algorithm: percentiles cannot be computed without "
+                "a histogram range."
+            )
+        cumulative_histogram = numpy.cumsum(self._histogram)
+        ranks = numpy.round(
+            numpy.asarray(percentiles, dtype=numpy.float64)
+            / 100.0
+            * (self._window_size - 1)
+        )
+        bins = numpy.searchsorted(cumulative_histogram, ranks, side="right")
+        return [
+            float(self._histogram_min + (value_bin + 0.5) * self._histogram_bin_width)
+            for value_bin in bins
+        ]
+
+    def _get_bin(self, value):
+        # type: (float) -> int
+        # Returns the index of the histogram bin in which a value falls.
+        value_bin = int((value - self._histogram_min) / self._histogram_bin_width)
+        return min(max(value_bin, 0), self._num_histogram_bins - 1)
@@ -19,4 +19,8 @@ Peakfinder8 algorithm wrapped using cython.
 This module contains the 'peakfinder8' peak finder written in C++, along with its
 Cython wrapper.
 """
-from .peakfinder8_extension import peakfinder_8  # pylint: disable=import-error
+from .peakfinder8_extension import (  # pylint: disable=import-error
+    Peakfinder8Context,
+    peakfinder_8,
+    peakfinder_8_batch,
+)
@@ -122,3 +122,56 @@ def detector_data(event):
     return event.data[event.framework_info["detector_label"]]["image.data"][
         event.current_frame, ...
     ].reshape(16 * 512, 128)
+
+
+def detector_gain(event):
+    # type: (data_event.DataEvent) -> numpy.ndarray
+    """
+    Retrieves from Karabo the gain information for one frame of AGIPD 1M data.
+
+    This function retrieves, for the detector identified by the
+    'karabo_detector_label' entry in the 'DataRetrievalLayer' configuration parameter
+    group, the information needed to determine the gain stage of each pixel in a data
+    frame. The information is needed by the
+    :class:`~onda.algorithms.calibration_algorithms.Agipd1MCalibration` algorithm.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing
+            the event data.
+
+    Returns:
+
+        numpy.ndarray: the gain information for the frame, with the same shape as the
+        detector data frame.
+    """
+    return event.data[event.framework_info["detector_label"]]["image.gain"][
+        event.current_frame, ...
+    ].reshape(16 * 512, 128)
+
+
+def detector_cell(event):
+    # type: (data_event.DataEvent) -> int
+    """
+    Retrieves from Karabo the cell from which one frame of AGIPD 1M data originates.
+
+    This function retrieves, for the detector identified by the
+    'karabo_detector_label' entry in the 'DataRetrievalLayer' configuration parameter
+    group, the memory cell, within an event, from which a data frame originates. The
+    information is needed by the
+    :class:`~onda.algorithms.calibration_algorithms.Agipd1MCalibration` algorithm.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing
+            the event data.
+
+    Returns:
+
+        int: the cell from which the frame originates.
+    """
+    return int(
+        event.data[event.framework_info["detector_label"]]["image.cellId"][
+            event.current_frame
+        ]
+    )
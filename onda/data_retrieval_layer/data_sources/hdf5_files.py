@@ -0,0 +1,358 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Retrieval of detector data from HDF5 files.
+
+This module contains functions that retrieve data from HDF5 files storing stacks of
+detector frames, like the files written by Eiger and Jungfrau detectors, or CXI files.
+"""
+from __future__ import absolute_import, division, print_function
+
+from typing import Any, List, Optional, Tuple  # pylint: disable=unused-import
+
+import numpy
+from future.utils import raise_from
+
+from onda.utils import data_event, exceptions, hdf5  # pylint: disable=unused-import
+
+try:
+    # Registers with the HDF5 library the compression filters used by many detectors
+    # (for example, the bitshuffle/LZ4 filter used by Eiger detectors), if available.
+    import hdf5plugin  # pylint: disable=import-error,unused-import
+except ImportError:
+    pass
+
+
+# Internal HDF5 paths where the detector data is looked for, in order, when the
+# 'hdf5_data_path' entry in the 'DataRetrievalLayer' parameter group is not set: the
+# path used by NeXus files (Eiger data files), by CXI files, and by Cheetah-style files.
+_DEFAULT_HDF5_DATA_PATHS = ("/entry/data/data", "/entry_1/data_1/data", "/data/data")
+
+
+class _FrameBufferRing(object):
+    # Stores a fixed number of buffers into which detector frames are read, and hands
+    # them out in turn, so that their memory is reused for later frames. A buffer is
+    # therefore overwritten when as many frames as there are buffers have been read
+    # after it. The ring must be large enough to hold all the frames that can be in
+    # use at the same time: the frame being processed, the frames waiting in the
+    # prefetching queue, and the frame being read.
+    def __init__(self, num_buffers):
+        # type: (int) -> None
+        self._buffers = [None] * num_buffers  # type: List[Optional[numpy.ndarray]]
+        self._next_buffer_index = 0
+
+    def get_buffer(self, shape, dtype):
+        # type: (Tuple[int, ...], Any) -> numpy.ndarray
+        buffer_index = self._next_buffer_index
+        self._next_buffer_index = (buffer_index + 1) % len(self._buffers)
+        buffer = self._buffers[buffer_index]
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = numpy.empty(shape=shape, dtype=dtype)
+            self._buffers[buffer_index] = buffer
+        return buffer
+
+
+def _get_frame_range(num_frames, frames_per_chunk, frame_range_index, num_frame_ranges):
+    # type: (int, int, int, int) -> Tuple[int, int]
+    # Splits the frames into ranges of consecutive frames, as equally as possible, and
+    # returns the first and last (excluded) frame in the requested range. The ranges
+    # start at chunk boundaries, so that no chunk has to be read for two ranges.
+    num_chunks = -(-num_frames // frames_per_chunk)
+    first_chunk = num_chunks * frame_range_index // num_frame_ranges
+    last_chunk = num_chunks * (frame_range_index + 1) // num_frame_ranges
+    return (
+        min(first_chunk * frames_per_chunk, num_frames),
+        min(last_chunk * frames_per_chunk, num_frames),
+    )
+
+
+#####################
+#                   #
+# UTILITY FUNCTIONS #
+#                   #
+#####################
+
+
+def get_file_extensions():
+    # type: () -> Tuple[str, ...]
+    """
+    Retrieves a list of extensions used by HDF5 data files.
+
+    Returns:
+
+        Tuple[str, ...]: the list of file extensions.
+    """
+    return (".h5", ".hdf5", ".cxi", ".nxs")
+
+
+############################
+#                          #
+# EVENT HANDLING FUNCTIONS #
+#                          #
+############################
+
+
+def open_event(event):
+    # type: (data_event.DataEvent) -> None
+    """
+    Opens an event retrieved from HDF5 files.
+
+    For HDF5 data files, an event corresponds to a stack of detector frames stored in a
+    single HDF5 file. The stack is read from the internal path stored in the
+    'hdf5_data_path' entry of the event's framework information or, if no path is
+    stored there, from the first of several commonly used paths that is found in the
+    file. The first axis of the stack indexes the frames. A data block with only two
+    axes is considered a stack with a single frame.
+
+    If the event's framework information stores a frame range (the first and last,
+    excluded, frame), only the frames in the range are part of the event. If it stores
+    instead a frame range index and a number of frame ranges, the frames are split into
+    ranges of consecutive frames, as equally as possible, each starting at a chunk
+    boundary of the data block, and only the frames in the corresponding range are
+    part of the event.
+
+    This function makes the file available in the 'data' field of the 'event' object,
+    and information about the stack (including the number of consecutive frames stored
+    in each chunk, in the 'frames_per_chunk' entry) in the 'metadata' field.
+
+    NOTE: This function is designed to be injected as a member function into an
+    :class:`~onda.utils.data_event.DataEvent` object.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+
+    Raises:
+
+        :class:`~onda.utils.exceptions.OndaMissingHdf5PathError`: if the detector data
+            cannot be found in the file.
+    """
+    hdf5_filename = event.framework_info["full_path"]
+    event.data = hdf5.Hdf5Reader(max_open_files=1)
+    if "hdf5_data_path" in event.framework_info:
+        hdf5_data_paths = (
+            event.framework_info["hdf5_data_path"],
+        )  # type: Tuple[str, ...]
+    else:
+        hdf5_data_paths = _DEFAULT_HDF5_DATA_PATHS
+    for hdf5_data_path in hdf5_data_paths:
+        try:
+            data_block = event.data.get_data_block(
+                hdf5_filename=hdf5_filename, hdf5_path=hdf5_data_path
+            )
+            break
+        except exceptions.OndaHdf5FileReadingError as exc:
+            reading_error = exc
+    else:
+        event.data.close()
+        raise_from(
+            exc=exceptions.OndaMissingHdf5PathError(
+                "Cannot find the detector data in the {0} HDF5 file (paths tried: "
+                "{1}).".format(hdf5_filename, ", ".join(hdf5_data_paths))
+            ),
+            cause=reading_error,
+        )
+
+    if len(data_block.shape) == 2:
+        frames_are_stacked = False
+        num_frames = 1
+        frame_shape = tuple(data_block.shape)
+    else:
+        frames_are_stacked = True
+        num_frames = data_block.shape[0]
+        frame_shape = tuple(data_block.shape[1:])
+    if data_block.chunks is not None and frames_are_stacked:
+        frames_per_chunk = data_block.chunks[0]
+    else:
+        frames_per_chunk = 1
+
+    if "frame_range" in event.framework_info:
+        first_frame = min(event.framework_info["frame_range"][0], num_frames)
+        last_frame = min(event.framework_info["frame_range"][1], num_frames)
+    elif "num_frame_ranges" in event.framework_info:
+        first_frame, last_frame = _get_frame_range(
+            num_frames=num_frames,
+            frames_per_chunk=frames_per_chunk,
+            frame_range_index=event.framework_info["frame_range_index"],
+            num_frame_ranges=event.framework_info["num_frame_ranges"],
+        )
+    else:
+        first_frame, last_frame = 0, num_frames
+
+    event.metadata = {
+        "hdf5_data_path": hdf5_data_path,
+        "frames_are_stacked": frames_are_stacked,
+        "first_frame": first_frame,
+        "num_frames": last_frame - first_frame,
+        "frames_per_chunk": frames_per_chunk,
+        "frame_shape": frame_shape,
+        "dtype": data_block.dtype,
+        # Frames stored uncompressed, one per chunk, can be read directly from the
+        # file, bypassing the HDF5 library's data selection machinery.
+        "direct_chunk_reads": (
+            frames_are_stacked
+            and data_block.chunks == (1,) + frame_shape
+            and data_block.compression is None
+            and not data_block.id.get_create_plist().get_nfilters()
+        ),
+    }
+
+    # The buffer ring is stored in the event, which is reused for all the events
+    # retrieved by a worker node, so that buffers can be reused across files.
+    if "frame_buffer_ring" not in event.framework_info:
+        event.framework_info["frame_buffer_ring"] = _FrameBufferRing(
+            num_buffers=event.framework_info.get("num_prefetched_frames", 0) + 2
+        )
+
+
+def close_event(event):
+    # type: (data_event.DataEvent) -> None
+    """
+    Closes an event retrieved from HDF5 files.
+
+    NOTE: This function is designed to be injected as a member function into an
+    :class:`~onda.utils.data_event.DataEvent` object.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+    """
+    event.data.close()
+
+
+def get_num_frames_in_event(event):
+    # type: (data_event.DataEvent) -> int
+    """
+    Gets the number of frames in an event retrieved from HDF5 files.
+
+    For HDF5 data files, this is the number of frames in the stack stored in the file
+    or, if the frames are split into ranges, the number of frames in the range assigned
+    to the event.
+
+    NOTE: This function is designed to be injected as a member function into an
+    :class:`~onda.utils.data_event.DataEvent` object.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+
+    Returns:
+
+        int: the number of frames in the event.
+    """
+    return event.metadata["num_frames"]
+
+
+#############################
+#                           #
+# DATA EXTRACTION FUNCTIONS #
+#                           #
+#############################
+
+
+def detector_data(event):
+    # type: (data_event.DataEvent) -> numpy.ndarray
+    """
+    Retrieves one frame of detector data from HDF5 files.
+
+    The frame is read directly into one of a fixed set of buffers, which are reused in
+    turn for the frames read later. A frame must therefore not be used anymore once
+    the next frame has been retrieved: with N prefetched frames (as stored in the
+    'num_prefetched_frames' entry of the event's framework information), its buffer
+    is overwritten when N + 2 further frames have been read. Any code that keeps the
+    frame for longer (for example, to send it to another node without copying it) must
+    copy it first. When each chunk of the data block stores a single uncompressed
+    frame, the chunk is read without going through the HDF5 library's data selection
+    machinery.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+
+    Returns:
+
+        numpy.ndarray: one frame of detector data.
+    """
+    metadata = event.metadata
+    frame_index = metadata["first_frame"] + event.current_frame
+    buffer = event.framework_info["frame_buffer_ring"].get_buffer(
+        shape=metadata["frame_shape"], dtype=metadata["dtype"]
+    )
+    if metadata["direct_chunk_reads"]:
+        # The chunk includes the frame axis, of length 1.
+        event.data.read_chunk_into(
+            hdf5_filename=event.framework_info["full_path"],
+            hdf5_path=metadata["hdf5_data_path"],
+            chunk_offset=(frame_index,) + (0,) * len(metadata["frame_shape"]),
+            out=buffer.reshape((1,) + metadata["frame_shape"]),
+        )
+        return buffer
+    if metadata["frames_are_stacked"]:
+        selection = numpy.s_[frame_index, ...]
+    else:
+        selection = None
+    return event.data.read_data_into(
+        hdf5_filename=event.framework_info["full_path"],
+        hdf5_path=metadata["hdf5_data_path"],
+        out=buffer,
+        selection=selection,
+    )
+
+
+def event_id(event):
+    # type: (data_event.DataEvent) -> str
+    """
+    Gets a unique identifier for an event retrieved from HDF5 files.
+
+    Returns a label that unambiguosly identifies, within an experiment, the event
+    currently being processed. For HDF5 data files, an event corresponds to a single
+    file, and the full path to the file is used as identifier.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+
+    Returns:
+
+        str: a unique event identifier.
+    """
+    return event.framework_info["full_path"]
+
+
+def frame_id(event):
+    # type: (data_event.DataEvent) -> str
+    """
+    Gets a unique identifier for a detector frame retrieved from HDF5 files.
+
+    Returns a label that unambiguosly identifies, within an event, the frame currently
+    being processed. The index of the frame within the stack stored in the file is used
+    as identifier (even when the event only contains a range of the frames).
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+
+    Returns:
+
+        str: a unique frame identifier (within an event).
+    """
+    return str(event.metadata["first_frame"] + event.current_frame)
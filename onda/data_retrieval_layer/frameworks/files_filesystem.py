@@ -21,18 +21,560 @@ on disk.
 """
 from __future__ import absolute_import, division, print_function
 
-import os.path
-from typing import Generator  # pylint: disable=unused-import
+import bisect
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import (  # pylint: disable=unused-import
+    Any,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
-import numpy
+import numpy  # pylint: disable=unused-import
 from future.utils import raise_from
 
 from onda.utils import (  # pylint: disable=unused-import
     data_event,
     dynamic_import,
+    exceptions,
     parameters,
 )
 
+try:
+    import inotify_simple  # pylint: disable=import-error
+except ImportError:
+    inotify_simple = None
+
+
+def _dynamically_assigned_entries(entries, event_indexes):
+    # type: (List[str], Iterator[int]) -> Generator[str, None, None]
+    # Yields the entries pointed to by the event indexes assigned to the current worker
+    # node, stopping as soon as an index goes beyond the end of the list.
+    for event_index in event_indexes:
+        if event_index >= len(entries):
+            return
+        yield entries[event_index]
+
+
+def _read_file_list(source):
+    # type: (str) -> List[str]
+    # Reads the list of files to process from the source file.
+    try:
+        with open(source, "r") as fhandle:
+            return [entry.strip() for entry in fhandle.readlines()]
+    except (IOError, OSError) as exc:
+        raise_from(
+            exc=RuntimeError("Error reading the {0} source file.".format(source)),
+            cause=exc,
+        )
+
+
+def _listed_entries(filelist, node_rank, node_pool_size, event_indexes):
+    # type: (List[str], int, int, Optional[Iterator[int]]) -> Iterator[str]
+    # Returns the entries in the list of files that the current worker node should
+    # process.
+    if event_indexes is None:
+        # Splits the files as equally as possible amongst the workers: the numbers of
+        # files processed by any two workers differ at most by one.
+        num_worker_nodes = node_pool_size - 1
+        files_curr_node = filelist[
+            (len(filelist) * (node_rank - 1) // num_worker_nodes) : (
+                len(filelist) * node_rank // num_worker_nodes
+            )
+        ]
+        return iter(files_curr_node)
+
+    return _dynamically_assigned_entries(entries=filelist, event_indexes=event_indexes)
+
+
+def _create_data_event(monitor_params):
+    # type: (parameters.MonitorParams) -> data_event.DataEvent
+    # Creates the data event used to retrieve data from the files, and fills its
+    # framework information with the static data that will be retrieved later.
+    data_retrieval_layer_filename = monitor_params.get_param(
+        group="Onda", parameter="data_retrieval_layer", type_=str, required=True
+    )
+    data_retrieval_layer = dynamic_import.import_data_retrieval_layer(
+        data_retrieval_layer_filename=data_retrieval_layer_filename
+    )
+    required_data = monitor_params.get_param(
+        group="Onda", parameter="required_data", type_=list, required=True
+    )
+    event_handling_functions = dynamic_import.get_event_handling_funcs(
+        data_retrieval_layer=data_retrieval_layer
+    )
+    data_extraction_functions = dynamic_import.get_data_extraction_funcs(
+        required_data=required_data, data_retrieval_layer=data_retrieval_layer
+    )
+    event = data_event.DataEvent(
+        event_handling_funcs=event_handling_functions,
+        data_extraction_funcs=data_extraction_functions,
+    )
+
+    if "beam_energy" in data_extraction_functions:
+        event.framework_info["beam_energy"] = monitor_params.get_param(
+            group="DataRetrievalLayer",
+            parameter="fallback_beam_energy_in_eV",
+            type_=float,
+            required=True,
+        )
+    if "detector_distance" in data_extraction_functions:
+        event.framework_info["detector_distance"] = monitor_params.get_param(
+            group="DataRetrievalLayer",
+            parameter="fallback_detector_distance_in_mm",
+            type_=float,
+            required=True,
+        )
+
+    # The path to the detector data in HDF5 files can be provided in the configuration
+    # file, for Data Retrieval Layers that read HDF5 files.
+    hdf5_data_path = monitor_params.get_param(
+        group="DataRetrievalLayer", parameter="hdf5_data_path", type_=str
+    )
+    if hdf5_data_path is not None:
+        event.framework_info["hdf5_data_path"] = hdf5_data_path
+
+    # The number of frames retrieved in advance determines how many frames can be in
+    # use at the same time, and therefore how many buffers the Data Retrieval Layer
+    # needs if it reuses the memory of the frames.
+    num_prefetched_frames = monitor_params.get_param(
+        group="Onda", parameter="num_prefetched_frames", type_=int
+    )
+    event.framework_info["num_prefetched_frames"] = (
+        num_prefetched_frames if num_prefetched_frames is not None else 0
+    )
+
+    return event
+
+
+def _get_frame_count_index_filename(source, monitor_params):
+    # type: (str, parameters.MonitorParams) -> str
+    # Returns the path to the file where the number of frames in each listed file is
+    # cached.
+    frame_count_index_filename = monitor_params.get_param(
+        group="DataRetrievalLayer",
+        parameter="filesystem_frame_count_index_file",
+        type_=str,
+    )
+    if frame_count_index_filename is None:
+        frame_count_index_filename = os.path.join(
+            os.path.dirname(os.path.abspath(source)),
+            ".{0}.onda_frame_counts".format(os.path.basename(source)),
+        )
+    return frame_count_index_filename
+
+
+def _read_frame_count_index(index_filename):
+    # type: (str) -> Dict[str, Dict[str, Any]]
+    # Reads the frame count index. A missing or unreadable index is empty.
+    try:
+        with open(index_filename, "r") as fhandle:
+            return json.load(fhandle)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _update_frame_count_index(filelist, event, index):
+    # type: (List[str], data_event.DataEvent, Dict[str, Dict[str, Any]]) -> bool
+    # Updates, in place, the frame count index entries of the listed files, and returns
+    # whether any entry has changed. The entry of a file is kept as long as the size and
+    # the modification time of the file do not change. Otherwise, the file is opened as
+    # a data event to count its frames, and to find how many consecutive frames are
+    # stored in each chunk (one, if the Data Retrieval Layer does not report it).
+    index_has_changed = False
+    for filename in filelist:
+        key = os.path.abspath(filename)
+        file_stat = os.stat(filename)
+        entry = index.get(key)
+        if (
+            entry is not None
+            and entry["size"] == file_stat.st_size
+            and entry["mtime"] == file_stat.st_mtime
+            and "frames_per_chunk" in entry
+        ):
+            continue
+        event.framework_info["full_path"] = filename
+        event.open_event()
+        try:
+            num_frames = event.get_num_frames_in_event()
+            if isinstance(event.metadata, dict):
+                frames_per_chunk = event.metadata.get("frames_per_chunk", 1)
+            else:
+                frames_per_chunk = 1
+        finally:
+            event.close_event()
+        index[key] = {
+            "size": file_stat.st_size,
+            "mtime": file_stat.st_mtime,
+            "num_frames": num_frames,
+            "frames_per_chunk": frames_per_chunk,
+        }
+        index_has_changed = True
+
+    return index_has_changed
+
+
+def _write_frame_count_index(index, index_filename):
+    # type: (Dict[str, Dict[str, Any]], str) -> None
+    # Writes the frame count index atomically, so that the index is never read while
+    # partially written.
+    try:
+        fdesc, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(index_filename))
+        )
+        with os.fdopen(fdesc, "w") as fhandle:
+            json.dump(index, fhandle)
+        os.chmod(temp_filename, 0o644)
+        os.rename(temp_filename, index_filename)
+    except (IOError, OSError) as exc:
+        print(
+            "OnDA Warning: Cannot write the {0} frame count index file: "
+            "{1}".format(index_filename, exc)
+        )
+        sys.stdout.flush()
+
+
+def _get_shard_boundaries(num_frames_in_files, frames_per_chunk_in_files, num_shards):
+    # type: (List[int], List[int], int) -> List[int]
+    # Splits all the frames in the files, taken in order, into shards of consecutive
+    # frames, and returns the positions of the shard boundaries (the first frame of
+    # each shard, followed by the total number of frames). The shards are as equal as
+    # possible, but start at chunk boundaries, so that no chunk has to be read for two
+    # shards: each shard boundary is the chunk boundary closest to the one that would
+    # split the frames equally. If the chunks are so large that more shards would be
+    # left empty than with an equal split, the frames are split equally instead,
+    # ignoring the chunks.
+    chunk_boundaries = []  # type: List[int]
+    first_frame_in_file = 0
+    for num_frames, frames_per_chunk in zip(
+        num_frames_in_files, frames_per_chunk_in_files
+    ):
+        chunk_boundaries.extend(
+            range(
+                first_frame_in_file,
+                first_frame_in_file + num_frames,
+                max(frames_per_chunk, 1),
+            )
+        )
+        first_frame_in_file += num_frames
+    total_num_frames = first_frame_in_file
+    chunk_boundaries.append(total_num_frames)
+    equal_boundaries = [
+        total_num_frames * shard_index // num_shards
+        for shard_index in range(num_shards)
+    ]
+    equal_boundaries.append(total_num_frames)
+    shard_boundaries = []  # type: List[int]
+    for equal_boundary in equal_boundaries[:-1]:
+        boundary_index = bisect.bisect_left(chunk_boundaries, equal_boundary)
+        if (
+            boundary_index > 0
+            and equal_boundary - chunk_boundaries[boundary_index - 1]
+            <= chunk_boundaries[boundary_index] - equal_boundary
+        ):
+            boundary_index -= 1
+        shard_boundaries.append(chunk_boundaries[boundary_index])
+    shard_boundaries.append(total_num_frames)
+    if _count_empty_shards(shard_boundaries) > _count_empty_shards(equal_boundaries):
+        return equal_boundaries
+
+    return shard_boundaries
+
+
+def _count_empty_shards(shard_boundaries):
+    # type: (List[int]) -> int
+    # Returns the number of shards without frames, given the shard boundaries.
+    return sum(
+        1
+        for first_frame, end_frame in zip(shard_boundaries[:-1], shard_boundaries[1:])
+        if first_frame == end_frame
+    )
+
+
+def _sharded_entries(filelist, node_rank, node_pool_size, event, index_filename):
+    # type: (List[str], int, int, data_event.DataEvent, str) -> Iterator[str]
+    # Yields the entries in the list of files that contain frames assigned to the
+    # current worker node. All the frames in the files, taken in order, are split into
+    # shards of consecutive frames, one per worker node (see the _get_shard_boundaries
+    # function). Before yielding each entry, the range of frames in the file assigned to
+    # the worker node is stored in the framework information of the event. The numbers
+    # of frames in the files are read from the index written by the master node.
+    index = _read_frame_count_index(index_filename)
+    if any(os.path.abspath(filename) not in index for filename in filelist):
+        # The master node could not write the index: the frames are counted again.
+        _update_frame_count_index(filelist=filelist, event=event, index=index)
+    entries = [index[os.path.abspath(filename)] for filename in filelist]
+    shard_boundaries = _get_shard_boundaries(
+        num_frames_in_files=[entry["num_frames"] for entry in entries],
+        frames_per_chunk_in_files=[entry["frames_per_chunk"] for entry in entries],
+        num_shards=node_pool_size - 1,
+    )
+    first_frame_curr_node = shard_boundaries[node_rank - 1]
+    last_frame_curr_node = shard_boundaries[node_rank]
+    first_frame_in_file = 0
+    for filename, entry in zip(filelist, entries):
+        last_frame_in_file = first_frame_in_file + entry["num_frames"]
+        if (
+            first_frame_in_file < last_frame_curr_node
+            and last_frame_in_file > first_frame_curr_node
+        ):
+            event.framework_info["frame_range"] = (
+                max(first_frame_curr_node, first_frame_in_file) - first_frame_in_file,
+                min(last_frame_curr_node, last_frame_in_file) - first_frame_in_file,
+            )
+            yield filename
+        first_frame_in_file = last_frame_in_file
+
+
+# Directories modified less than this number of seconds before a scan are always listed
+# again, because on some filesystems the modification times of directories have a
+# coarse granularity.
+_RECENTLY_MODIFIED_DIRECTORY_AGE = 2.0
+
+
+class _DirectoryTreeWatcher(object):
+    # Watches a directory tree for new files with one of the provided extensions, and
+    # reports them once they have been completely written. Files that are already in
+    # the tree when the watcher is created are ignored.
+    #
+    # With inotify, a file is complete as soon as it is closed after writing, or moved
+    # into the tree. When the tree is polled instead (and for the files found when
+    # scanning a newly created directory with inotify), a file is complete when it has
+    # not been modified for the settle time.
+    def __init__(
+        self,
+        directory,  # type: str
+        file_extensions,  # type: Tuple[str, ...]
+        watch_method,  # type: str
+        polling_interval,  # type: float
+        settle_time,  # type: float
+    ):
+        # type: (...) -> None
+        self._file_extensions = file_extensions
+        self._polling_interval = polling_interval
+        self._settle_time = settle_time
+        self._directory_mtimes = {}  # type: Dict[str, float]
+        self._watched_directories = {}  # type: Dict[int, str]
+        self._known_files = set()  # type: Set[str]
+        self._pending_files = set()  # type: Set[str]
+        if watch_method == "inotify":
+            self._inotify = inotify_simple.INotify()
+            self._inotify_file_flags = (
+                inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO
+            )
+        else:
+            self._inotify = None
+        self._next_scan_time = time.time() + polling_interval
+        self._scan_directory(directory=directory, files_are_new=False)
+
+    def get_completed_files(self):
+        # type: () -> List[str]
+        # Waits for at most the polling interval, then returns, sorted, the files that
+        # have been completed in the meantime.
+        completed_files = []  # type: List[str]
+        if self._inotify is not None:
+            for inotify_event in self._inotify.read(
+                timeout=int(self._polling_interval * 1000)
+            ):
+                completed_files.extend(self._handle_inotify_event(inotify_event))
+        else:
+            time.sleep(max(0.0, self._next_scan_time - time.time()))
+            self._next_scan_time = time.time() + self._polling_interval
+            self._scan_tree()
+        completed_files.extend(self._get_settled_files())
+        return sorted(completed_files)
+
+    def close(self):
+        # type: () -> None
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def _scan_tree(self):
+        # type: () -> None
+        # Only the directories that have changed since they were last listed are
+        # listed again. New subdirectories are scanned as soon as they are found.
+        for directory in list(self._directory_mtimes):
+            self._scan_directory(directory=directory, files_are_new=True)
+
+    def _scan_directory(self, directory, files_are_new):
+        # type: (str, bool) -> None
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            # The directory has been removed.
+            self._directory_mtimes.pop(directory, None)
+            return
+        if (
+            directory in self._directory_mtimes
+            and mtime == self._directory_mtimes[directory]
+            and time.time() - mtime > _RECENTLY_MODIFIED_DIRECTORY_AGE
+        ):
+            return
+        if self._inotify is not None and directory not in self._directory_mtimes:
+            # The directory is watched before being listed, so that no file completed
+            # after the listing can be missed.
+            watch_descriptor = self._inotify.add_watch(
+                directory,
+                self._inotify_file_flags
+                | inotify_simple.flags.CREATE
+                | inotify_simple.flags.ONLYDIR,
+            )
+            self._watched_directories[watch_descriptor] = directory
+        self._directory_mtimes[directory] = mtime
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            self._directory_mtimes.pop(directory, None)
+            return
+        for entry in entries:
+            path = os.path.join(directory, entry)
+            if path in self._known_files or path in self._directory_mtimes:
+                continue
+            if path.endswith(self._file_extensions):
+                self._known_files.add(path)
+                if files_are_new:
+                    self._pending_files.add(path)
+            elif os.path.isdir(path):
+                self._scan_directory(directory=path, files_are_new=files_are_new)
+
+    def _handle_inotify_event(self, inotify_event):
+        # type: (inotify_simple.Event) -> List[str]
+        if inotify_event.mask & inotify_simple.flags.Q_OVERFLOW:
+            # Some events have been lost: the files created in the meantime are found
+            # by scanning the tree, and must then settle.
+            self._scan_tree()
+            return []
+        directory = self._watched_directories.get(inotify_event.wd)
+        if directory is None:
+            return []
+        if inotify_event.mask & inotify_simple.flags.IGNORED:
+            # The directory has been removed.
+            del self._watched_directories[inotify_event.wd]
+            self._directory_mtimes.pop(directory, None)
+            return []
+        path = os.path.join(directory, inotify_event.name)
+        if inotify_event.mask & inotify_simple.flags.ISDIR:
+            if path not in self._directory_mtimes:
+                self._scan_directory(directory=path, files_are_new=True)
+            return []
+        if not (
+            inotify_event.mask & self._inotify_file_flags
+            and path.endswith(self._file_extensions)
+        ):
+            return []
+        if path in self._pending_files:
+            self._pending_files.remove(path)
+        elif path in self._known_files:
+            return []
+        else:
+            self._known_files.add(path)
+        return [path]
+
+    def _get_settled_files(self):
+        # type: () -> List[str]
+        now = time.time()
+        settled_files = []  # type: List[str]
+        for path in list(self._pending_files):
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # The file has been removed before being completed.
+                self._pending_files.remove(path)
+                continue
+            if now - mtime >= self._settle_time:
+                self._pending_files.remove(path)
+                settled_files.append(path)
+        return settled_files
+
+
+def _watched_entries(
+    directory,  # type: str
+    node_rank,  # type: int
+    node_pool_size,  # type: int
+    monitor_params,  # type: parameters.MonitorParams
+    distribute_files,  # type: bool
+):
+    # type: (...) -> Generator[str, None, None]
+    # Watches the directory tree for new files and yields the ones assigned to the
+    # current worker node (all of them, if the files are not distributed amongst the
+    # worker nodes). All the worker nodes watch the tree independently. Each file is
+    # assigned to a worker node using a hash of its path, so that the worker nodes
+    # agree on the assignment without communicating with each other.
+    watch_method = monitor_params.get_param(
+        group="DataRetrievalLayer", parameter="filesystem_watch_method", type_=str
+    )
+    if watch_method is None:
+        if inotify_simple is not None:
+            watch_method = "inotify"
+        else:
+            watch_method = "polling"
+    if watch_method not in ("inotify", "polling"):
+        raise exceptions.OndaUnsupportedWatchMethodError(
+            "Unsupported filesystem watch method: {0}.".format(watch_method)
+        )
+    if watch_method == "inotify" and inotify_simple is None:
+        raise exceptions.OndaMissingDependencyError(
+            "The inotify_simple module could not be loaded. The following dependency "
+            "does not appear to be available on the system: inotify_simple."
+        )
+    polling_interval = monitor_params.get_param(
+        group="DataRetrievalLayer",
+        parameter="filesystem_polling_interval_in_s",
+        type_=float,
+    )
+    if polling_interval is None:
+        polling_interval = 0.5
+    settle_time = monitor_params.get_param(
+        group="DataRetrievalLayer", parameter="filesystem_settle_time_in_s", type_=float
+    )
+    if settle_time is None:
+        settle_time = 1.0
+    watch_timeout = monitor_params.get_param(
+        group="DataRetrievalLayer",
+        parameter="filesystem_watch_timeout_in_s",
+        type_=float,
+    )
+
+    watcher = _DirectoryTreeWatcher(
+        directory=directory,
+        file_extensions=tuple(dynamic_import.get_file_extensions(monitor_params)),
+        watch_method=watch_method,
+        polling_interval=polling_interval,
+        settle_time=settle_time,
+    )
+    try:
+        # The timeout is measured from the last time a completed file was found in the
+        # tree, whichever worker node it is assigned to, so that all the worker nodes
+        # stop at roughly the same time.
+        last_file_time = time.time()
+        while True:
+            completed_files = watcher.get_completed_files()
+            now = time.time()
+            if completed_files:
+                last_file_time = now
+            elif watch_timeout is not None and now - last_file_time >= watch_timeout:
+                return
+            for filename in completed_files:
+                if not distribute_files:
+                    yield filename
+                    continue
+                # Unlike a CRC, an MD5 hash spreads files with consecutive names
+                # evenly amongst the worker nodes.
+                filename_hash = hashlib.md5(filename.encode("utf-8")).hexdigest()
+                if int(filename_hash[:8], 16) % (node_pool_size - 1) == node_rank - 1:
+                    yield filename
+    finally:
+        watcher.close()
+
 
 ############################
 #                          #
@@ -47,13 +589,19 @@ def initialize_event_source(source, node_pool_size, monitor_params):
     Initializes the file event source when reading files from the filesystem.
 
     This function must be called on the master node before the :func:`event_generator`
-    function is called on the worker nodes. There is no need to initialize the event
-    source when reading from files, so this function actually does nothing.
+    function is called on the worker nodes. When the frames in the listed files are
+    split into frame ranges (see the documentation of the :func:`event_generator`
+    function), this function counts the frames in each file, and stores the numbers in
+    an index file, which the worker nodes then read. Only the files that have changed
+    since the index was last written are opened. Otherwise, there is no need to
+    initialize the event source when reading from files, and this function does
+    nothing.
 
     Arguments:
 
         source (str): the relative or absolute path to a file containing a list of
-            files to process (one per line, with their full path).
+            files to process (one per line, with their full path), or to a directory
+            to watch for new files.
 
         node_pool_size (int): the total number of nodes in the OnDA pool, including all
             the worker nodes and the master node.
@@ -61,9 +609,56 @@ def initialize_event_source(source, node_pool_size, monitor_params):
         monitor_params (:class:`~onda.utils.parameters.MonitorParams`): an object
             storing the OnDA monitor parameters from the configuration file.
     """
-    del source
     del node_pool_size
+    split_files_into_frame_ranges = monitor_params.get_param(
+        group="DataRetrievalLayer",
+        parameter="filesystem_split_files_into_frame_ranges",
+        type_=bool,
+    )
+    if not split_files_into_frame_ranges or os.path.isdir(source):
+        return
+    frame_count_index_filename = _get_frame_count_index_filename(
+        source=source, monitor_params=monitor_params
+    )
+    index = _read_frame_count_index(frame_count_index_filename)
+    if _update_frame_count_index(
+        filelist=_read_file_list(source),
+        event=_create_data_event(monitor_params),
+        index=index,
+    ):
+        _write_frame_count_index(index=index, index_filename=frame_count_index_filename)
+
+
+def get_num_events(source, monitor_params):
+    # type: (str, parameters.MonitorParams) -> Optional[int]
+    """
+    Gets the number of events in the file event source.
+
+    This function can be called on the master node, after the
+    :func:`initialize_event_source` function, to retrieve the number of events that
+    the worker nodes will process with dynamic event distribution (see the
+    documentation of the :func:`event_generator` function). Each listed file is an
+    event. When watching a directory, the number of events is not known in advance.
+
+    Arguments:
+
+        source (str): the relative or absolute path to a file containing a list of
+            files to process (one per line, with their full path), or to a directory
+            to watch for new files.
+
+        monitor_params (:class:`~onda.utils.parameters.MonitorParams`): an object
+            storing the OnDA monitor parameters from the configuration file.
+
+    Returns:
+
+        Optional[int]: the number of files in the list, or None if the source is a
+        directory.
+    """
     del monitor_params
+    if os.path.isdir(source):
+        return None
+
+    return len(_read_file_list(source))
 
 
 def event_generator(
@@ -71,6 +666,7 @@ def event_generator(
     node_rank,  # type: int
     node_pool_size,  # type: int
     monitor_params,  # type: parameters.MonitorParams
+    event_indexes=None,  # type: Optional[Iterator[int]]
 ):
     # type: (...) -> Generator[data_event.DataEvent, None, None]
     """
@@ -81,10 +677,43 @@ def event_generator(
     function is a generator and it returns an iterator over the events that the calling
     worker must process.
 
+    If the 'event_indexes' argument is None, the list of files is split as equally as
+    possible amongst the worker nodes. Otherwise, the worker node only processes the
+    files whose position in the list matches one of the provided indexes.
+
+    If the source is a directory, the directory tree is instead watched for new files
+    with one of the extensions used by the detector (see the 'get_file_extensions'
+    function in the Data Retrieval Layer), and the files are processed as soon as they
+    have been completely written. Files already present in the tree when the function
+    is called are ignored. Each new file is assigned to a worker node using a hash of
+    its path. The tree is watched using inotify, if available, or by polling it. The
+    event timestamp, which is the modification time of the file, can be used to
+    measure the latency of the processing (see the 'report_latency' entry in the
+    'Crystallography' configuration parameter group).
+
+    Files storing many frames (for example, HDF5 files) can be split into frame ranges
+    instead, if the 'filesystem_split_files_into_frame_ranges' entry in the
+    'DataRetrievalLayer' configuration parameter group is True. In this case, all the
+    frames in the listed files, taken in order, are split into ranges of consecutive
+    frames, as equally as possible, one per worker node. Each range starts at a chunk
+    boundary, if the Data Retrieval Layer reports how the frames are chunked (like
+    the one for HDF5 files), so that no chunk is read by two worker nodes, unless
+    this would leave some worker nodes without frames. The number
+    of frames in each file is read from the index file written by the
+    :func:`initialize_event_source` function. Each event then corresponds to the part
+    of a file that falls within the range of the worker node, and the first and last
+    (excluded) frame of that part are stored in the 'frame_range' entry of the
+    framework information of the event. When watching a directory, the files are not
+    known in advance, and the frames in each file are instead split amongst all the
+    worker nodes: the index of the range assigned to the worker node and the number of
+    ranges are stored in the framework information of the event. The Data Retrieval
+    Layer uses this information when opening the event.
+
     Arguments:
 
         source (str): the relative or absolute path to a file containing a list of
-            files to process (one per line, with their full path).
+            files to process (one per line, with their full path), or to a directory
+            to watch for new files.
 
         node_rank (int): the rank, in the OnDA pool, of the worker node calling the
             function.
@@ -95,62 +724,71 @@ def event_generator(
         monitor_params (:class:`~onda.utils.parameters.MonitorParams`): an object
             storing the OnDA monitor parameters from the configuration file.
 
+        event_indexes (Optional[Iterator[int]]): an iterator over the indexes, in the
+            list of files, of the events that the worker node should process. The
+            indexes must be provided in increasing order. If this argument is None,
+            the worker node processes a fixed share of the files. Dynamic event
+            distribution is not supported when watching a directory or when
+            splitting files into frame ranges. Defaults to None.
+
     Yields:
 
         :class:`~onda.utils.data_event.DataEvent`: an object storing the event data.
+
+    Raises:
+
+        :class:`~onda.utils.exceptions.OndaUnsupportedEventDistributionError`: if
+            dynamic event distribution is requested when watching a directory or when
+            splitting files into frame ranges.
     """
-    data_retrieval_layer_filename = monitor_params.get_param(
-        group="Onda", parameter="data_retrieval_layer", type_=str, required=True
-    )
-    data_retrieval_layer = dynamic_import.import_data_retrieval_layer(
-        data_retrieval_layer_filename=data_retrieval_layer_filename
-    )
-    required_data = monitor_params.get_param(
-        group="Onda", parameter="required_data", type_=list, required=True
-    )
-    event_handling_functions = dynamic_import.get_event_handling_funcs(
-        data_retrieval_layer=data_retrieval_layer
-    )
-    data_extraction_functions = dynamic_import.get_data_extraction_funcs(
-        required_data=required_data, data_retrieval_layer=data_retrieval_layer
-    )
-    event = data_event.DataEvent(
-        event_handling_funcs=event_handling_functions,
-        data_extraction_funcs=data_extraction_functions,
-    )
+    event = _create_data_event(monitor_params)
 
-    # Fills the framework info with static data that will be retrieved later.
-    if "beam_energy" in data_extraction_functions:
-        event.framework_info["beam_energy"] = monitor_params.get_param(
-            group="DataRetrievalLayer",
-            parameter="fallback_beam_energy_in_eV",
-            type_=float,
-            required=True,
-        )
-    if "detector_distance" in data_extraction_functions:
-        event.framework_info["detector_distance"] = monitor_params.get_param(
-            group="DataRetrievalLayer",
-            parameter="fallback_detector_distance_in_mm",
-            type_=float,
-            required=True,
+    split_files_into_frame_ranges = monitor_params.get_param(
+        group="DataRetrievalLayer",
+        parameter="filesystem_split_files_into_frame_ranges",
+        type_=bool,
+    )
+    if split_files_into_frame_ranges and event_indexes is not None:
+        raise exceptions.OndaUnsupportedEventDistributionError(
+            "Dynamic event distribution is not supported when splitting files into "
+            "frame ranges."
         )
 
-    # Computes how many files the current worker node should process. Splits the files
-    # as equally as possible amongst the workers with the last worker getting a
-    # smaller number of files if the number of files to be processed cannot be exactly
-    # divided by the number of workers.
-    try:
-        with open(source, "r") as fhandle:
-            filelist = fhandle.readlines()
-    except (IOError, OSError) as exc:
-        raise_from(
-            exc=RuntimeError("Error reading the {0} source file.".format(source)),
-            cause=exc,
+    if os.path.isdir(source):
+        if event_indexes is not None:
+            raise exceptions.OndaUnsupportedEventDistributionError(
+                "Dynamic event distribution is not supported when watching a "
+                "directory."
+            )
+        if split_files_into_frame_ranges:
+            # The files are not known in advance: the frames in each file are split
+            # amongst all the worker nodes.
+            event.framework_info["frame_range_index"] = node_rank - 1
+            event.framework_info["num_frame_ranges"] = node_pool_size - 1
+        files_curr_node = _watched_entries(
+            directory=source,
+            node_rank=node_rank,
+            node_pool_size=node_pool_size,
+            monitor_params=monitor_params,
+            distribute_files=not split_files_into_frame_ranges,
+        )  # type: Iterator[str]
+    elif split_files_into_frame_ranges:
+        files_curr_node = _sharded_entries(
+            filelist=_read_file_list(source),
+            node_rank=node_rank,
+            node_pool_size=node_pool_size,
+            event=event,
+            index_filename=_get_frame_count_index_filename(
+                source=source, monitor_params=monitor_params
+            ),
+        )
+    else:
+        files_curr_node = _listed_entries(
+            filelist=_read_file_list(source),
+            node_rank=node_rank,
+            node_pool_size=node_pool_size,
+            event_indexes=event_indexes,
         )
-    num_files_curr_node = int(numpy.ceil(len(filelist) / float(node_pool_size - 1)))
-    files_curr_node = filelist[
-        ((node_rank - 1) * num_files_curr_node) : (node_rank * num_files_curr_node)
-    ]
 
     for entry in files_curr_node:
         stripped_entry = entry.strip()
@@ -21,7 +21,10 @@ framework at the LCLS facility.
 """
 from __future__ import absolute_import, division, print_function
 
-from typing import Generator, List  # pylint: disable=unused-import
+import hashlib
+import os
+import tempfile
+from typing import Generator, Iterator, List, Optional  # pylint: disable=unused-import
 
 import numpy
 from future.utils import iteritems, raise_from
@@ -47,21 +50,158 @@ except ImportError as exc:
 ############################
 
 
-def _psana_offline_event_generator(psana_source, node_rank, mpi_pool_size):
-    # type: (psana._DataSource, int, int) -> Generator[psana.Event, None, None]
-    # Computes how many events the current worker node should process. Splits the
-    # events as equally as possible amongst the workers. If the number of events cannot
-    # be exactly divided by the number of workers, an additional worker is assigned
-    # the residual events.
-    for run in psana_source.runs():
-        times = run.times()
-        num_events_curr_node = int(numpy.ceil(len(times) / float(mpi_pool_size - 1)))
-        events_curr_node = times[
-            (node_rank - 1) * num_events_curr_node : node_rank * num_events_curr_node
-        ]
-        for evt in events_curr_node:
+# Structure of the time index of a psana run, as cached on disk: the time of each event
+# (seconds and nanoseconds from the Epoch) and its fiducial.
+_PSANA_TIME_INDEX_DTYPE = numpy.dtype(
+    [
+        ("seconds", numpy.uint32),
+        ("nanoseconds", numpy.uint32),
+        ("fiducial", numpy.uint32),
+    ]
+)
+
+
+def _get_psana_time_index(run, psana_source_string, cache_directory):
+    # type: (psana.Run, str, Optional[str]) -> numpy.ndarray
+    # Returns the time index of a psana run. If a cache directory is provided, the
+    # index is loaded from the cache, if available. Otherwise, it is retrieved from
+    # psana, then stored in the cache.
+    if cache_directory is not None:
+        cache_filename = os.path.join(
+            cache_directory,
+            "{0}.run{1}.onda_time_index.npy".format(
+                hashlib.sha1(psana_source_string.encode("utf-8")).hexdigest()[:16],
+                run.run(),
+            ),
+        )
+        try:
+            return numpy.load(cache_filename)
+        except (IOError, OSError, ValueError):
+            pass
+
+    time_index = numpy.array(
+        [
+            (event_time.seconds(), event_time.nanoseconds(), event_time.fiducial())
+            for event_time in run.times()
+        ],
+        dtype=_PSANA_TIME_INDEX_DTYPE,
+    )
 
-            yield run.event(evt)
+    if cache_directory is not None:
+        # The cache file is written atomically, since several worker nodes might
+        # write it at the same time.
+        try:
+            fdesc, temp_filename = tempfile.mkstemp(dir=cache_directory)
+            with os.fdopen(fdesc, "wb") as fhandle:
+                numpy.save(fhandle, time_index)
+            os.chmod(temp_filename, 0o644)
+            os.rename(temp_filename, cache_filename)
+        except (IOError, OSError) as exc:
+            print(
+                "OnDA Warning: Cannot write the {0} psana time index cache file: "
+                "{1}".format(cache_filename, exc)
+            )
+
+    return time_index
+
+
+def _get_psana_events_to_process(time_index, start_timestamp):
+    # type: (numpy.ndarray, Optional[float]) -> numpy.ndarray
+    # Returns the indexes, in the time index of a run, of the events that must be
+    # processed: the events whose timestamp is not earlier than the start timestamp.
+    event_indexes = numpy.arange(len(time_index))
+    if start_timestamp is None:
+        return event_indexes
+    timestamps = time_index["seconds"] + time_index["nanoseconds"] * 1e-9
+    return event_indexes[timestamps >= start_timestamp]
+
+
+def _get_psana_event(run, time_index, event_index):
+    # type: (psana.Run, numpy.ndarray, int) -> psana.Event
+    # Retrieves from psana the event stored at the provided position in the time index.
+    seconds, nanoseconds, fiducial = time_index[event_index]
+    return run.event(
+        psana.EventTime(int((int(seconds) << 32) | int(nanoseconds)), int(fiducial))
+    )
+
+
+def _psana_offline_event_generator(
+    psana_source,  # type: psana._DataSource
+    psana_source_string,  # type: str
+    node_rank,  # type: int
+    mpi_pool_size,  # type: int
+    block_size,  # type: Optional[int]
+    start_timestamp,  # type: Optional[float]
+    cache_directory,  # type: Optional[str]
+):
+    # type: (...) -> Generator[psana.Event, None, None]
+    # Splits the events in each run amongst the worker nodes. If the block size is None,
+    # each worker node processes a contiguous range of events, and the numbers of
+    # events processed by any two worker nodes differ at most by one. Otherwise, the
+    # events are split into blocks of consecutive events, which are assigned to the
+    # worker nodes in turn, so that all the worker nodes progress through the run at
+    # the same pace.
+    num_worker_nodes = mpi_pool_size - 1
+    for run in psana_source.runs():
+        time_index = _get_psana_time_index(
+            run=run,
+            psana_source_string=psana_source_string,
+            cache_directory=cache_directory,
+        )
+        events_to_process = _get_psana_events_to_process(
+            time_index=time_index, start_timestamp=start_timestamp
+        )
+        if block_size is None:
+            events_curr_node = events_to_process[
+                (len(events_to_process) * (node_rank - 1) // num_worker_nodes) : (
+                    len(events_to_process) * node_rank // num_worker_nodes
+                )
+            ]
+        else:
+            block_indexes = numpy.arange(len(events_to_process)) // block_size
+            events_curr_node = events_to_process[
+                block_indexes % num_worker_nodes == node_rank - 1
+            ]
+        for event_index in events_curr_node:
+            yield _get_psana_event(
+                run=run, time_index=time_index, event_index=event_index
+            )
+
+
+def _psana_offline_dynamic_event_generator(
+    psana_source,  # type: psana._DataSource
+    psana_source_string,  # type: str
+    event_indexes,  # type: Iterator[int]
+    start_timestamp,  # type: Optional[float]
+    cache_directory,  # type: Optional[str]
+):
+    # type: (...) -> Generator[psana.Event, None, None]
+    # Retrieves the events whose indexes are provided by the 'event_indexes' iterator.
+    # The indexes run over the events to process in all the runs in the source, one
+    # run after the other, and must be provided in increasing order.
+    event_index = next(event_indexes, None)
+    run_offset = 0
+    for run in psana_source.runs():
+        time_index = _get_psana_time_index(
+            run=run,
+            psana_source_string=psana_source_string,
+            cache_directory=cache_directory,
+        )
+        events_to_process = _get_psana_events_to_process(
+            time_index=time_index, start_timestamp=start_timestamp
+        )
+        while event_index is not None and event_index - run_offset < len(
+            events_to_process
+        ):
+            yield _get_psana_event(
+                run=run,
+                time_index=time_index,
+                event_index=events_to_process[event_index - run_offset],
+            )
+            event_index = next(event_indexes, None)
+        if event_index is None:
+            return
+        run_offset += len(events_to_process)
 
 
 def initialize_event_source(source, node_pool_size, monitor_params):
@@ -88,11 +228,66 @@ def initialize_event_source(source, node_pool_size, monitor_params):
     del monitor_params
 
 
+def get_num_events(source, monitor_params):
+    # type: (str, parameters.MonitorParams) -> Optional[int]
+    """
+    Gets the number of events in the psana event source at LCLS.
+
+    This function can be called on the master node, after the
+    :func:`initialize_event_source` function, to retrieve the number of events that
+    the worker nodes will process with dynamic event distribution (see the
+    documentation of the :func:`event_generator` function). When reading offline
+    data, the events to process in all the runs are counted, using the time index of
+    each run (which is cached, if the 'psana_time_index_cache_directory' entry in the
+    'DataRetrievalLayer' configuration parameter group is set). When reading data
+    from shared memory, the number of events is not known in advance.
+
+    Arguments:
+
+        source (str): a psana-style DataSource string.
+
+        monitor_params (:class:`~onda.utils.parameters.MonitorParams`): an object
+            storing the OnDA monitor parameters from the configuration file.
+
+    Returns:
+
+        Optional[int]: the number of events to process, or None when reading data
+        from shared memory.
+    """
+    if "shmem" in source:
+        return None
+    if not source[-4:] == ":idx":
+        source += ":idx"
+    start_timestamp = monitor_params.get_param(
+        group="DataRetrievalLayer", parameter="psana_start_timestamp", type_=float
+    )
+    time_index_cache_directory = monitor_params.get_param(
+        group="DataRetrievalLayer",
+        parameter="psana_time_index_cache_directory",
+        type_=str,
+    )
+    num_events = 0
+    for run in psana.DataSource(source.encode("ascii")).runs():
+        time_index = _get_psana_time_index(
+            run=run,
+            psana_source_string=source,
+            cache_directory=time_index_cache_directory,
+        )
+        num_events += len(
+            _get_psana_events_to_process(
+                time_index=time_index, start_timestamp=start_timestamp
+            )
+        )
+
+    return num_events
+
+
 def event_generator(
     source,  # type: str
     node_rank,  # type: int
     node_pool_size,  # type: int
     monitor_params,  # type: parameters.MonitorParams
+    event_indexes=None,  # type: Optional[Iterator[int]]
 ):
     # type: (...) -> Generator[data_event.DataEvent, None, None]
     """
@@ -103,6 +298,27 @@ def event_generator(
     The function is a generator and it returns an iterator over the events that the
     calling worker must process.
 
+    When reading offline data, if the 'event_indexes' argument is None, the events in
+    each run are split as equally as possible amongst the worker nodes. Each worker
+    node processes a contiguous range of events or, if the
+    'psana_offline_event_block_size' entry in the 'DataRetrievalLayer' configuration
+    parameter group is set, blocks of consecutive events assigned to the worker nodes
+    in turn. Otherwise, the worker node only processes the events whose indexes are
+    provided by the argument. The 'event_indexes' argument is ignored when reading data
+    from shared memory.
+
+    When reading offline data, the time index of each run (the list of its events) can
+    be cached on disk, so that it is not retrieved again from psana when the same run is
+    processed later. Additionally, the events whose timestamp is earlier than the one
+    in the 'psana_start_timestamp' entry of the 'DataRetrievalLayer' configuration
+    parameter group are skipped. This only selects the part of the run to process:
+    OnDA does not record which events have been processed, and the worker nodes
+    always work on different parts of a run at the same time (contiguous ranges of
+    events, blocks of events up to (number of worker nodes - 1) * block size events
+    apart, or batches of events assigned dynamically). No single timestamp therefore
+    marks the point where an interrupted processing stopped, and starting from the
+    timestamp of the last reported event can skip events or process them again.
+
     Arguments:
 
         source (str): a psana-style DataSource string.
@@ -116,6 +332,12 @@ def event_generator(
         monitor_params (:class:`~onda.utils.parameters.MonitorParams`): an object
             storing the OnDA monitor parameters from the configuration file.
 
+        event_indexes (Optional[Iterator[int]]): an iterator over the indexes of the
+            events that the worker node should process. The indexes run over the events
+            to process in all the runs in the data source, and must be provided in
+            increasing order. If this argument is None, the worker node processes a
+            fixed share of the events in each run. Defaults to None.
+
     Yields:
 
         :class:`~onda.utils.data_event.DataEvent`: an object storing the event data.
@@ -171,9 +393,42 @@ def event_generator(
         ] = func(monitor_params)
 
     # Initializes the psana event source and starts retrieving events.
-    if offline:
+    # Parameters used when reading offline data.
+    block_size = monitor_params.get_param(
+        group="DataRetrievalLayer",
+        parameter="psana_offline_event_block_size",
+        type_=int,
+    )
+    if block_size is not None and block_size <= 0:
+        raise exceptions.OndaInvalidParameterValueError(
+            "The psana_offline_event_block_size parameter must be a positive "
+            "integer, but it is {0}.".format(block_size)
+        )
+    start_timestamp = monitor_params.get_param(
+        group="DataRetrievalLayer", parameter="psana_start_timestamp", type_=float
+    )
+    time_index_cache_directory = monitor_params.get_param(
+        group="DataRetrievalLayer",
+        parameter="psana_time_index_cache_directory",
+        type_=str,
+    )
+    if offline and event_indexes is not None:
+        psana_events = _psana_offline_dynamic_event_generator(
+            psana_source=psana_source,
+            psana_source_string=source,
+            event_indexes=event_indexes,
+            start_timestamp=start_timestamp,
+            cache_directory=time_index_cache_directory,
+        )
+    elif offline:
         psana_events = _psana_offline_event_generator(
-            psana_source=psana_source, node_rank=node_rank, mpi_pool_size=node_pool_size
+            psana_source=psana_source,
+            psana_source_string=source,
+            node_rank=node_rank,
+            mpi_pool_size=node_pool_size,
+            block_size=block_size,
+            start_timestamp=start_timestamp,
+            cache_directory=time_index_cache_directory,
         )
     else:
         psana_events = psana_source.events()
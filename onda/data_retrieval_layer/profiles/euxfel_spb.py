@@ -24,7 +24,9 @@ from ..data_sources.agipd_1m_karabo import (  # pylint: disable=unused-import
     # Event handling functions.
     get_num_frames_in_event,
     # Data extraction functions.
+    detector_cell,
     detector_data,
+    detector_gain,
 )
 
 from ..frameworks.karabo_euxfel import (  # pylint: disable=unused-import
@@ -0,0 +1,46 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Data retrieval from HDF5 files storing stacks of detector frames.
+
+This profile does not provide peakfinder8 information, which depends on the detector
+that wrote the files.
+"""
+from __future__ import absolute_import, division, print_function
+
+from ..data_sources.hdf5_files import (  # pylint: disable=unused-import
+    # Utility functions.
+    get_file_extensions,
+    # Event handling functions.
+    close_event,
+    get_num_frames_in_event,
+    open_event,
+    # Data extraction functions.
+    detector_data,
+    event_id,
+    frame_id,
+)
+
+from ..frameworks.files_filesystem import (  # pylint: disable=unused-import
+    # Event handling functions.
+    event_generator,
+    get_num_events,
+    initialize_event_source,
+    # Data extraction functions.
+    beam_energy,
+    detector_distance,
+    timestamp,
+)
@@ -35,6 +35,7 @@ from ..data_sources.pilatus_files import (  # pylint: disable=unused-import
 from ..frameworks.files_filesystem import (  # pylint: disable=unused-import
     # Event handling functions.
     event_generator,
+    get_num_events,
     initialize_event_source,
     # Data extraction functions.
     beam_energy,
@@ -29,6 +29,7 @@ from ..frameworks.psana_lcls import (  # pylint: disable=unused-import
     # Event handling function.
     close_event,
     event_generator,
+    get_num_events,
     get_num_frames_in_event,
     initialize_event_source,
     open_event,
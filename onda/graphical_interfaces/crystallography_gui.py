@@ -244,21 +244,19 @@ class CrystallographyGui(gui.OndaGui):
         ]
         for text_item in self._resolution_rings_textitems:
             self._image_view.getView().addItem(text_item)
+        beam_energy = self._local_data.columns["beam_energy"][-1]
+        detector_distance = self._local_data.columns["detector_distance"][-1]
         try:
-            lambda_ = (
-                constants.h
-                * constants.c
-                / (self._local_data[-1][b"beam_energy"] * constants.e)
-            )
+            # Missing beam energy and detector distance values are broadcasted as NaN.
+            if numpy.isnan(beam_energy) or numpy.isnan(detector_distance):
+                raise TypeError
+            lambda_ = constants.h * constants.c / (beam_energy * constants.e)
             resolution_rings_in_pix = [1.0]
             resolution_rings_in_pix.extend(
                 [
                     2.0
                     * self._res
-                    * (
-                        self._local_data[-1][b"detector_distance"] * 1e-3
-                        + self._coffset
-                    )
+                    * (detector_distance * 1e-3 + self._coffset)
                     * numpy.tan(
                         2.0 * numpy.arcsin(lambda_ / (2.0 * resolution * 1e-10))
                     )
@@ -313,8 +311,7 @@ class CrystallographyGui(gui.OndaGui):
             return
 
         QtGui.QApplication.processEvents()
-        last_frame = self._local_data[-1]
-        if last_frame[b"geometry_is_optimized"]:
+        if self._local_data.metadata["geometry_is_optimized"]:
             if not self._resolution_rings_check_box.isEnabled():
                 self._resolution_rings_check_box.setEnabled(True)
                 self._resolution_rings_lineedit.setEnabled(True)
@@ -325,21 +322,24 @@ class CrystallographyGui(gui.OndaGui):
                 self._resolution_rings_lineedit.setEnabled(False)
             self._update_resolution_rings()
         QtGui.QApplication.processEvents()
-        for frame in self._local_data:
-            for peak_fs, peak_ss, peak_value in zip(
-                frame[b"peak_list"][b"fs"],
-                frame[b"peak_list"][b"ss"],
-                frame[b"peak_list"][b"intensity"],
-            ):
-                peak_index_in_slab = int(round(peak_ss)) * frame[b"native_data_shape"][
-                    1
-                ] + int(round(peak_fs))
-                self._img_virt_powder_plot[
-                    self._visual_pixel_map_y[peak_index_in_slab],
-                    self._visual_pixel_map_x[peak_index_in_slab],
-                ] += peak_value
-            self._hit_rate_history.append(frame[b"hit_rate"])
-            self._saturation_rate_history.append(frame[b"saturation_rate"])
+        # The data is received in columnar format: the peaks from all the events in
+        # the batch are added to the virtual powder plot in one go.
+        columns = self._local_data.columns
+        peak_ss = numpy.round(columns["peak_ss"]).astype(numpy.intp)
+        peak_fs = numpy.round(columns["peak_fs"]).astype(numpy.intp)
+        peak_index_in_slab = (
+            peak_ss * self._local_data.metadata["native_data_shape"][1] + peak_fs
+        )
+        numpy.add.at(
+            self._img_virt_powder_plot,
+            (
+                self._visual_pixel_map_y[peak_index_in_slab],
+                self._visual_pixel_map_x[peak_index_in_slab],
+            ),
+            columns["peak_intensity"],
+        )
+        self._hit_rate_history.extend(columns["hit_rate"])
+        self._saturation_rate_history.extend(columns["saturation_rate"])
         QtGui.QApplication.processEvents()
         self._hit_rate_plot.setData(self._hit_rate_history)
         self._saturation_rate_plot.setData(self._saturation_rate_history)
@@ -350,7 +350,7 @@ class CrystallographyGui(gui.OndaGui):
             autoRange=False,
         )
         # Resets local_data so that the same data is not processed multiple times.
-        self._local_data = []
+        self._local_data = None
 
 
 @click.command()
@@ -51,7 +51,8 @@ def main(source, config, debug):
     OnDA monitor. This script starts a monitor that runs according to the provided
     configuration file and retrieves data from the specified source. When the 'mpi'
     Parallelization Layer is used, this script should be launched via the 'mpirun' or
-    'mpiexec' commands.
+    'mpiexec' commands. When the 'multiproc' Parallelization Layer is used, this script
+    should be launched directly.
 
     SOURCE: the source of data for the OnDA monitor. The exact format of this string
     depends on the specific Data Extraction Layer currently used (see documentation).
@@ -65,7 +66,18 @@ def main(source, config, debug):
         group="Onda", parameter="processing_layer", type_=str, required=True
     )
     processing_layer = dynamic_import.import_processing_layer(processing_layer_filename)
-    monitor = processing_layer.OndaMonitor(
-        source=source, monitor_parameters=monitor_parameters
+    parallelization_layer_filename = monitor_parameters.get_param(
+        group="Onda", parameter="parallelization_layer", type_=str
     )
+    if parallelization_layer_filename is not None:
+        parallelization_layer = dynamic_import.import_parallelization_layer(
+            parallelization_layer_filename
+        )
+    else:
+        parallelization_layer = None
+    monitor_class = dynamic_import.get_monitor_class(
+        monitor_class=processing_layer.OndaMonitor,
+        parallelization_layer=parallelization_layer,
+    )
+    monitor = monitor_class(source=source, monitor_parameters=monitor_parameters)
     monitor.start()
@@ -0,0 +1,209 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Base class for OnDA parallelization engines.
+
+This module contains the functionality shared by all the parallelization engines of
+OnDA, regardless of how the nodes communicate with each other.
+"""
+from __future__ import absolute_import, division, print_function
+
+import abc
+import sys
+import time
+from typing import Any, Dict, Iterable, Tuple  # pylint: disable=unused-import
+
+import numpy
+from future.utils import iteritems, with_metaclass
+
+from onda.utils import named_tuples, timing
+
+
+class ParallelizationEngineBase(with_metaclass(abc.ABCMeta, object)):
+    """
+    Base class for OnDA parallelization engines.
+
+    This class implements the parts of a master-worker parallelization engine that do
+    not depend on how the nodes communicate with each other: the batching of the
+    processed data on the worker nodes, the periodic reporting of the stage timing
+    histograms, and the end-of-processing report on the master node.
+
+    NOTE: This is an abstract class, and it is not meant to be used directly. Each
+    parallelization engine derives from it, and implements the
+    '_send_stage_timing_report' and '_get_shed_data_counters_by_node' functions.
+    """
+
+    def _report_stage_timings(self, force=False):
+        # type: (bool) -> None
+        # Sends the timing histograms accumulated by the worker node to the master
+        # node, and resets them, if the reporting interval has elapsed (or if forced).
+        if not self.stage_timer.enabled:
+            return
+        if (
+            not force
+            and time.time() - self._last_stage_timing_report_time
+            < self._stage_timing_report_interval
+        ):
+            return
+        report = self.stage_timer.pop_report()
+        if self._prefetch_stage_timer is not None:
+            # The frame data is retrieved by a background thread, which uses its own
+            # timer.
+            report = timing.merge_stage_timing_reports(
+                [report, self._prefetch_stage_timer.pop_report()]
+            )
+        self._send_stage_timing_report(report=report, force=force)
+        self._last_stage_timing_report_time = time.time()
+
+    @abc.abstractmethod
+    def _send_stage_timing_report(self, report, force):
+        # type: (Dict[str, Dict[str, Any]], bool) -> None
+        # Sends a timing report to the master node. When forced, the function returns
+        # only once the report has been sent.
+        pass
+
+    def _processed_data_batch_is_ready(self):
+        # type: () -> bool
+        # Checks if the batch of processed data accumulated on a worker node is ready to
+        # be sent to the master node.
+        if len(self._processed_data_batch) >= self._processed_data_batch_size:
+            return True
+        if self._processed_data_batch_max_delay is not None and (
+            time.time() - self._processed_data_batch_start_time
+            >= self._processed_data_batch_max_delay
+        ):
+            return True
+
+        return False
+
+    @abc.abstractmethod
+    def _get_shed_data_counters_by_node(self):
+        # type: () -> Iterable[Tuple[int, int]]
+        # Returns, for each worker node, the number of payloads dropped and the number
+        # of frames skipped so far, as known by the master node.
+        pass
+
+    def get_shed_data_counters(self):
+        # type: () -> Dict[str, int]
+        """
+        Gets the amount of data shed by the worker nodes.
+
+        This function can only be called on the master node. It returns the latest
+        counters known for the worker nodes, summed over all of them. The counters are
+        only updated while the worker nodes are shedding load (see the documentation of
+        the '__init__' function of the parallelization engine).
+
+        Returns:
+
+            Dict[str, int]: a dictionary with two entries: 'dropped_payloads' (the
+            number of frames sent without their numpy arrays) and 'skipped_frames'
+            (the number of frames that have been skipped or whose processed data has
+            been dropped completely).
+        """
+        shed_data_counters = list(self._get_shed_data_counters_by_node())
+
+        return {
+            "dropped_payloads": sum(counters[0] for counters in shed_data_counters),
+            "skipped_frames": sum(counters[1] for counters in shed_data_counters),
+        }
+
+    def get_stage_timing_reports(self):
+        # type: () -> Dict[int, Dict[str, Dict[str, Any]]]
+        """
+        Gets the timing histograms of the processing stages on the worker nodes.
+
+        This function can only be called on the master node. It returns the latest
+        histograms received from each worker node (see the documentation of the
+        '__init__' function of the parallelization engine). The histograms only cover
+        the reporting interval that preceded their transfer.
+
+        Returns:
+
+            Dict[int, Dict[str, Dict[str, Any]]]: a dictionary whose keys are the
+            ranks of the worker nodes, and whose values are the timing reports of
+            the nodes, in the format returned by the
+            :func:`~onda.utils.timing.StageTimer.pop_report` function.
+        """
+        return self._stage_timing_reports
+
+    def end_processing(self):
+        # type () -> None
+        """
+        Executes end-of-processing actions.
+
+        This function is called by the parallelization engine on the master node at the
+        end of the processing, immediately before stopping. By default, it prints a
+        message to the console and exits. It can be overridden in a derived class to
+        implement custom end-of-processing actions.
+        """
+        print(
+            "Processing finished. OnDA has processed {0} events in total.".format(
+                self._num_collected_events
+            )
+        )
+        shed_data_counters = self.get_shed_data_counters()
+        if any(shed_data_counters.values()):
+            print(
+                "Because of backpressure, {0} frame payloads have been dropped and "
+                "{1} frames have been skipped.".format(
+                    shed_data_counters["dropped_payloads"],
+                    shed_data_counters["skipped_frames"],
+                )
+            )
+        sys.stdout.flush()
+
+
+def drop_payloads(processed_data):
+    # type: (Any) -> Tuple[Any, int]
+    """
+    Removes the numpy arrays from processed data.
+
+    This function is used by the parallelization engines to shed load when the master
+    node is falling behind.
+
+    Arguments:
+
+        processed_data (Any): a single
+            :class:`~onda.utils.named_tuples.ProcessedData` named tuple, or a list of
+            them.
+
+    Returns:
+
+        Tuple[Any, int]: a tuple whose first entry is the stripped data (in the same
+        format as the input data), and whose second entry is the number of entries from
+        which at least one array has been removed.
+    """
+    if isinstance(processed_data, list):
+        processed_data_batch = processed_data
+    else:
+        processed_data_batch = [processed_data]
+    num_dropped_payloads = 0
+    stripped_batch = []
+    for entry in processed_data_batch:
+        data = {
+            key: value
+            for key, value in iteritems(entry.data)
+            if not isinstance(value, numpy.ndarray)
+        }
+        if len(data) < len(entry.data):
+            num_dropped_payloads += 1
+        stripped_batch.append(
+            named_tuples.ProcessedData(data=data, worker_rank=entry.worker_rank)
+        )
+    if isinstance(processed_data, list):
+        return stripped_batch, num_dropped_payloads
+
+    return stripped_batch[0], num_dropped_payloads
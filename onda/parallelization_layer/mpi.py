@@ -21,17 +21,39 @@ master/worker architecture.
 """
 from __future__ import absolute_import, division, print_function
 
+import collections
 import json
 import sys
-from typing import Any, Dict, Callable, Optional, Tuple  # pylint: disable=unused-import
+import time
+from typing import (  # pylint: disable=unused-import
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import mpi4py
+import numpy
+from future.utils import iteritems, raise_from
 
-from mpi4py import MPI
+# MPI is initialized when the parallelization engine is created, and not when this
+# module is imported, so that importing an OnDA monitor does not require MPI.
+mpi4py.rc.initialize = False
+mpi4py.rc.finalize = True
+from mpi4py import MPI  # pylint: disable=wrong-import-position
 
+from onda.parallelization_layer import base
 from onda.utils import (  # pylint: disable=unused-import
     dynamic_import,
     exceptions,
     named_tuples,
     parameters,
+    prefetch,
+    timing,
 )
 
 
@@ -39,9 +61,20 @@ from onda.utils import (  # pylint: disable=unused-import
 _NOMORE = 998
 _DIETAG = 999
 _DEADTAG = 1000
+_EVENTREQTAG = 1001
+_EVENTBATCHTAG = 1002
+_ARRAYTAG = 1003
+_ACKTAG = 1004
+_SHEDTAG = 1005
+_TIMINGTAG = 1006
+
 
+# Placeholder that replaces a numpy array in the data sent from a worker node to the
+# master node, when the array itself is transferred separately as a raw buffer.
+_ArrayInfo = collections.namedtuple("_ArrayInfo", ["shape", "dtype"])
 
-class ParallelizationEngine(object):
+
+class ParallelizationEngine(base.ParallelizationEngineBase):
     """
     See documentation of the __init__ function.
     """
@@ -52,6 +85,8 @@ class ParallelizationEngine(object):
         collect_func,  # type: Callable[[named_tuples.ProcessedData], None]
         source,  # type: str
         monitor_params,  # type:  parameters.MonitorParams
+        collect_batch_func=None,  # type: Optional[Callable[[List[Any]], None]]
+        aggregate_func=None,  # type: Optional[Callable[[List[Any]], List[Any]]]
     ):
         # type (...) -> None
         """
@@ -74,6 +109,74 @@ class ParallelizationEngine(object):
         * When all events from the source have been processed, the engine performs
           some final clean-up tasks and shuts down.
 
+        By default, each worker node retrieves a fixed share of the events from the
+        source, as decided by the Data Retrieval Layer. If the
+        'dynamic_event_distribution' entry in the 'Onda' configuration parameter group
+        is true, the worker nodes instead request batches of event indexes from the
+        master node every time they run out of events to process. The size of each
+        batch is determined by the 'dynamic_event_distribution_batch_size' entry in
+        the same parameter group. This is only supported by Data Retrieval Layers whose
+        'event_generator' function accepts an 'event_indexes' argument.
+
+        If the 'buffer_based_array_transfer' entry in the 'Onda' configuration
+        parameter group is true, the numpy arrays stored in the 'data' field of the
+        'ProcessedData' named tuple are not serialized together with the rest of the
+        data. They are instead transferred as raw memory buffers, and received on the
+        master node into pre-allocated arrays. These arrays are reused every time new
+        data is received: the 'collect_func' function should copy them if it needs to
+        keep them beyond its own execution.
+
+        If the 'processed_data_batch_size' entry in the 'Onda' configuration parameter
+        group is set, each worker node accumulates the 'ProcessedData' named tuples
+        returned by the 'process_func' function, and transfers them to the master node
+        in batches. A batch is transferred when it contains the specified number of
+        entries, or when its oldest entry has been waiting for longer than the number
+        of milliseconds specified by the 'processed_data_batch_max_delay_in_ms' entry
+        in the same parameter group. On the master node, the 'collect_func' function is
+        called on each entry of the batch, unless the 'collect_batch_func' function is
+        provided. In that case, the 'collect_batch_func' function is called once on
+        the whole batch instead.
+
+        If the 'num_aggregator_nodes' entry in the 'Onda' configuration parameter group
+        is set, the engine additionally starts the specified number of aggregator
+        nodes, which sit between the worker nodes and the master node. The worker nodes
+        are split into groups, and each group sends its processed data to one of the
+        aggregator nodes instead of the master node. Each aggregator node accumulates
+        the data received from its group, calls the 'aggregate_func' function on it,
+        and sends the result to the master node in a single transfer. The aggregator
+        node sends the accumulated data as soon as no more data is waiting to be
+        received, or when the number of accumulated entries reaches the value of the
+        'processed_data_batch_size' entry in the 'Onda' parameter group (by default,
+        the number of worker nodes in the group). The aggregator nodes do not
+        retrieve or process any event.
+
+        If the 'backpressure_max_in_flight_messages' entry in the 'Onda' configuration
+        parameter group is set, the engine keeps track of how many messages sent by
+        each worker node have not been collected yet. When this number reaches the
+        specified value, the worker node assumes that the master node is falling
+        behind, and starts shedding load, according to the 'backpressure_mode' entry
+        in the same parameter group:
+
+        * 'drop_payloads': the worker node sends the processed data without the numpy
+          arrays stored in the 'data' field of the 'ProcessedData' named tuple (for
+          example, detector frames).
+
+        * 'skip_frames': the worker node skips frames without processing them.
+
+        In both modes, the processed data is dropped completely when the number of
+        messages waiting to be collected reaches twice the specified value. The number
+        of dropped payloads and skipped frames is periodically reported to the master
+        node, and can be retrieved using the :func:`get_shed_data_counters` function.
+
+        If the 'stage_timing_report_interval_in_s' entry in the 'Onda' configuration
+        parameter group is set, each worker node measures the time spent opening and
+        closing events, extracting each type of data, processing the data and sending
+        it to the master node. The 'process_func' function can time additional stages
+        using the 'stage_timer' attribute. The measurements are accumulated into
+        histograms, which are sent to the master node at the specified interval (in
+        seconds), and then reset. The latest histograms received from each worker node
+        can be retrieved using the :func:`get_stage_timing_reports` function.
+
         NOTE: This class is designed to be subclassed to create an OnDA monitor.
 
         Arguments:
@@ -96,24 +199,74 @@ class ParallelizationEngine(object):
             monitor_params (:class:`~onda.utils.parameters.MonitorParams`): an object
                 storing the OnDA monitor parameters from the configuration file.
 
+            collect_batch_func (Optional[Callable[[List[\
+                :class:`~onda.utils.named_tuples.ProcessedData`]], None]]): the
+                function that will run on the master node every time a batch of
+                'ProcessedData' named tuples is transferred from a worker node. If
+                this argument is None, the 'collect_func' function is called
+                separately on each entry of the batch. Defaults to None.
+
+            aggregate_func (Optional[Callable[[List[\
+                :class:`~onda.utils.named_tuples.ProcessedData`]], List[\
+                :class:`~onda.utils.named_tuples.ProcessedData`]]]): the function that
+                will run on the aggregator nodes every time a batch of accumulated
+                'ProcessedData' named tuples must be sent to the master node. The
+                function receives the accumulated batch and must return the list of
+                'ProcessedData' named tuples that will be actually transferred (for
+                example, a condensed version of the batch). If this argument is None,
+                the accumulated batch is transferred unchanged. Defaults to None.
+
         Attributes:
 
-            role (str): the role of the current node ('worker' or 'master').
+            role (str): the role of the current node ('worker', 'aggregator' or
+                'master').
 
             rank (int): the rank (in MPI terms) of the current node.
+
+            stage_timer (:class:`~onda.utils.timing.StageTimer`): the timer used to
+                measure the duration of the processing stages on the current node. The
+                timer is disabled if the 'stage_timing_report_interval_in_s' entry in
+                the 'Onda' configuration parameter group is not set.
         """
         self._map = process_func
         self._reduce = collect_func
+        self._reduce_batch = collect_batch_func
+        self._aggregate = aggregate_func
         self._source = source
         self._monitor_params = monitor_params
 
+        # When the frame data is prefetched in a background thread, MPI is
+        # initialized with support for multiple threads.
+        self._num_prefetched_frames = monitor_params.get_param(
+            group="Onda", parameter="num_prefetched_frames", type_=int
+        )
+        if not MPI.Is_initialized():
+            if self._num_prefetched_frames:
+                MPI.Init_thread(MPI.THREAD_MULTIPLE)
+            else:
+                MPI.Init()
         self._mpi_size = MPI.COMM_WORLD.Get_size()
         self.rank = MPI.COMM_WORLD.Get_rank()
+        num_aggregator_nodes = monitor_params.get_param(
+            group="Onda", parameter="num_aggregator_nodes", type_=int
+        )
+        if num_aggregator_nodes is None:
+            self._num_aggregator_nodes = 0
+        else:
+            self._num_aggregator_nodes = num_aggregator_nodes
         if self.rank == 0:
             self.role = "master"
+        elif self.rank <= self._num_aggregator_nodes:
+            self.role = "aggregator"
         else:
             self.role = "worker"
 
+        # The aggregator nodes do not retrieve events, so they are excluded from the
+        # node pool seen by the Data Retrieval Layer. In the Data Retrieval Layer, the
+        # worker nodes have ranks that go from 1 to the size of the pool minus 1,
+        # regardless of the number of aggregator nodes.
+        self._event_source_pool_size = self._mpi_size - self._num_aggregator_nodes
+
         data_retrieval_layer_filename = monitor_params.get_param(
             group="Onda", parameter="data_retrieval_layer", type_=str, required=True
         )
@@ -123,8 +276,56 @@ class ParallelizationEngine(object):
         event_handling_functions = dynamic_import.get_event_handling_funcs(
             data_retrieval_layer=data_retrieval_layer
         )
+        dynamic_event_distribution = monitor_params.get_param(
+            group="Onda", parameter="dynamic_event_distribution", type_=bool
+        )
+        if dynamic_event_distribution is None:
+            self._dynamic_event_distribution = False
+        else:
+            self._dynamic_event_distribution = dynamic_event_distribution
+        buffer_based_array_transfer = monitor_params.get_param(
+            group="Onda", parameter="buffer_based_array_transfer", type_=bool
+        )
+        if buffer_based_array_transfer is None:
+            self._buffer_based_array_transfer = False
+        else:
+            self._buffer_based_array_transfer = buffer_based_array_transfer
+        self._max_in_flight_messages = monitor_params.get_param(
+            group="Onda", parameter="backpressure_max_in_flight_messages", type_=int
+        )
+        self._ack_reqs = []  # type: List[MPI.Request]
+        self._stage_timing_report_interval = monitor_params.get_param(
+            group="Onda", parameter="stage_timing_report_interval_in_s", type_=float
+        )
+        self.stage_timer = timing.StageTimer(
+            enabled=self._stage_timing_report_interval is not None
+        )
+        # Timer used by the thread that prefetches the frame data, if any.
+        self._prefetch_stage_timer = None  # type: Optional[timing.StageTimer]
+
+        if self.role in ("worker", "aggregator"):
+            self._processed_data_batch_size = monitor_params.get_param(
+                group="Onda", parameter="processed_data_batch_size", type_=int
+            )
+            processed_data_batch_max_delay = monitor_params.get_param(
+                group="Onda",
+                parameter="processed_data_batch_max_delay_in_ms",
+                type_=float,
+            )
+            if processed_data_batch_max_delay is not None:
+                self._processed_data_batch_max_delay = (
+                    processed_data_batch_max_delay / 1000.0
+                )
+            else:
+                self._processed_data_batch_max_delay = None
+            self._processed_data_batch = []  # type: List[named_tuples.ProcessedData]
+            self._processed_data_batch_start_time = 0.0
 
         if self.role == "worker":
+            if self._num_aggregator_nodes > 0:
+                self._collector_rank = self._get_aggregator_rank(self.rank)
+            else:
+                self._collector_rank = 0
             self._event_generator = event_handling_functions["event_generator"]
             self._num_frames_in_event_to_process = monitor_params.get_param(
                 group="DataRetrievalLayer",
@@ -140,13 +341,81 @@ class ParallelizationEngine(object):
                 self._frames_in_event_to_skip = tuple(frames_in_event_to_skip)
             else:
                 self._frames_in_event_to_skip = tuple()
+            if (
+                self._num_prefetched_frames
+                and self._dynamic_event_distribution
+                and MPI.Query_thread() != MPI.THREAD_MULTIPLE
+            ):
+                # With dynamic event distribution, the event indexes are requested
+                # from the master node by the prefetching thread, while the main
+                # thread communicates with the master node too.
+                raise exceptions.OndaUnsupportedEventDistributionError(
+                    "Dynamic event distribution with prefetching requires an MPI "
+                    "library with full thread support."
+                )
+            self._backpressure_mode = monitor_params.get_param(
+                group="Onda", parameter="backpressure_mode", type_=str
+            )
+            if self._backpressure_mode is None:
+                self._backpressure_mode = "drop_payloads"
+            if self._backpressure_mode not in ("drop_payloads", "skip_frames"):
+                raise RuntimeError(
+                    "Unrecognized backpressure mode: {0}.".format(
+                        self._backpressure_mode
+                    )
+                )
+            self._num_sent_messages = 0
+            self._num_acknowledged_messages = 0
+            self._num_dropped_payloads = 0
+            self._num_skipped_frames = 0
+            self._last_shed_data_report = (0, 0)
+            self._last_shed_data_report_time = 0.0
+            self._shed_data_report_req = None  # type: Optional[MPI.Request]
+            self._last_stage_timing_report_time = time.time()
+            self._stage_timing_report_req = None  # type: Optional[MPI.Request]
+
+        if self.role == "aggregator":
+            self._collector_rank = 0
+            self._aggregated_worker_ranks = [
+                node_rank
+                for node_rank in range(self._num_aggregator_nodes + 1, self._mpi_size)
+                if self._get_aggregator_rank(node_rank) == self.rank
+            ]
+            if self._processed_data_batch_size is None:
+                self._processed_data_batch_size = max(
+                    len(self._aggregated_worker_ranks), 1
+                )
+            self._num_nomore = 0
+            self._finished_worker_ranks = []  # type: List[int]
+            self._array_receive_buffers = {}
+            self._unacknowledged_message_sources = []  # type: List[int]
 
         if self.role == "master":
             self._initialize_event_source = event_handling_functions[
                 "initialize_event_source"
             ]
+            self._get_num_events = event_handling_functions["get_num_events"]
             self._num_nomore = 0
             self._num_collected_events = 0
+            self._array_receive_buffers = {}
+            self._shed_data_counters = {}  # type: Dict[int, Tuple[int, int]]
+            self._stage_timing_reports = {}  # type: Dict[int, Dict[str, Any]]
+            # Nodes that have finished processing data, or that have shut down. They do
+            # not need to confirm a shutdown of the engine.
+            self._stopped_node_ranks = set()  # type: Set[int]
+            if self._dynamic_event_distribution:
+                self._event_batch_size = monitor_params.get_param(
+                    group="Onda",
+                    parameter="dynamic_event_distribution_batch_size",
+                    type_=int,
+                )
+                if self._event_batch_size is None:
+                    self._event_batch_size = 1
+                self._next_event_index = 0
+                # The number of events to distribute is retrieved after the event
+                # source has been initialized, if the Data Retrieval Layer can provide
+                # it. If it is None, the number of events is not known.
+                self._num_events_to_distribute = None  # type: Optional[int]
 
     def start(self):
         # type () -> None
@@ -156,61 +425,163 @@ class ParallelizationEngine(object):
         * When this function is called on a worker node, the node starts retrieving data
           events and processing them.
 
+        * When this function is called on an aggregator node, the node starts receiving
+          data from its group of worker nodes and forwarding it to the master node.
+
         * When this function is called on the master node, the node starts receiving
           data from the worker nodes and aggregating it.
         """
+        if self.role != "master":
+            # Waits until the master node has initialized the event source.
+            MPI.COMM_WORLD.Barrier()
+
         if self.role == "worker":
-            # Flag used to make sure that the MPI messages have been processed.
-            req = None
-            events = self._event_generator(
-                source=self._source,
-                node_rank=self.rank,
-                node_pool_size=self._mpi_size,
-                monitor_params=self._monitor_params,
+            # List used to make sure that the MPI messages have been processed.
+            reqs = []  # type: List[MPI.Request]
+            if self._dynamic_event_distribution:
+                try:
+                    events = self._event_generator(
+                        source=self._source,
+                        node_rank=self.rank - self._num_aggregator_nodes,
+                        node_pool_size=self._event_source_pool_size,
+                        monitor_params=self._monitor_params,
+                        event_indexes=self._event_index_generator(),
+                    )
+                except TypeError as exc:
+                    raise_from(
+                        exc=exceptions.OndaUnsupportedEventDistributionError(
+                            "The Data Retrieval Layer does not support dynamic event "
+                            "distribution."
+                        ),
+                        cause=exc,
+                    )
+            else:
+                events = self._event_generator(
+                    source=self._source,
+                    node_rank=self.rank - self._num_aggregator_nodes,
+                    node_pool_size=self._event_source_pool_size,
+                    monitor_params=self._monitor_params,
+                )
+
+            if self._num_prefetched_frames:
+                # The frame data is retrieved in a background thread, which cannot
+                # share the timer of the worker node.
+                self._prefetch_stage_timer = timing.StageTimer(
+                    enabled=self.stage_timer.enabled
+                )
+                frame_data_stage_timer = self._prefetch_stage_timer
+            else:
+                frame_data_stage_timer = self.stage_timer
+            frame_data = prefetch.generate_frame_data(
+                events=events,
+                num_frames_in_event_to_process=self._num_frames_in_event_to_process,
+                frames_in_event_to_skip=self._frames_in_event_to_skip,
+                stage_timer=frame_data_stage_timer,
+                frame_must_be_skipped=(
+                    None if self._num_prefetched_frames else self._frame_must_be_skipped
+                ),
             )
+            if self._num_prefetched_frames:
+                # The data is retrieved in the background. Frames are then skipped
+                # because of backpressure only after they have been retrieved.
+                frame_data = prefetch.FramePrefetcher(
+                    frame_data=frame_data,
+                    max_num_prefetched_frames=self._num_prefetched_frames,
+                    stage_timer=self.stage_timer,
+                )
 
-            for event in events:
+            for data in frame_data:
                 # Listens for requests to shut down.
                 if MPI.COMM_WORLD.Iprobe(source=0, tag=_DIETAG):
                     self.shutdown("Shutting down RANK: {0}.".format(self.rank))
-                event.open_event()
-                n_frames_in_evt = event.get_num_frames_in_event()
-                if self._num_frames_in_event_to_process is not None:
-                    num_frames_to_process = min(
-                        n_frames_in_evt, self._num_frames_in_event_to_process
-                    )
-                else:
-                    num_frames_to_process = n_frames_in_evt
-                # Iterates over the last 'num_frames_to_process' frames in the event.
-                for frame_offset in range(-num_frames_to_process, 0):
-                    current_frame = n_frames_in_evt + frame_offset
-                    if current_frame in self._frames_in_event_to_skip:
-                        continue
-                    event.current_frame = current_frame
-                    try:
-                        data = event.extract_data()
-                    except exceptions.OndaDataExtractionError as exc:
-                        print(exc)
-                        print("Skipping event...")
-                        continue
+                if self._num_prefetched_frames and self._frame_must_be_skipped():
+                    continue
+                with self.stage_timer.stage("processing"):
                     result = self._map(data)
-                    if req:
-                        req.Wait()
-                    req = MPI.COMM_WORLD.isend(result, dest=0, tag=0)
-                # Makes sure that the last MPI message has processed.
-                if req:
-                    req.Wait()
-                event.close_event()
+                if self._processed_data_batch_size is None:
+                    with self.stage_timer.stage("send"):
+                        reqs = self._complete_send_requests(reqs)
+                        reqs.extend(self._shed_and_send_processed_data(result))
+                    self._report_stage_timings()
+                    continue
+                if not self._processed_data_batch:
+                    self._processed_data_batch_start_time = time.time()
+                self._processed_data_batch.append(result)
+                if self._processed_data_batch_is_ready():
+                    with self.stage_timer.stage("send"):
+                        reqs = self._complete_send_requests(reqs)
+                        reqs.extend(
+                            self._shed_and_send_processed_data(
+                                self._processed_data_batch
+                            )
+                        )
+                    self._processed_data_batch = []
+                self._report_stage_timings()
+
+            # Sends to the master node any processed data left in the batch.
+            if self._processed_data_batch:
+                reqs.extend(
+                    self._shed_and_send_processed_data(self._processed_data_batch)
+                )
+                self._processed_data_batch = []
+            MPI.Request.Waitall(reqs)
+            self._report_shed_data(force=True)
+            self._report_stage_timings(force=True)
 
             # After finishing iterating over the events to process, sends a message to
             # the master node saying that there are no more events.
             end_dict = {"end": True}
-            req = MPI.COMM_WORLD.isend((end_dict, self.rank), dest=0, tag=0)
+            req = MPI.COMM_WORLD.isend(
+                (end_dict, self.rank), dest=self._collector_rank, tag=0
+            )
             if req:
                 req.Wait()
             MPI.Finalize()
             exit(0)
 
+        if self.role == "aggregator":
+            status = MPI.Status()
+            while self._num_nomore < len(self._aggregated_worker_ranks):
+                received_data = MPI.COMM_WORLD.recv(
+                    source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status
+                )
+                if status.Get_tag() == _DIETAG:
+                    self.shutdown("Shutting down RANK: {0}.".format(self.rank))
+                if status.Get_tag() != 0:
+                    _report_unexpected_message(
+                        tag=status.Get_tag(), node_rank=status.Get_source()
+                    )
+                    continue
+                if isinstance(received_data, list):
+                    self._accumulate_processed_data_batch(
+                        processed_data_batch=received_data,
+                        node_rank=status.Get_source(),
+                    )
+                elif "end" in received_data[0].keys():
+                    self._num_nomore += 1
+                    self._finished_worker_ranks.append(status.Get_source())
+                else:
+                    self._accumulate_processed_data_batch(
+                        processed_data_batch=[received_data],
+                        node_rank=status.Get_source(),
+                    )
+                # Forwards the accumulated data when the batch is full, or when no
+                # more data is immediately available.
+                if self._processed_data_batch and (
+                    self._processed_data_batch_is_ready()
+                    or not MPI.COMM_WORLD.Iprobe(source=MPI.ANY_SOURCE, tag=0)
+                ):
+                    self._forward_processed_data_batch()
+
+            # When all the worker nodes in the group have finished, sends a message to
+            # the master node saying that there are no more events.
+            if self._processed_data_batch:
+                self._forward_processed_data_batch()
+            end_dict = {"end": True}
+            MPI.COMM_WORLD.send((end_dict, self.rank), dest=0, tag=0)
+            MPI.Finalize()
+            exit(0)
+
         if self.role == "master":
             print("Starting OnDA with the following parameters:")
             print(
@@ -222,23 +593,89 @@ class ParallelizationEngine(object):
                 "You are using an OnDA real-time monitor. Please cite: "
                 "Mariani et al., J Appl Crystallogr. 2016 May 23;49(Pt 3):1073-1080"
             )
-            _ = self._initialize_event_source(  # pylint: disable=unused-variable
-                source=self._source,
-                node_pool_size=self._mpi_size,
-                monitor_params=self._monitor_params,
-            )
+            try:
+                _ = self._initialize_event_source(  # pylint: disable=unused-variable
+                    source=self._source,
+                    node_pool_size=self._event_source_pool_size,
+                    monitor_params=self._monitor_params,
+                )
+                if (
+                    self._dynamic_event_distribution
+                    and self._get_num_events is not None
+                ):
+                    self._num_events_to_distribute = self._get_num_events(
+                        source=self._source, monitor_params=self._monitor_params
+                    )
+            except Exception:  # pylint: disable=broad-except
+                # The other nodes are waiting for the event source to be initialized.
+                # In case of error, reports it, then crashes hard!
+                try:
+                    sys.excepthook(*sys.exc_info())
+                finally:
+                    MPI.COMM_WORLD.Abort(0)
+            MPI.COMM_WORLD.Barrier()
+            if self._num_aggregator_nodes > 0:
+                num_data_sending_nodes = self._num_aggregator_nodes
+            else:
+                num_data_sending_nodes = self._mpi_size - 1
+            status = MPI.Status()
             while True:
                 try:
-                    received_data = MPI.COMM_WORLD.recv(source=MPI.ANY_SOURCE, tag=0)
+                    received_data = MPI.COMM_WORLD.recv(
+                        source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status
+                    )
+                    if status.Get_tag() == _EVENTREQTAG:
+                        # If the received message is a request for events to process,
+                        # sends the next batch of event indexes to the worker node.
+                        self._send_event_index_batch(node_rank=status.Get_source())
+                        continue
+                    if status.Get_tag() == _SHEDTAG:
+                        # If the received message reports how much data a worker
+                        # node has shed, stores the counters.
+                        self._shed_data_counters[status.Get_source()] = received_data
+                        continue
+                    if status.Get_tag() == _TIMINGTAG:
+                        # If the received message contains the timing histograms of
+                        # a worker node, stores them.
+                        if received_data:
+                            self._stage_timing_reports[
+                                status.Get_source()
+                            ] = received_data
+                        continue
+                    if status.Get_tag() == _DEADTAG:
+                        # If the received message announces that a node has shut down
+                        # on its own (for example, because of an error), shuts down the
+                        # other nodes too. The node has already confirmed its shutdown.
+                        self._add_stopped_node_ranks(
+                            node_rank=status.Get_source(),
+                            finished_worker_ranks=received_data,
+                        )
+                        self.shutdown(
+                            "RANK {0} has shut down.".format(status.Get_source())
+                        )
+                    if status.Get_tag() != 0:
+                        _report_unexpected_message(
+                            tag=status.Get_tag(), node_rank=status.Get_source()
+                        )
+                        continue
+                    if isinstance(received_data, list):
+                        # If the received message is a batch of processed data,
+                        # collects all the entries in the batch.
+                        self._collect_processed_data_batch(
+                            processed_data_batch=received_data,
+                            node_rank=status.Get_source(),
+                        )
+                        continue
                     if "end" in received_data[0].keys():
-                        # If the received message announces that a worker node has
-                        # finished processing data, keeps track of how many worker
-                        # nodes have already finished.
+                        # If the received message announces that a worker node (or an
+                        # aggregator node) has finished processing data, keeps track of
+                        # how many nodes have already finished.
                         print("Finalizing {0}".format(received_data[1]))
                         self._num_nomore += 1
+                        self._add_stopped_node_ranks(node_rank=status.Get_source())
                         # When all workers have finished, calls the 'end_processing'
                         # function then shuts down.
-                        if self._num_nomore == self._mpi_size - 1:
+                        if self._num_nomore == num_data_sending_nodes:
                             print("All workers have run out of events.")
                             print("Shutting down.")
                             sys.stdout.flush()
@@ -247,8 +684,10 @@ class ParallelizationEngine(object):
                             exit(0)
                         else:
                             continue
-                    self._reduce(received_data)
-                    self._num_collected_events += 1
+                    self._collect_processed_data_batch(
+                        processed_data_batch=[received_data],
+                        node_rank=status.Get_source(),
+                    )
                 except KeyboardInterrupt as exc:
                     print("Recieved keyboard sigterm...")
                     print(str(exc))
@@ -263,12 +702,14 @@ class ParallelizationEngine(object):
         """
         Shuts down the parallelization engine.
 
-        * When this function is called on a worker node, the worker communicates to the
-          master node that it is shutting down, then shuts down.
+        * When this function is called on a worker node (or on an aggregator node), the
+          node communicates to the master node that it is shutting down, then shuts
+          down.
 
         * When this function is called on the master node, the master tells each worker
           to shut down, waits for all the workers to confirm that they done that, then
-          shuts down.
+          shuts down. The nodes that have already finished processing data, or that
+          have shut down on their own, are not waited for.
 
         Arguments:
 
@@ -278,7 +719,13 @@ class ParallelizationEngine(object):
         print("Shutting down:", msg)
         sys.stdout.flush()
         if self.role == "worker":
-            _ = MPI.COMM_WORLD.send(dest=0, tag=_DEADTAG)
+            MPI.COMM_WORLD.send([], dest=0, tag=_DEADTAG)
+            MPI.Finalize()
+            exit(0)
+        if self.role == "aggregator":
+            # The worker nodes in the group that have already finished processing data
+            # cannot confirm the shutdown themselves.
+            MPI.COMM_WORLD.send(self._finished_worker_ranks, dest=0, tag=_DEADTAG)
             MPI.Finalize()
             exit(0)
         if self.role == "master":
@@ -287,15 +734,64 @@ class ParallelizationEngine(object):
             # messages from the nodes (MPI cannot shut down if there are unreceived
             # messages).
             try:
-                for nod_num in range(1, self._mpi_size()):
-                    MPI.COMM_WORLD.isend(0, dest=nod_num, tag=_DIETAG)
-                num_shutdown_confirm = 0
+                for nod_num in range(1, self._mpi_size):
+                    if nod_num not in self._stopped_node_ranks:
+                        MPI.COMM_WORLD.isend(0, dest=nod_num, tag=_DIETAG)
+                status = MPI.Status()
                 while True:
-                    if MPI.COMM_WORLD.Iprobe(source=MPI.ANY_SOURCE, tag=0):
-                        _ = MPI.COMM_WORLD.recv(source=MPI.ANY_SOURCE, tag=0)
-                    if MPI.COMM_WORLD.Iprobe(source=MPI.ANY_SOURCE, tag=_DEADTAG):
-                        num_shutdown_confirm += 1
-                    if num_shutdown_confirm == self._mpi_size() - 1:
+                    if MPI.COMM_WORLD.Iprobe(
+                        source=MPI.ANY_SOURCE, tag=0, status=status
+                    ):
+                        received_data = MPI.COMM_WORLD.recv(
+                            source=status.Get_source(), tag=0
+                        )
+                        # The nodes that finish processing data in the meantime do
+                        # not confirm the shutdown.
+                        if (
+                            not isinstance(received_data, list)
+                            and "end" in received_data[0].keys()
+                        ):
+                            self._add_stopped_node_ranks(node_rank=status.Get_source())
+                    if MPI.COMM_WORLD.Iprobe(source=MPI.ANY_SOURCE, tag=_SHEDTAG):
+                        _ = MPI.COMM_WORLD.recv(source=MPI.ANY_SOURCE, tag=_SHEDTAG)
+                    if MPI.COMM_WORLD.Iprobe(source=MPI.ANY_SOURCE, tag=_TIMINGTAG):
+                        _ = MPI.COMM_WORLD.recv(source=MPI.ANY_SOURCE, tag=_TIMINGTAG)
+                    if MPI.COMM_WORLD.Iprobe(
+                        source=MPI.ANY_SOURCE, tag=_ARRAYTAG, status=status
+                    ):
+                        MPI.COMM_WORLD.Recv(
+                            [bytearray(status.Get_count(MPI.BYTE)), MPI.BYTE],
+                            source=status.Get_source(),
+                            tag=_ARRAYTAG,
+                        )
+                    if MPI.COMM_WORLD.Iprobe(
+                        source=MPI.ANY_SOURCE, tag=_EVENTREQTAG, status=status
+                    ):
+                        # Workers waiting for events are told that there are no
+                        # more events to process. They then finish processing data
+                        # instead of confirming the shutdown.
+                        _ = MPI.COMM_WORLD.recv(
+                            source=status.Get_source(), tag=_EVENTREQTAG
+                        )
+                        MPI.COMM_WORLD.send(
+                            None, dest=status.Get_source(), tag=_EVENTBATCHTAG
+                        )
+                        self._add_stopped_node_ranks(
+                            node_rank=status.Get_source(), finished_worker_ranks=[]
+                        )
+                    if MPI.COMM_WORLD.Iprobe(
+                        source=MPI.ANY_SOURCE, tag=_DEADTAG, status=status
+                    ):
+                        # Each confirmation is received, so that it is counted only
+                        # once.
+                        finished_worker_ranks = MPI.COMM_WORLD.recv(
+                            source=status.Get_source(), tag=_DEADTAG
+                        )
+                        self._add_stopped_node_ranks(
+                            node_rank=status.Get_source(),
+                            finished_worker_ranks=finished_worker_ranks,
+                        )
+                    if len(self._stopped_node_ranks) == self._mpi_size - 1:
                         break
                 # When all the worker nodes have confirmed, shuts down the master.
                 MPI.Finalize()
@@ -305,19 +801,327 @@ class ParallelizationEngine(object):
                 MPI.COMM_WORLD.Abort(0)
                 exit(0)
 
-    def end_processing(self):
-        # type () -> None
-        """
-        Executes end-of-processing actions.
+    def _add_stopped_node_ranks(self, node_rank, finished_worker_ranks=None):
+        # type: (int, Optional[List[int]]) -> None
+        # Records on the master node that a node has finished processing data or has
+        # shut down, together with the worker nodes that it reports as finished. If no
+        # list of worker nodes is provided, an aggregator node has finished processing
+        # data, and so have all the worker nodes in its group.
+        self._stopped_node_ranks.add(node_rank)
+        if finished_worker_ranks:
+            self._stopped_node_ranks.update(finished_worker_ranks)
+        if node_rank <= self._num_aggregator_nodes and finished_worker_ranks is None:
+            self._stopped_node_ranks.update(
+                worker_rank
+                for worker_rank in range(self._num_aggregator_nodes + 1, self._mpi_size)
+                if self._get_aggregator_rank(worker_rank) == node_rank
+            )
 
-        This function is called by the parallelization engine on the master node at the
-        end of the processing, immediately before stopping. By default, it prints a
-        message to the console and exits. It can be overridden in a derived class to
-        implement custom end-of-processing actions.
-        """
-        print(
-            "Processing finished. OnDA has processed {0} events in total.".format(
-                self._num_collected_events
+    def _send_stage_timing_report(self, report, force):
+        # type: (Dict[str, Dict[str, Any]], bool) -> None
+        # Sends a timing report to the master node. Unless forced, does not wait for
+        # the transfer to complete.
+        if self._stage_timing_report_req is not None:
+            self._stage_timing_report_req.Wait()
+        self._stage_timing_report_req = MPI.COMM_WORLD.isend(
+            report, dest=0, tag=_TIMINGTAG
+        )
+        if force:
+            self._stage_timing_report_req.Wait()
+            self._stage_timing_report_req = None
+
+    def _send_processed_data(self, processed_data):
+        # type: (Any) -> List[MPI.Request]
+        # Sends the processed data (a single 'ProcessedData' named tuple or a list of
+        # them) to the master node, and returns the MPI requests that must be completed
+        # before the data can be safely modified. When raw buffers are used to
+        # transfer numpy arrays, each array is replaced by a placeholder in the
+        # serialized data, and then sent separately. The arrays are sent entry by entry
+        # and, within each entry, in alphabetical order of their dictionary keys, so
+        # that the master node can receive them in the same order.
+        if not self._buffer_based_array_transfer:
+            return [
+                MPI.COMM_WORLD.isend(processed_data, dest=self._collector_rank, tag=0)
+            ]
+
+        if isinstance(processed_data, list):
+            processed_data_batch = processed_data
+        else:
+            processed_data_batch = [processed_data]
+        arrays = []
+        serialized_batch = []
+        for entry in processed_data_batch:
+            entry_arrays = []
+            data = {}
+            for key, value in iteritems(entry.data):
+                if isinstance(value, numpy.ndarray):
+                    array = numpy.ascontiguousarray(value)
+                    entry_arrays.append((key, array))
+                    data[key] = _ArrayInfo(shape=array.shape, dtype=array.dtype.str)
+                else:
+                    data[key] = value
+            arrays.extend(
+                array for _, array in sorted(entry_arrays, key=lambda x: x[0])
+            )
+            serialized_batch.append(
+                named_tuples.ProcessedData(data=data, worker_rank=entry.worker_rank)
             )
+        if isinstance(processed_data, list):
+            message = serialized_batch
+        else:
+            message = serialized_batch[0]
+        reqs = [MPI.COMM_WORLD.isend(message, dest=self._collector_rank, tag=0)]
+        for array in arrays:
+            reqs.append(
+                MPI.COMM_WORLD.Isend(
+                    [array, MPI.BYTE], dest=self._collector_rank, tag=_ARRAYTAG
+                )
+            )
+
+        return reqs
+
+    def _collect_processed_data_batch(self, processed_data_batch, node_rank):
+        # type: (List[named_tuples.ProcessedData], int) -> None
+        # Receives the arrays transferred as raw buffers, if needed, then calls the
+        # collecting function(s) on a batch of processed data.
+        for batch_index, processed_data in enumerate(processed_data_batch):
+            if self._buffer_based_array_transfer:
+                self._receive_arrays(
+                    processed_data=processed_data,
+                    node_rank=node_rank,
+                    batch_index=batch_index,
+                )
+            if self._reduce_batch is None:
+                self._reduce(processed_data)
+        if self._reduce_batch is not None:
+            self._reduce_batch(processed_data_batch)
+        self._num_collected_events += len(processed_data_batch)
+        if self._max_in_flight_messages is not None and self._num_aggregator_nodes == 0:
+            self._acknowledge_messages(node_rank=node_rank, num_messages=1)
+
+    def _accumulate_processed_data_batch(self, processed_data_batch, node_rank):
+        # type: (List[named_tuples.ProcessedData], int) -> None
+        # Receives the arrays transferred as raw buffers, if needed, then adds a batch
+        # of processed data received from a worker node to the data accumulated on an
+        # aggregator node. The receiving arrays are indexed by the position of the
+        # entries in the accumulated data, so that they are not overwritten before the
+        # data is forwarded to the master node.
+        if not self._processed_data_batch:
+            self._processed_data_batch_start_time = time.time()
+        self._unacknowledged_message_sources.append(node_rank)
+        for processed_data in processed_data_batch:
+            if self._buffer_based_array_transfer:
+                self._receive_arrays(
+                    processed_data=processed_data,
+                    node_rank=node_rank,
+                    batch_index=len(self._processed_data_batch),
+                )
+            self._processed_data_batch.append(processed_data)
+
+    def _forward_processed_data_batch(self):
+        # type: () -> None
+        # Sends the data accumulated on an aggregator node to the master node, after
+        # calling the aggregating function on it. Waits for the transfer to complete,
+        # since the receiving arrays will be reused for the next batch.
+        if self._aggregate is not None:
+            processed_data_batch = self._aggregate(self._processed_data_batch)
+        else:
+            processed_data_batch = self._processed_data_batch
+        reqs = self._send_processed_data(processed_data_batch)
+        MPI.Request.Waitall(reqs)
+        self._processed_data_batch = []
+        if self._max_in_flight_messages is not None:
+            for node_rank, num_messages in iteritems(
+                collections.Counter(self._unacknowledged_message_sources)
+            ):
+                self._acknowledge_messages(
+                    node_rank=node_rank, num_messages=num_messages
+                )
+        self._unacknowledged_message_sources = []
+
+    def _complete_send_requests(self, reqs):
+        # type: (List[MPI.Request]) -> List[MPI.Request]
+        # Waits for the previous transfers from a worker node to complete, and returns
+        # the requests that are still pending. When load shedding is enabled, the
+        # worker node does not wait: it just forgets the requests that have already
+        # been completed, since the number of pending transfers is anyway limited.
+        if self._max_in_flight_messages is None:
+            MPI.Request.Waitall(reqs)
+            return []
+
+        return [req for req in reqs if not req.Test()]
+
+    def _acknowledge_messages(self, node_rank, num_messages):
+        # type: (int, int) -> None
+        # Tells a worker node that some of the messages it sent have been collected.
+        # The requests for the acknowledgement messages are completed in the
+        # background.
+        self._ack_reqs.append(
+            MPI.COMM_WORLD.isend(num_messages, dest=node_rank, tag=_ACKTAG)
         )
-        sys.stdout.flush()
+        if MPI.Request.Testall(self._ack_reqs):
+            self._ack_reqs = []
+
+    def _get_num_in_flight_messages(self):
+        # type: () -> int
+        # Receives all the pending acknowledgement messages, then returns how many
+        # messages sent by the worker node have not been collected yet.
+        while MPI.COMM_WORLD.Iprobe(source=self._collector_rank, tag=_ACKTAG):
+            self._num_acknowledged_messages += MPI.COMM_WORLD.recv(
+                source=self._collector_rank, tag=_ACKTAG
+            )
+
+        return self._num_sent_messages - self._num_acknowledged_messages
+
+    def _frame_must_be_skipped(self):
+        # type: () -> bool
+        # Checks if a frame must be skipped, without being processed, because the
+        # master node is falling behind.
+        if (
+            self._max_in_flight_messages is None
+            or self._backpressure_mode != "skip_frames"
+            or self._get_num_in_flight_messages() < self._max_in_flight_messages
+        ):
+            return False
+        self._num_skipped_frames += 1
+        self._report_shed_data()
+
+        return True
+
+    def _shed_and_send_processed_data(self, processed_data):
+        # type: (Any) -> List[MPI.Request]
+        # Sends the processed data to the master node, after shedding part or all of
+        # it if the master node is falling behind. Returns the MPI requests that must
+        # be completed before the data can be safely modified.
+        if self._max_in_flight_messages is None:
+            return self._send_processed_data(processed_data)
+        if isinstance(processed_data, list):
+            num_entries = len(processed_data)
+        else:
+            num_entries = 1
+        num_in_flight_messages = self._get_num_in_flight_messages()
+        if num_in_flight_messages >= 2 * self._max_in_flight_messages:
+            self._num_skipped_frames += num_entries
+            self._report_shed_data()
+            return []
+        if (
+            num_in_flight_messages >= self._max_in_flight_messages
+            and self._backpressure_mode == "drop_payloads"
+        ):
+            processed_data, num_dropped_payloads = base.drop_payloads(processed_data)
+            self._num_dropped_payloads += num_dropped_payloads
+            self._report_shed_data()
+        self._num_sent_messages += 1
+
+        return self._send_processed_data(processed_data)
+
+    def _report_shed_data(self, force=False):
+        # type: (bool) -> None
+        # Sends to the master node the number of payloads dropped and frames skipped so
+        # far by the worker node, if they have changed. Unless forced, the report is
+        # sent at most once per second.
+        report = (self._num_dropped_payloads, self._num_skipped_frames)
+        if report == self._last_shed_data_report:
+            return
+        if not force and time.time() - self._last_shed_data_report_time < 1.0:
+            return
+        if self._shed_data_report_req is not None:
+            self._shed_data_report_req.Wait()
+        self._shed_data_report_req = MPI.COMM_WORLD.isend(report, dest=0, tag=_SHEDTAG)
+        self._last_shed_data_report = report
+        self._last_shed_data_report_time = time.time()
+        if force:
+            self._shed_data_report_req.Wait()
+            self._shed_data_report_req = None
+
+    def _get_aggregator_rank(self, node_rank):
+        # type: (int) -> int
+        # Returns the rank of the aggregator node that collects the data processed by
+        # a worker node. The worker nodes are assigned to the aggregator nodes in a
+        # round-robin fashion.
+        return (node_rank - self._num_aggregator_nodes - 1) % (
+            self._num_aggregator_nodes
+        ) + 1
+
+    def _receive_arrays(self, processed_data, node_rank, batch_index):
+        # type: (named_tuples.ProcessedData, int, int) -> None
+        # Receives the raw buffers sent by a worker node after the serialized data, and
+        # puts the arrays back in place of their placeholders. One receiving array is
+        # allocated for each combination of position in the batch, dictionary key,
+        # shape and type, and reused for all subsequent transfers.
+        placeholders = sorted(
+            (key, value)
+            for key, value in iteritems(processed_data.data)
+            if isinstance(value, _ArrayInfo)
+        )
+        for key, array_info in placeholders:
+            buffer_id = (batch_index, key, array_info.shape, array_info.dtype)
+            if buffer_id not in self._array_receive_buffers:
+                self._array_receive_buffers[buffer_id] = numpy.empty(
+                    shape=array_info.shape, dtype=numpy.dtype(array_info.dtype)
+                )
+            receive_buffer = self._array_receive_buffers[buffer_id]
+            MPI.COMM_WORLD.Recv(
+                [receive_buffer, MPI.BYTE], source=node_rank, tag=_ARRAYTAG
+            )
+            processed_data.data[key] = receive_buffer
+
+    def _event_index_generator(self):
+        # type: () -> Generator[int, None, None]
+        # Requests batches of event indexes from the master node and yields them one by
+        # one. The generator stops after the last batch of events, if the master node
+        # knows the number of events in the source, or when the master node replies
+        # that there are no more events to process (for example, during shutdown).
+        # Otherwise, the Data Retrieval Layer stops consuming the indexes when they
+        # point beyond the end of its list of events.
+        while True:
+            MPI.COMM_WORLD.send(self.rank, dest=0, tag=_EVENTREQTAG)
+            event_index_batch = MPI.COMM_WORLD.recv(source=0, tag=_EVENTBATCHTAG)
+            if event_index_batch is None:
+                return
+            first_event_index, last_event_index, is_last_batch = event_index_batch
+            for event_index in range(first_event_index, last_event_index):
+                yield event_index
+            if is_last_batch:
+                return
+
+    def _send_event_index_batch(self, node_rank):
+        # type: (int) -> None
+        # Sends the next batch of event indexes to a worker node, as a (first, last,
+        # is_last_batch) tuple. If the number of events in the source is known, the
+        # batch that reaches the end of the events is truncated and marked as the last
+        # one, so that the worker node that receives it stops without asking again,
+        # and None is sent to the worker nodes that ask after that. Otherwise, the
+        # master node just hands out consecutive batches, and the Data Retrieval Layer
+        # stops on the first index past the end of its events.
+        first_event_index = self._next_event_index
+        last_event_index = first_event_index + self._event_batch_size
+        is_last_batch = False
+        if self._num_events_to_distribute is not None:
+            if first_event_index >= self._num_events_to_distribute:
+                MPI.COMM_WORLD.send(None, dest=node_rank, tag=_EVENTBATCHTAG)
+                return
+            if last_event_index >= self._num_events_to_distribute:
+                last_event_index = self._num_events_to_distribute
+                is_last_batch = True
+        self._next_event_index = last_event_index
+        MPI.COMM_WORLD.send(
+            (first_event_index, last_event_index, is_last_batch),
+            dest=node_rank,
+            tag=_EVENTBATCHTAG,
+        )
+
+    def _get_shed_data_counters_by_node(self):
+        # type: () -> List[Tuple[int, int]]
+        # Returns the latest counters reported by each worker node.
+        return list(self._shed_data_counters.values())
+
+
+def _report_unexpected_message(tag, node_rank):
+    # type: (int, int) -> None
+    # Warns that a message with an unexpected tag has been received and ignored.
+    print(
+        "OnDA Warning: Ignoring a message with unexpected tag {0} received from RANK "
+        "{1}.".format(tag, node_rank)
+    )
+    sys.stdout.flush()
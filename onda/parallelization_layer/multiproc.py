@@ -0,0 +1,818 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Multiprocessing-based parallelization engine for OnDA.
+
+This module contains a parallelization engine for OnDA based on python's
+multiprocessing module. The engine follows the same master/worker architecture as the
+MPI-based engine, but runs on a single machine and does not require MPI.
+"""
+from __future__ import absolute_import, division, print_function
+
+import collections
+import ctypes
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from typing import (  # pylint: disable=unused-import
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import numpy
+from future.moves import queue
+from future.utils import iteritems, raise_from
+
+from onda.parallelization_layer import base
+from onda.utils import (  # pylint: disable=unused-import
+    dynamic_import,
+    exceptions,
+    named_tuples,
+    parameters,
+    prefetch,
+    timing,
+)
+
+
+# Define some labels for internal communication (just some syntactic sugar).
+_NOMORE = 998
+_DEADTAG = 1000
+_TIMINGTAG = 1006
+
+
+# Placeholder that replaces a numpy array in the data sent from a worker node to the
+# master node, when the array itself is stored in the shared memory ring buffer. The
+# offset is measured from the start of the worker node's ring buffer.
+_ArrayInfo = collections.namedtuple("_ArrayInfo", ["shape", "dtype", "offset"])
+
+
+# Alignment (in bytes) of the arrays stored in the shared memory ring buffers.
+_ARRAY_ALIGNMENT = 64
+
+
+# Interval (in seconds) between consecutive checks, on the master node, that the
+# worker nodes are still running.
+_WORKER_NODE_CHECK_INTERVAL = 1.0
+
+
+class ParallelizationEngine(base.ParallelizationEngineBase):
+    """
+    See documentation of the __init__ function.
+    """
+
+    def __init__(
+        self,
+        process_func,  # type: Callable[[Dict[str, Any]], named_tuples.ProcessedData]
+        collect_func,  # type: Callable[[named_tuples.ProcessedData], None]
+        source,  # type: str
+        monitor_params,  # type:  parameters.MonitorParams
+        collect_batch_func=None,  # type: Optional[Callable[[List[Any]], None]]
+        aggregate_func=None,  # type: Optional[Callable[[List[Any]], List[Any]]]
+    ):
+        # type (...) -> None
+        """
+        A multiprocessing-based master-worker parallelization engine for OnDA.
+
+        This engine starts several processing worker nodes and an aggregating master
+        node, all running as separate processes on the same machine. The engine
+        operates according to the same rules as the MPI-based engine (see
+        :class:`onda.parallelization_layer.mpi.ParallelizationEngine`), and it can
+        be used as a drop-in replacement for it on single-machine deployments.
+
+        The worker nodes are started when the engine is created, by forking the
+        current process. From that moment on, each node (including the master node)
+        continues its own initialization independently, exactly as if it had been
+        started by MPI. The number of worker nodes is determined by the
+        'num_worker_nodes' entry in the 'Onda' configuration parameter group. By
+        default, one worker node is started for each available CPU core, minus one.
+        Forking is only available on POSIX systems.
+
+        The numpy arrays stored in the 'data' field of the 'ProcessedData' named tuple
+        are not serialized together with the rest of the data. Each worker node
+        instead copies them into a ring buffer in shared memory, which is read by the
+        master node. Each ring buffer is split into a number of slots, determined by
+        the 'shared_memory_num_slots' entry in the 'Onda' configuration parameter
+        group. The size of each slot, in megabytes, is determined by the
+        'shared_memory_slot_size_in_mb' entry in the same parameter group. The arrays
+        in each message from a worker node (a single 'ProcessedData' named tuple, or a
+        batch of them) must fit in a single slot, otherwise they are serialized. When
+        all the slots are in use, the worker node waits for the master node to free
+        one of them.
+
+        The 'dynamic_event_distribution', 'dynamic_event_distribution_batch_size',
+        'processed_data_batch_size', 'processed_data_batch_max_delay_in_ms',
+        'backpressure_max_in_flight_messages', 'backpressure_mode' and
+        'stage_timing_report_interval_in_s' entries in the 'Onda' configuration
+        parameter group have the same meaning as for the MPI-based engine.
+
+        NOTE: This class is designed to be subclassed to create an OnDA monitor.
+
+        Arguments:
+
+            process_func (Callable[[Dict[str, Any]], \
+                :class:`~onda.utils.named_tuples.ProcessedData`]): the function that
+                will be called on each worker node for every frame in a data event. The
+                'ProcessedData' named tuple returned by this function will be
+                transferred to the master node.
+
+            collect_func ( Callable[[:class:`~onda.utils.named_tuples.ProcessedData`], \
+                None]): the function that will run on the master node every time a
+                'ProcessedData' named tuple is transferred from a worker node.
+
+            source (str): a string describing a source of event data. The exact format
+                of the string depends on the specific Data Recovery Layer currently
+                being used. See the documentation of the relevant
+                'initialize_event_source' function).
+
+            monitor_params (:class:`~onda.utils.parameters.MonitorParams`): an object
+                storing the OnDA monitor parameters from the configuration file.
+
+            collect_batch_func (Optional[Callable[[List[\
+                :class:`~onda.utils.named_tuples.ProcessedData`]], None]]): the
+                function that will run on the master node every time a batch of
+                'ProcessedData' named tuples is transferred from a worker node. If
+                this argument is None, the 'collect_func' function is called
+                separately on each entry of the batch. Defaults to None.
+
+            aggregate_func (Optional[Callable[[List[\
+                :class:`~onda.utils.named_tuples.ProcessedData`]], List[\
+                :class:`~onda.utils.named_tuples.ProcessedData`]]]): the function that
+                runs on the aggregator nodes of the MPI-based engine. This engine does
+                not start any aggregator node, so the function is never called, exactly
+                as with the MPI-based engine when no aggregator node is requested. The
+                argument is accepted so that the same OnDA monitor can be used with
+                both engines. Defaults to None.
+
+        Attributes:
+
+            role (str): the role of the current node ('worker' or 'master').
+
+            rank (int): the rank of the current node (0 for the master node, from 1
+                to the number of worker nodes for the worker nodes).
+
+            stage_timer (:class:`~onda.utils.timing.StageTimer`): the timer used to
+                measure the duration of the processing stages on the current node. The
+                timer is disabled if the 'stage_timing_report_interval_in_s' entry in
+                the 'Onda' configuration parameter group is not set.
+        """
+        self._map = process_func
+        self._reduce = collect_func
+        self._reduce_batch = collect_batch_func
+        self._aggregate = aggregate_func
+        self._source = source
+        self._monitor_params = monitor_params
+
+        num_worker_nodes = monitor_params.get_param(
+            group="Onda", parameter="num_worker_nodes", type_=int
+        )
+        if num_worker_nodes is None:
+            num_worker_nodes = max(multiprocessing.cpu_count() - 1, 1)
+        self._num_nodes = num_worker_nodes + 1
+
+        data_retrieval_layer_filename = monitor_params.get_param(
+            group="Onda", parameter="data_retrieval_layer", type_=str, required=True
+        )
+        data_retrieval_layer = dynamic_import.import_data_retrieval_layer(
+            data_retrieval_layer_filename=data_retrieval_layer_filename
+        )
+        event_handling_functions = dynamic_import.get_event_handling_funcs(
+            data_retrieval_layer=data_retrieval_layer
+        )
+        self._initialize_event_source = event_handling_functions[
+            "initialize_event_source"
+        ]
+        self._event_generator = event_handling_functions["event_generator"]
+        self._num_frames_in_event_to_process = monitor_params.get_param(
+            group="DataRetrievalLayer",
+            parameter="num_of_most_recent_frames_in_event_to_process",
+            type_=int,
+        )
+        frames_in_event_to_skip = monitor_params.get_param(
+            group="DataRetrievalLayer", parameter="frame_indexes_to_skip", type_=list
+        )
+        if frames_in_event_to_skip is not None:
+            self._frames_in_event_to_skip = tuple(frames_in_event_to_skip)
+        else:
+            self._frames_in_event_to_skip = tuple()
+        self._num_prefetched_frames = monitor_params.get_param(
+            group="Onda", parameter="num_prefetched_frames", type_=int
+        )
+
+        dynamic_event_distribution = monitor_params.get_param(
+            group="Onda", parameter="dynamic_event_distribution", type_=bool
+        )
+        if dynamic_event_distribution is None:
+            self._dynamic_event_distribution = False
+        else:
+            self._dynamic_event_distribution = dynamic_event_distribution
+        self._event_batch_size = monitor_params.get_param(
+            group="Onda", parameter="dynamic_event_distribution_batch_size", type_=int
+        )
+        if self._event_batch_size is None:
+            self._event_batch_size = 1
+        self._processed_data_batch_size = monitor_params.get_param(
+            group="Onda", parameter="processed_data_batch_size", type_=int
+        )
+        processed_data_batch_max_delay = monitor_params.get_param(
+            group="Onda", parameter="processed_data_batch_max_delay_in_ms", type_=float
+        )
+        if processed_data_batch_max_delay is not None:
+            self._processed_data_batch_max_delay = (
+                processed_data_batch_max_delay / 1000.0
+            )
+        else:
+            self._processed_data_batch_max_delay = None
+
+        shared_memory_num_slots = monitor_params.get_param(
+            group="Onda", parameter="shared_memory_num_slots", type_=int
+        )
+        if shared_memory_num_slots is None:
+            self._num_slots = 4
+        else:
+            self._num_slots = shared_memory_num_slots
+        shared_memory_slot_size = monitor_params.get_param(
+            group="Onda", parameter="shared_memory_slot_size_in_mb", type_=float
+        )
+        if shared_memory_slot_size is None:
+            shared_memory_slot_size = 16.0
+        self._slot_size = int(shared_memory_slot_size * 1024 * 1024)
+        self._stage_timing_report_interval = monitor_params.get_param(
+            group="Onda", parameter="stage_timing_report_interval_in_s", type_=float
+        )
+        self.stage_timer = timing.StageTimer(
+            enabled=self._stage_timing_report_interval is not None
+        )
+        # Timer used by the thread that prefetches the frame data, if any.
+        self._prefetch_stage_timer = None  # type: Optional[timing.StageTimer]
+        self._max_in_flight_messages = monitor_params.get_param(
+            group="Onda", parameter="backpressure_max_in_flight_messages", type_=int
+        )
+        self._backpressure_mode = monitor_params.get_param(
+            group="Onda", parameter="backpressure_mode", type_=str
+        )
+        if self._backpressure_mode is None:
+            self._backpressure_mode = "drop_payloads"
+        if self._backpressure_mode not in ("drop_payloads", "skip_frames"):
+            raise RuntimeError(
+                "Unrecognized backpressure mode: {0}.".format(self._backpressure_mode)
+            )
+
+        # Creates the objects shared by all the nodes before starting the worker
+        # nodes, so that they are inherited by them. Each worker node has its own ring
+        # buffer, and a semaphore that counts the free slots in it.
+        self._result_queue = multiprocessing.Queue()
+        self._shutdown_event = multiprocessing.Event()
+        self._event_source_initialized = multiprocessing.Event()
+        self._next_event_index = multiprocessing.Value("l", 0)
+        self._ring_buffers = [
+            multiprocessing.RawArray(ctypes.c_uint8, self._num_slots * self._slot_size)
+            for _ in range(num_worker_nodes)
+        ]
+        self._free_slots = [
+            multiprocessing.Semaphore(self._num_slots) for _ in range(num_worker_nodes)
+        ]
+        # Each worker node can read how many of its messages have been collected by
+        # the master node, and writes there how many payloads it has dropped and how
+        # many frames it has skipped.
+        self._num_collected_messages = multiprocessing.RawArray(
+            ctypes.c_long, num_worker_nodes
+        )
+        self._shed_data_counters = multiprocessing.RawArray(
+            ctypes.c_long, 2 * num_worker_nodes
+        )
+
+        # Makes sure that nothing is left in the output buffers, otherwise it would be
+        # printed once by each node.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.rank = 0
+        self._worker_pids = {}  # type: Dict[int, int]
+        for node_rank in range(1, self._num_nodes):
+            try:
+                pid = os.fork()
+            except AttributeError as exc:
+                raise_from(
+                    exc=exceptions.OndaUnsupportedParallelizationLayerError(
+                        "The multiprocessing-based parallelization engine is only "
+                        "supported on POSIX systems."
+                    ),
+                    cause=exc,
+                )
+            if pid == 0:
+                self.rank = node_rank
+                break
+            self._worker_pids[node_rank] = pid
+
+        if self.rank == 0:
+            self.role = "master"
+        else:
+            self.role = "worker"
+
+        if self.role == "worker":
+            # Only the master node reacts to keyboard interrupts, and shuts down the
+            # worker nodes in an orderly fashion.
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self._worker_pids = {}
+            self._ring_buffer = self._ring_buffers[self.rank - 1]
+            self._next_slot = 0
+            self._processed_data_batch = []  # type: List[named_tuples.ProcessedData]
+            self._processed_data_batch_start_time = 0.0
+            self._num_sent_messages = 0
+            self._last_stage_timing_report_time = time.time()
+
+        if self.role == "master":
+            self._finished_worker_nodes = set()  # type: Set[int]
+            self._terminated_worker_nodes = []  # type: List[int]
+            self._last_worker_node_check_time = time.time()
+            self._num_collected_events = 0
+            self._stage_timing_reports = {}  # type: Dict[int, Dict[str, Any]]
+
+    def start(self):
+        # type () -> None
+        """
+        Starts the parallelization engine.
+
+        * When this function is called on a worker node, the node starts retrieving data
+          events and processing them.
+
+        * When this function is called on the master node, the node starts receiving
+          data from the worker nodes and aggregating it.
+        """
+        if self.role == "worker":
+            # Waits until the master node has initialized the event source, while
+            # still listening for requests to shut down.
+            while not self._event_source_initialized.wait(timeout=1.0):
+                if self._shutdown_event.is_set():
+                    self.shutdown("Shutting down RANK: {0}.".format(self.rank))
+            if self._dynamic_event_distribution:
+                try:
+                    events = self._event_generator(
+                        source=self._source,
+                        node_rank=self.rank,
+                        node_pool_size=self._num_nodes,
+                        monitor_params=self._monitor_params,
+                        event_indexes=self._event_index_generator(),
+                    )
+                except TypeError as exc:
+                    raise_from(
+                        exc=exceptions.OndaUnsupportedEventDistributionError(
+                            "The Data Retrieval Layer does not support dynamic event "
+                            "distribution."
+                        ),
+                        cause=exc,
+                    )
+            else:
+                events = self._event_generator(
+                    source=self._source,
+                    node_rank=self.rank,
+                    node_pool_size=self._num_nodes,
+                    monitor_params=self._monitor_params,
+                )
+
+            if self._num_prefetched_frames:
+                # The frame data is retrieved in a background thread, which cannot
+                # share the timer of the worker node.
+                self._prefetch_stage_timer = timing.StageTimer(
+                    enabled=self.stage_timer.enabled
+                )
+                frame_data_stage_timer = self._prefetch_stage_timer
+            else:
+                frame_data_stage_timer = self.stage_timer
+            frame_data = prefetch.generate_frame_data(
+                events=events,
+                num_frames_in_event_to_process=self._num_frames_in_event_to_process,
+                frames_in_event_to_skip=self._frames_in_event_to_skip,
+                stage_timer=frame_data_stage_timer,
+                frame_must_be_skipped=(
+                    None if self._num_prefetched_frames else self._frame_must_be_skipped
+                ),
+            )
+            if self._num_prefetched_frames:
+                # The data is retrieved in the background. Frames are then skipped
+                # because of backpressure only after they have been retrieved.
+                frame_data = prefetch.FramePrefetcher(
+                    frame_data=frame_data,
+                    max_num_prefetched_frames=self._num_prefetched_frames,
+                    stage_timer=self.stage_timer,
+                )
+
+            for data in frame_data:
+                # Listens for requests to shut down.
+                if self._shutdown_event.is_set():
+                    self.shutdown("Shutting down RANK: {0}.".format(self.rank))
+                if self._num_prefetched_frames and self._frame_must_be_skipped():
+                    continue
+                with self.stage_timer.stage("processing"):
+                    result = self._map(data)
+                if self._processed_data_batch_size is None:
+                    with self.stage_timer.stage("send"):
+                        self._shed_and_send_processed_data(result)
+                    self._report_stage_timings()
+                    continue
+                if not self._processed_data_batch:
+                    self._processed_data_batch_start_time = time.time()
+                self._processed_data_batch.append(result)
+                if self._processed_data_batch_is_ready():
+                    with self.stage_timer.stage("send"):
+                        self._shed_and_send_processed_data(self._processed_data_batch)
+                    self._processed_data_batch = []
+                self._report_stage_timings()
+
+            # Sends to the master node any processed data left in the batch.
+            if self._processed_data_batch:
+                self._shed_and_send_processed_data(self._processed_data_batch)
+                self._processed_data_batch = []
+
+            self._report_stage_timings(force=True)
+
+            # After finishing iterating over the events to process, sends a message to
+            # the master node saying that there are no more events.
+            self._result_queue.put((_NOMORE, self.rank, None))
+            self._exit_worker_node()
+
+        if self.role == "master":
+            print("Starting OnDA with the following parameters:")
+            print(
+                json.dumps(
+                    self._monitor_params.get_all_parameters(), indent=4, sort_keys=True
+                )
+            )
+            print(
+                "You are using an OnDA real-time monitor. Please cite: "
+                "Mariani et al., J Appl Crystallogr. 2016 May 23;49(Pt 3):1073-1080"
+            )
+            try:
+                _ = self._initialize_event_source(  # pylint: disable=unused-variable
+                    source=self._source,
+                    node_pool_size=self._num_nodes,
+                    monitor_params=self._monitor_params,
+                )
+            except Exception:
+                # The worker nodes are waiting for the event source to be initialized:
+                # they are told to shut down.
+                self._shutdown_event.set()
+                raise
+            self._event_source_initialized.set()
+            while True:
+                try:
+                    # The worker nodes are checked at regular intervals, whether or
+                    # not messages are being received, so that a worker node that
+                    # has died is noticed even while the others keep sending data.
+                    now = time.time()
+                    if (
+                        now - self._last_worker_node_check_time
+                        >= _WORKER_NODE_CHECK_INTERVAL
+                    ):
+                        self._last_worker_node_check_time = now
+                        self._check_worker_nodes()
+                    try:
+                        tag, node_rank, received_data = self._result_queue.get(
+                            timeout=_WORKER_NODE_CHECK_INTERVAL
+                        )
+                    except queue.Empty:
+                        continue
+                    if tag == _NOMORE:
+                        # If the received message announces that a worker node has
+                        # finished processing data, keeps track of how many worker
+                        # nodes have already finished.
+                        print("Finalizing {0}".format(node_rank))
+                        self._finished_worker_nodes.add(node_rank)
+                        # When all workers have finished, calls the 'end_processing'
+                        # function then shuts down.
+                        if len(self._finished_worker_nodes) == self._num_nodes - 1:
+                            print("All workers have run out of events.")
+                            print("Shutting down.")
+                            sys.stdout.flush()
+                            self.end_processing()
+                            self._wait_for_worker_nodes()
+                            exit(0)
+                        continue
+                    if tag == _TIMINGTAG:
+                        # If the received message contains the timing histograms of
+                        # a worker node, stores them.
+                        if received_data:
+                            self._stage_timing_reports[node_rank] = received_data
+                        continue
+                    if tag == _DEADTAG:
+                        # If the received message announces that a worker node has
+                        # shut down on its own (for example, because of an error),
+                        # shuts down the other worker nodes too.
+                        self._finished_worker_nodes.add(node_rank)
+                        self.shutdown(
+                            "Worker node {0} has shut down.".format(node_rank)
+                        )
+                    if tag != 0:
+                        print(
+                            "OnDA Warning: Ignoring a message with unexpected tag {0} "
+                            "received from worker node {1}.".format(tag, node_rank)
+                        )
+                        sys.stdout.flush()
+                        continue
+                    self._collect_processed_data(
+                        message=received_data, node_rank=node_rank
+                    )
+                except KeyboardInterrupt as exc:
+                    print("Recieved keyboard sigterm...")
+                    print(str(exc))
+                    print("shutting down the worker nodes.")
+                    self.shutdown()
+                    print("---> execution finished.")
+                    sys.stdout.flush()
+                    exit(0)
+
+    def shutdown(self, msg="Reason not provided."):
+        # type (Optional[str]) -> None
+        """
+        Shuts down the parallelization engine.
+
+        * When this function is called on a worker node, the worker communicates to the
+          master node that it is shutting down, then shuts down.
+
+        * When this function is called on the master node, the master tells each worker
+          to shut down, waits for all the workers to confirm that they done that, then
+          shuts down.
+
+        Arguments:
+
+            msg (Optional[str]): reason for shutting down the parallelization engine.
+                Defaults to "Reason not provided".
+        """
+        print("Shutting down:", msg)
+        sys.stdout.flush()
+        if self.role == "worker":
+            self._result_queue.put((_DEADTAG, self.rank, None))
+            self._exit_worker_node()
+        if self.role == "master":
+            # Tells all the worker nodes that they need to shut down, then waits for
+            # confirmation. During the whole process, keeps receiving messages from
+            # the worker nodes and freeing the ring buffer slots, so that no worker
+            # node remains blocked.
+            self._shutdown_event.set()
+            num_running_worker_nodes = (
+                self._num_nodes - 1 - len(self._finished_worker_nodes)
+            )
+            num_shutdown_confirm = 0
+            while num_shutdown_confirm < num_running_worker_nodes:
+                try:
+                    tag, node_rank, received_data = self._result_queue.get(timeout=1.0)
+                except queue.Empty:
+                    if not self._worker_pids:
+                        break
+                    self._reap_worker_nodes()
+                    continue
+                if tag == _DEADTAG or tag == _NOMORE:
+                    num_shutdown_confirm += 1
+                elif tag == 0 and received_data[1] is not None:
+                    self._free_slots[node_rank - 1].release()
+            # When all the worker nodes have confirmed, shuts down the master.
+            self._wait_for_worker_nodes()
+            exit(0)
+
+    def _send_stage_timing_report(self, report, force):
+        # type: (Dict[str, Dict[str, Any]], bool) -> None
+        # Sends a timing report to the master node. The queue transfers the report in
+        # the background, and the worker node waits for all transfers before exiting.
+        self._result_queue.put((_TIMINGTAG, self.rank, report))
+
+    def _get_num_in_flight_messages(self):
+        # type: () -> int
+        # Returns how many messages sent by the worker node have not been collected by
+        # the master node yet.
+        return self._num_sent_messages - self._num_collected_messages[self.rank - 1]
+
+    def _frame_must_be_skipped(self):
+        # type: () -> bool
+        # Checks if a frame must be skipped, without being processed, because the
+        # master node is falling behind.
+        if (
+            self._max_in_flight_messages is None
+            or self._backpressure_mode != "skip_frames"
+            or self._get_num_in_flight_messages() < self._max_in_flight_messages
+        ):
+            return False
+        self._shed_data_counters[2 * (self.rank - 1) + 1] += 1
+
+        return True
+
+    def _shed_and_send_processed_data(self, processed_data):
+        # type: (Any) -> None
+        # Sends the processed data to the master node, after shedding part or all of
+        # it if the master node is falling behind.
+        if self._max_in_flight_messages is not None:
+            if isinstance(processed_data, list):
+                num_entries = len(processed_data)
+            else:
+                num_entries = 1
+            num_in_flight_messages = self._get_num_in_flight_messages()
+            if num_in_flight_messages >= 2 * self._max_in_flight_messages:
+                self._shed_data_counters[2 * (self.rank - 1) + 1] += num_entries
+                return
+            if (
+                num_in_flight_messages >= self._max_in_flight_messages
+                and self._backpressure_mode == "drop_payloads"
+            ):
+                processed_data, num_dropped_payloads = base.drop_payloads(
+                    processed_data
+                )
+                self._shed_data_counters[2 * (self.rank - 1)] += num_dropped_payloads
+        self._num_sent_messages += 1
+        self._send_processed_data(processed_data)
+
+    def _send_processed_data(self, processed_data):
+        # type: (Any) -> None
+        # Sends the processed data (a single 'ProcessedData' named tuple or a list of
+        # them) to the master node. The numpy arrays are copied into the next free slot
+        # of the ring buffer, and replaced by placeholders in the message sent through
+        # the queue. If the arrays do not fit in a slot, they are serialized together
+        # with the rest of the data.
+        if isinstance(processed_data, list):
+            processed_data_batch = processed_data
+        else:
+            processed_data_batch = [processed_data]
+        slot_usage = 0
+        for entry in processed_data_batch:
+            for value in entry.data.values():
+                if isinstance(value, numpy.ndarray):
+                    slot_usage += _aligned_size(value.nbytes)
+        if slot_usage == 0 or slot_usage > self._slot_size:
+            self._result_queue.put((0, self.rank, (processed_data, None)))
+            return
+
+        # Waits for a free slot, while still listening for requests to shut down.
+        while not self._free_slots[self.rank - 1].acquire(timeout=1.0):
+            if self._shutdown_event.is_set():
+                self.shutdown("Shutting down RANK: {0}.".format(self.rank))
+        slot = self._next_slot
+        self._next_slot = (self._next_slot + 1) % self._num_slots
+        offset = slot * self._slot_size
+        serialized_batch = []
+        for entry in processed_data_batch:
+            data = {}
+            for key, value in iteritems(entry.data):
+                if isinstance(value, numpy.ndarray):
+                    numpy.ndarray(
+                        shape=value.shape,
+                        dtype=value.dtype,
+                        buffer=self._ring_buffer,
+                        offset=offset,
+                    )[...] = value
+                    data[key] = _ArrayInfo(
+                        shape=value.shape, dtype=value.dtype.str, offset=offset
+                    )
+                    offset += _aligned_size(value.nbytes)
+                else:
+                    data[key] = value
+            serialized_batch.append(
+                named_tuples.ProcessedData(data=data, worker_rank=entry.worker_rank)
+            )
+        if isinstance(processed_data, list):
+            message = serialized_batch
+        else:
+            message = serialized_batch[0]
+        self._result_queue.put((0, self.rank, (message, slot)))
+
+    def _collect_processed_data(self, message, node_rank):
+        # type: (Tuple[Any, Optional[int]], int) -> None
+        # Copies the arrays out of the ring buffer of a worker node, if needed, frees
+        # the ring buffer slot, then calls the collecting function(s) on the processed
+        # data.
+        processed_data, slot = message
+        if isinstance(processed_data, list):
+            processed_data_batch = processed_data
+        else:
+            processed_data_batch = [processed_data]
+        if slot is not None:
+            ring_buffer = self._ring_buffers[node_rank - 1]
+            for entry in processed_data_batch:
+                for key, value in iteritems(entry.data):
+                    if isinstance(value, _ArrayInfo):
+                        entry.data[key] = numpy.array(
+                            numpy.ndarray(
+                                shape=value.shape,
+                                dtype=numpy.dtype(value.dtype),
+                                buffer=ring_buffer,
+                                offset=value.offset,
+                            )
+                        )
+            self._free_slots[node_rank - 1].release()
+        if self._reduce_batch is None:
+            for entry in processed_data_batch:
+                self._reduce(entry)
+        else:
+            self._reduce_batch(processed_data_batch)
+        self._num_collected_events += len(processed_data_batch)
+        self._num_collected_messages[node_rank - 1] += 1
+
+    def _event_index_generator(self):
+        # type: () -> Generator[int, None, None]
+        # Takes batches of consecutive event indexes from the counter shared by all the
+        # worker nodes, and yields them one by one. The Data Retrieval Layer stops
+        # consuming the indexes when they point beyond the end of its list of events.
+        while not self._shutdown_event.is_set():
+            with self._next_event_index.get_lock():
+                first_event_index = self._next_event_index.value
+                self._next_event_index.value += self._event_batch_size
+            for event_index in range(
+                first_event_index, first_event_index + self._event_batch_size
+            ):
+                yield event_index
+
+    def _exit_worker_node(self):
+        # type: () -> None
+        # Makes sure that all the messages have been delivered to the master node, then
+        # terminates the worker process without running the clean-up actions inherited
+        # from the master node.
+        self._result_queue.close()
+        self._result_queue.join_thread()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)  # pylint: disable=protected-access
+
+    def _reap_worker_nodes(self):
+        # type: () -> List[Tuple[int, Optional[int]]]
+        # Collects the exit status of the worker nodes that have terminated, and
+        # returns their ranks and exit codes. As in the multiprocessing module, the
+        # exit code of a worker node killed by a signal is the negative signal number.
+        # The exit code is None if it cannot be retrieved.
+        terminated_worker_nodes = []
+        for node_rank, pid in list(self._worker_pids.items()):
+            try:
+                waited_pid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                waited_pid, status = pid, None
+            if waited_pid == pid:
+                del self._worker_pids[node_rank]
+                if status is None:
+                    exit_code = None
+                elif os.WIFSIGNALED(status):
+                    exit_code = -os.WTERMSIG(status)
+                else:
+                    exit_code = os.WEXITSTATUS(status)
+                terminated_worker_nodes.append((node_rank, exit_code))
+
+        return terminated_worker_nodes
+
+    def _check_worker_nodes(self):
+        # type: () -> None
+        # Shuts down the engine if a worker node has terminated without announcing it
+        # (for example, because of an unhandled exception). A worker node that exits
+        # with a non-zero exit code has crashed, and the engine is shut down at once.
+        # A worker node that exits normally is only considered lost if the master
+        # node has not received its final message by the next check, because the
+        # message might still be in the queue.
+        for node_rank in self._terminated_worker_nodes:
+            if node_rank not in self._finished_worker_nodes:
+                self.shutdown(
+                    "Worker node {0} terminated unexpectedly.".format(node_rank)
+                )
+        for node_rank, exit_code in self._reap_worker_nodes():
+            if exit_code != 0:
+                self.shutdown(
+                    "Worker node {0} terminated with exit code {1}.".format(
+                        node_rank, exit_code
+                    )
+                )
+            self._terminated_worker_nodes.append(node_rank)
+
+    def _wait_for_worker_nodes(self):
+        # type: () -> None
+        # Waits for all the worker processes to terminate.
+        for pid in self._worker_pids.values():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._worker_pids = {}
+
+    def _get_shed_data_counters_by_node(self):
+        # type: () -> List[Tuple[int, int]]
+        # Returns the counters updated by each worker node in shared memory.
+        return list(zip(self._shed_data_counters[0::2], self._shed_data_counters[1::2]))
+
+
+def _aligned_size(num_bytes):
+    # type: (int) -> int
+    # Rounds a size in bytes up to the next multiple of the array alignment.
+    return -(-num_bytes // _ARRAY_ALIGNMENT) * _ARRAY_ALIGNMENT
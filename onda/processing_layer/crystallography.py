@@ -20,11 +20,11 @@ This module contains an OnDA monitor for serial x-ray crystallography experiment
 """
 from __future__ import absolute_import, division, print_function
 
-import collections
 import sys
 import time
-from typing import Any, Dict, Tuple  # pylint: disable=unused-import
+from typing import Any, Dict, List, Optional, Tuple  # pylint: disable=unused-import
 
+import numpy
 from cfelpyutils import crystfel_utils, geometry_utils
 
 from onda.algorithms import (
@@ -32,11 +32,10 @@ from onda.algorithms import (
     crystallography_algorithms as cryst_algs,
     generic_algorithms as gen_algs,
 )
-from onda.parallelization_layer import mpi
-from onda.utils import dynamic_import, named_tuples, zmq_monitor
+from onda.utils import dynamic_import, named_tuples, timing, zmq_monitor
 
 
-class OndaMonitor(mpi.ParallelizationEngine):
+class OndaMonitor(object):
     """
     See documentation for the '__init__' function.
     """
@@ -55,6 +54,10 @@ class OndaMonitor(mpi.ParallelizationEngine):
         visualization by other programs. Optionally, it can also broadcast calibrated
         and corrected detector data frames.
 
+        NOTE: This class does not derive from any parallelization engine. The engine
+        is chosen when the monitor is started, using the
+        :func:`~onda.utils.dynamic_import.get_monitor_class` function.
+
         Arguments:
 
             source (str): a string describing the data source. The exact format of the
@@ -81,12 +84,23 @@ class OndaMonitor(mpi.ParallelizationEngine):
             if requested_calibration_algorithm is not None:
                 calibration_alg = getattr(calib_algs, requested_calibration_algorithm)
                 self._calibration = calibration_alg(
-                    calibration_file=monitor_parameters.get_param(
+                    calibration_filename=monitor_parameters.get_param(
                         group="DetectorCalibration",
-                        parameter="calibration_file",
+                        parameter="calibration_filename",
                         type_=str,
                         required=True,
-                    )
+                    ),
+                    cellid_list=monitor_parameters.get_param(
+                        group="DetectorCalibration",
+                        parameter="calibration_cellid_list",
+                        type_=list,
+                        required=True,
+                    ),
+                    cache_directory=monitor_parameters.get_param(
+                        group="DetectorCalibration",
+                        parameter="calibration_cache_directory",
+                        type_=str,
+                    ),
                 )
             else:
                 # If no calibration is required, stores None in the 'calibration_alg'
@@ -197,6 +211,18 @@ class OndaMonitor(mpi.ParallelizationEngine):
                 )
             else:
                 pf8_bad_pixel_map_hdf5_path = None
+            pf8_num_threads = monitor_parameters.get_param(
+                group="Peakfinder8PeakDetection", parameter="num_threads", type_=int
+            )
+            if pf8_num_threads is None:
+                pf8_num_threads = 1
+            pf8_warm_start = monitor_parameters.get_param(
+                group="Peakfinder8PeakDetection",
+                parameter="warm_start_background_estimation",
+                type_=bool,
+            )
+            if pf8_warm_start is None:
+                pf8_warm_start = False
             self._peak_detection = cryst_algs.Peakfinder8PeakDetection(
                 max_num_peaks=pf8_max_num_peaks,
                 asic_nx=pf8_detector_info.asic_nx,
@@ -213,6 +239,8 @@ class OndaMonitor(mpi.ParallelizationEngine):
                 bad_pixel_map_filename=pf8_bad_pixel_map_fname,
                 bad_pixel_map_hdf5_path=pf8_bad_pixel_map_hdf5_path,
                 radius_pixel_map=radius_pixel_map,
+                num_threads=pf8_num_threads,
+                warm_start_background_estimation=pf8_warm_start,
             )
 
             self._max_saturated_peaks = monitor_parameters.get_param(
@@ -271,26 +299,44 @@ class OndaMonitor(mpi.ParallelizationEngine):
                 type_=int,
                 required=True,
             )
-            self._data_accumulator = gen_algs.DataAccumulator(
+            self._data_accumulator = gen_algs.ColumnarDataAccumulator(
                 num_events_to_accumulate=num_events_to_accumulate
             )
 
+            self._report_latency = bool(
+                monitor_parameters.get_param(
+                    group="Crystallography", parameter="report_latency", type_=bool
+                )
+            )
+
             self._running_average_window_size = monitor_parameters.get_param(
                 group="Crystallography",
                 parameter="running_average_window_size",
                 type_=int,
                 required=True,
             )
-            self._hit_rate_running_window = collections.deque(
-                [0.0] * self._running_average_window_size,
-                maxlen=self._running_average_window_size,
+            self._hit_rate_statistics = gen_algs.RunningStatistics(
+                window_size=self._running_average_window_size
             )
-            self._saturation_rate_running_window = collections.deque(
-                [0.0] * self._running_average_window_size,
-                maxlen=self._running_average_window_size,
+            self._saturation_rate_statistics = gen_algs.RunningStatistics(
+                window_size=self._running_average_window_size
+            )
+            # The histogram used for the percentiles of the number of peaks has one
+            # bin for each possible number of peaks.
+            max_num_peaks = monitor_parameters.get_param(
+                group="Peakfinder8PeakDetection",
+                parameter="max_num_peaks",
+                type_=int,
+                required=True,
+            )
+            self._num_peaks_statistics = gen_algs.RunningStatistics(
+                window_size=self._running_average_window_size,
+                histogram_range=(-0.5, max_num_peaks + 0.5),
+                num_histogram_bins=max_num_peaks + 1,
+            )
+            self._peak_intensity_statistics = gen_algs.RunningStatistics(
+                window_size=self._running_average_window_size
             )
-            self._avg_hit_rate = 0
-            self._avg_sat_rate = 0
 
             broadcast_socket_ip = monitor_parameters.get_param(
                 group="Crystallography", parameter="broadcast_ip", type_=str
@@ -301,8 +347,46 @@ class OndaMonitor(mpi.ParallelizationEngine):
             self._data_broadcast_socket = zmq_monitor.ZmqDataBroadcaster(
                 hostname=broadcast_socket_ip, port=broadcast_socket_port
             )
+            broadcast_stage_timings = monitor_parameters.get_param(
+                group="Crystallography", parameter="broadcast_stage_timings", type_=bool
+            )
+            if broadcast_stage_timings is None:
+                self._broadcast_stage_timings = False
+            else:
+                self._broadcast_stage_timings = broadcast_stage_timings
+
+            frame_broadcast_encoding = monitor_parameters.get_param(
+                group="Crystallography", parameter="frame_broadcast_encoding", type_=str
+            )
+            frame_broadcast_bin_size = monitor_parameters.get_param(
+                group="Crystallography", parameter="frame_broadcast_bin_size", type_=int
+            )
+            frame_broadcast_compression_level = monitor_parameters.get_param(
+                group="Crystallography",
+                parameter="frame_broadcast_compression_level",
+                type_=int,
+            )
+            if (
+                frame_broadcast_encoding is None
+                and frame_broadcast_bin_size is None
+                and frame_broadcast_compression_level is None
+            ):
+                self._frame_encoder = None
+            else:
+                if frame_broadcast_encoding is None:
+                    frame_broadcast_encoding = "none"
+                if frame_broadcast_bin_size is None:
+                    frame_broadcast_bin_size = 1
+                if frame_broadcast_compression_level is None:
+                    frame_broadcast_compression_level = 0
+                self._frame_encoder = zmq_monitor.FrameEncoder(
+                    encoding=frame_broadcast_encoding,
+                    bin_size=frame_broadcast_bin_size,
+                    compression_level=frame_broadcast_compression_level,
+                )
 
             self._num_events = 0
+            self._event_latencies = []  # type: List[float]
             self._old_time = time.time()
             self._time = None
 
@@ -335,17 +419,29 @@ class OndaMonitor(mpi.ParallelizationEngine):
         """
         processed_data = {}
         if self._calibration is not None:
-            calibrated_detector_data = self._calibration.apply_calibration(
-                calibration_file_name=data["detector_data"]
-            )
+            with self.stage_timer.stage("calibration"):
+                # The calibration needs, in addition to the frame, the gain
+                # information and the cell from which the frame originates, which
+                # must therefore be listed in the 'required_data' parameter.
+                calibrated_detector_data = self._calibration.apply_calibration(
+                    data_and_calib_info=named_tuples.DataAndCalibrationInfo(
+                        data=data["detector_data"],
+                        info={
+                            "gain": data["detector_gain"],
+                            "cell": data["detector_cell"],
+                        },
+                    )
+                )
         else:
             calibrated_detector_data = data["detector_data"]
-        corrected_detector_data = self._correction.apply_correction(
-            data=calibrated_detector_data
-        )
-        peak_list = self._peak_detection.find_peaks(corrected_detector_data)
+        with self.stage_timer.stage("correction"):
+            corrected_detector_data = self._correction.apply_correction(
+                data=calibrated_detector_data
+            )
+        with self.stage_timer.stage("peak_finding"):
+            peak_list = self._peak_detection.find_peaks(corrected_detector_data)
         frame_is_saturated = (
-            len([x for x in peak_list.intensity if x > self._saturation_value])
+            numpy.count_nonzero(peak_list.intensity > self._saturation_value)
             > self._max_saturated_peaks
         )
         frame_is_hit = (
@@ -357,6 +453,8 @@ class OndaMonitor(mpi.ParallelizationEngine):
         processed_data["timestamp"] = data["timestamp"]
         processed_data["frame_is_saturated"] = frame_is_saturated
         processed_data["frame_is_hit"] = frame_is_hit
+        processed_data["num_peaks"] = len(peak_list.intensity)
+        processed_data["peak_intensity"] = float(numpy.sum(peak_list.intensity))
         processed_data["detector_distance"] = data["detector_distance"]
         processed_data["beam_energy"] = data["beam_energy"]
         processed_data["native_data_shape"] = data["detector_data"].shape
@@ -368,13 +466,16 @@ class OndaMonitor(mpi.ParallelizationEngine):
                     # If the frame is a hit, and if the 'hit_sending_interval'
                     # attribute says that the detector frame data should be sent to
                     # the master node, adds the data to the 'processed_dat' dictionary
-                    # (and resets the counter).
-                    processed_data["detector_data"] = corrected_detector_data
+                    # (and resets the counter). The data is copied, because the
+                    # correction algorithm reuses its output array for the next frame.
+                    processed_data["detector_data"] = corrected_detector_data.copy()
                     self._hit_frame_sending_counter = 0
         else:
             # If the frame is not a hit, sends an empty peak list.
             processed_data["peak_list"] = named_tuples.PeakList(
-                fs=[], ss=[], intensity=[]
+                fs=numpy.empty(0, dtype=numpy.float32),
+                ss=numpy.empty(0, dtype=numpy.float32),
+                intensity=numpy.empty(0, dtype=numpy.float32),
             )
             if self._non_hit_frame_sending_interval is not None:
                 self._non_hit_frame_sending_counter += 1
@@ -385,8 +486,9 @@ class OndaMonitor(mpi.ParallelizationEngine):
                     # If the frame is a not a hit, and if the 'hit_sending_interval'
                     # attribute says that the detector frame data should be sent to
                     # the master node, adds the data to the 'results_dict' dictionary
-                    # (and resets the counter).
-                    processed_data["detector_data"] = corrected_detector_data
+                    # (and resets the counter). The data is copied, because the
+                    # correction algorithm reuses its output array for the next frame.
+                    processed_data["detector_data"] = corrected_detector_data.copy()
                     self._non_hit_frame_sending_counter = 0
 
         return named_tuples.ProcessedData(data=processed_data, worker_rank=self.rank)
@@ -398,7 +500,9 @@ class OndaMonitor(mpi.ParallelizationEngine):
 
         This function computes aggregated statistics on data received from the worker
         nodes. It then broadcasts the results via a network socket (for visualization
-        by other programs) using the MessagePack protocol.
+        by other programs). Detector frame data is broadcasted using the MessagePack
+        protocol, while aggregated data is broadcasted in columnar format (see the
+        'send_columnar_data' function in the onda.utils.zmq_monitor module).
 
         Arguments:
 
@@ -409,49 +513,92 @@ class OndaMonitor(mpi.ParallelizationEngine):
         received_data = processed_data.data
         self._num_events += 1
 
-        self._hit_rate_running_window.append(float(received_data["frame_is_hit"]))
-        self._saturation_rate_running_window.append(
-            float(received_data["frame_is_saturated"])
-        )
-        avg_hit_rate = (
-            sum(self._hit_rate_running_window) / self._running_average_window_size
-        )
-        avg_sat_rate = (
-            sum(self._saturation_rate_running_window)
-            / self._running_average_window_size
-        )
-        received_data["hit_rate"] = avg_hit_rate
-        received_data["saturation_rate"] = avg_sat_rate
+        # The latency of each event is the time elapsed between the event timestamp
+        # and the collection of the event data. It is only measured on request,
+        # because the timestamp is not always the acquisition time (for files, it is
+        # their modification time).
+        if self._report_latency and received_data["timestamp"] is not None:
+            self._event_latencies.append(time.time() - received_data["timestamp"])
+
+        self._hit_rate_statistics.add_value(received_data["frame_is_hit"])
+        self._saturation_rate_statistics.add_value(received_data["frame_is_saturated"])
+        received_data["hit_rate"] = self._hit_rate_statistics.get_average()
+        received_data[
+            "saturation_rate"
+        ] = self._saturation_rate_statistics.get_average()
+        self._num_peaks_statistics.add_value(received_data["num_peaks"])
+        self._peak_intensity_statistics.add_value(received_data["peak_intensity"])
+        received_data["average_num_peaks"] = self._num_peaks_statistics.get_average()
+        received_data["median_num_peaks"] = self._num_peaks_statistics.get_percentiles(
+            [50]
+        )[0]
+        received_data[
+            "average_peak_intensity"
+        ] = self._peak_intensity_statistics.get_average()
         received_data["geometry_is_optimized"] = self._geometry_is_optimized
 
-        # Since the data will be sent out of the master node using msgpack, NamedTuple
-        # structures will not be preserved. The peak list is converted here to a
-        # dictionary, which suvives the msgpack conversion and allows introspection on
-        # the receiver side.
-        received_data["peak_list"] = {
-            "fs": received_data["peak_list"].fs,
-            "ss": received_data["peak_list"].ss,
-            "intensity": received_data["peak_list"].intensity,
-        }
-
         if "detector_data" in received_data:
             # If detector frame data is found in the data received from the worker
-            # node, it must be broadcasted to visualization programs. The frame is
-            # wrapped into a list because the receiving programs usually expect lists
-            # of aggregated events as opposed to single events.
+            # node, it must be broadcasted to visualization programs. Since the data
+            # will be sent out of the master node using msgpack, NamedTuple structures
+            # will not be preserved. The peak list is converted here to a dictionary,
+            # which suvives the msgpack conversion and allows introspection on the
+            # receiver side. The frame is wrapped into a list because the receiving
+            # programs usually expect lists of aggregated events as opposed to single
+            # events.
+            frame_data = dict(received_data)
+            frame_data["peak_list"] = {
+                "fs": received_data["peak_list"].fs,
+                "ss": received_data["peak_list"].ss,
+                "intensity": received_data["peak_list"].intensity,
+            }
+            # The frame is serialized by the broadcasting thread, after this function
+            # has returned. It is copied here, because the received frame might be
+            # stored in a buffer that is reused for the data received later.
+            frame_data["detector_data"] = received_data["detector_data"].copy()
+            if self._frame_encoder is not None:
+                frame_data["detector_data"] = self._frame_encoder.defer_encoding(
+                    frame_data["detector_data"]
+                )
             self._data_broadcast_socket.send_data(
-                tag=u"ondaframedata", message=[received_data]
-            )
-        # After it has been broadcasted, it removes the detector frame data from the
-        # 'received_data' dictionary (the frame data is not needed anymore, so we
-        # remove it for efficiency reasons).
-        if "detector_data" in received_data:
-            del received_data["detector_data"]
-
-        collected_data = self._data_accumulator.add_data(data=received_data)
+                tag=u"ondaframedata", message=[frame_data]
+            )
+
+        # The aggregated data is broadcasted in columnar format: the values from all
+        # the accumulated events are stored in contiguous arrays, and the peak lists
+        # are concatenated. Missing beam energy and detector distance values are
+        # stored as NaN.
+        collected_data = self._data_accumulator.add_data(
+            scalar_data={
+                "timestamp": received_data["timestamp"],
+                "frame_is_hit": received_data["frame_is_hit"],
+                "frame_is_saturated": received_data["frame_is_saturated"],
+                "hit_rate": received_data["hit_rate"],
+                "saturation_rate": received_data["saturation_rate"],
+                "num_peaks": received_data["num_peaks"],
+                "average_num_peaks": received_data["average_num_peaks"],
+                "median_num_peaks": received_data["median_num_peaks"],
+                "peak_intensity": received_data["peak_intensity"],
+                "average_peak_intensity": received_data["average_peak_intensity"],
+                "detector_distance": _float_or_nan(received_data["detector_distance"]),
+                "beam_energy": _float_or_nan(received_data["beam_energy"]),
+            },
+            array_data={
+                "peak_fs": received_data["peak_list"].fs,
+                "peak_ss": received_data["peak_list"].ss,
+                "peak_intensity": received_data["peak_list"].intensity,
+            },
+        )
         if collected_data is not None:
-            self._data_broadcast_socket.send_data(
-                tag=u"ondadata", message=collected_data
+            self._data_broadcast_socket.send_columnar_data(
+                tag=u"ondadata",
+                columns=collected_data,
+                metadata={
+                    "geometry_is_optimized": bool(self._geometry_is_optimized),
+                    "native_data_shape": [
+                        int(axis) for axis in received_data["native_data_shape"]
+                    ],
+                },
             )
 
         if self._num_events % self._speed_report_interval == 0:
@@ -462,6 +609,57 @@ class OndaMonitor(mpi.ParallelizationEngine):
                 (float(self._speed_report_interval) / float(now_time - self._old_time)),
             )
 
+            if self._event_latencies:
+                latency_msg = " - Latency: {0:.2f} s median, {1:.2f} s max".format(
+                    numpy.median(self._event_latencies), max(self._event_latencies)
+                )
+                speed_report_msg += latency_msg
+                self._event_latencies = []
+
+            shed_data_counters = self.get_shed_data_counters()
+            if any(shed_data_counters.values()):
+                speed_report_msg += (
+                    " - Shed because of backpressure: {0} frame payloads dropped, "
+                    "{1} frames skipped".format(
+                        shed_data_counters["dropped_payloads"],
+                        shed_data_counters["skipped_frames"],
+                    )
+                )
+
+            num_dropped_broadcasts = (
+                self._data_broadcast_socket.get_num_dropped_messages()
+            )
+            if num_dropped_broadcasts:
+                speed_report_msg += " - Broadcast messages dropped: {0}".format(
+                    num_dropped_broadcasts
+                )
+
             print(speed_report_msg)
+            stage_timing_reports = self.get_stage_timing_reports()
+            if stage_timing_reports:
+                print(
+                    timing.format_stage_timing_report(
+                        timing.merge_stage_timing_reports(
+                            list(stage_timing_reports.values())
+                        )
+                    )
+                )
+                if self._broadcast_stage_timings:
+                    self._data_broadcast_socket.send_data(
+                        tag=u"ondastagetimings",
+                        message={
+                            "bin_edges": timing.STAGE_TIMING_BIN_EDGES,
+                            "stage_timings": stage_timing_reports,
+                        },
+                    )
             sys.stdout.flush()
             self._old_time = now_time
+
+
+def _float_or_nan(value):
+    # type: (Optional[float]) -> float
+    # Converts a value that might be missing (None) to a float, using NaN for missing
+    # values.
+    if value is None:
+        return float("nan")
+    return float(value)
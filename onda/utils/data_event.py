@@ -27,7 +27,7 @@ from typing import Any, Callable, Dict  # pylint: disable=unused-import
 
 from future.utils import iteritems
 
-from onda.utils import exceptions
+from onda.utils import exceptions, timing
 
 
 class DataEvent(object):
@@ -85,6 +85,7 @@ class DataEvent(object):
         self.current_frame = None
         self.framework_info = {}
         self.data_extraction_functions = data_extraction_funcs
+        self.stage_timer = timing.StageTimer(enabled=False)
 
     def extract_data(self):
         # type: () -> Dict[str, Any]
@@ -92,7 +93,9 @@ class DataEvent(object):
         Extracts data from an event.
 
         This function calls in sequence all the Data Extraction functions that have
-        been attached to the event, and returns the extracted data.
+        been attached to the event, and returns the extracted data. The time spent in
+        each function is measured by the timer stored in the 'stage_timer' attribute
+        of the event (as a stage named after the function, with an 'extract_' prefix).
 
         Returns:
 
@@ -107,7 +110,8 @@ class DataEvent(object):
         data = {}
         try:
             for f_name, func in iteritems(self.data_extraction_functions):
-                data[f_name] = func(self)
+                with self.stage_timer.stage("extract_" + f_name):
+                    data[f_name] = func(self)
         # One should never do the following, but it is not possible to anticipate
         # every possible error raised by the facility frameworks.
         except Exception:  # pylint: disable=broad-except
@@ -23,10 +23,18 @@ from __future__ import absolute_import, division, print_function
 
 import importlib
 from types import ModuleType  # pylint: disable=unused-import
-from typing import Any, Callable, Dict, List, Tuple  # pylint: disable=unused-import
+from typing import (  # pylint: disable=unused-import
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
 
 from future.utils import raise_from
 
+from onda.parallelization_layer import base
 from onda.utils import (  # pylint: disable=unused-import
     exceptions,
     named_tuples,
@@ -120,6 +128,61 @@ def import_parallelization_layer(parallelization_layer_filename):
     return parallelization_layer
 
 
+def get_monitor_class(monitor_class, parallelization_layer):
+    # type: (type, Optional[ModuleType]) -> type
+    """
+    Combines an OnDA monitor with a Parallelization Layer.
+
+    The OnDA monitors implemented by the Processing Layers (usually in an 'OndaMonitor'
+    class) are mixin classes that do not derive from any specific parallelization
+    engine: their '__init__' function initializes the engine via the 'super' function.
+    This function creates a new class, with the same name as the monitor class, that
+    derives from both the monitor class and the parallelization engine of the
+    specified Parallelization Layer. If no Parallelization Layer is specified, the
+    MPI-based one is used.
+
+    A monitor class that already derives from a parallelization engine is returned
+    unchanged, if no Parallelization Layer is specified or if the engine is the one of
+    the specified Parallelization Layer.
+
+    Arguments:
+
+        monitor_class (type): the OnDA monitor class.
+
+        parallelization_layer (Optional[ModuleType]): the Parallelization Layer module,
+            or None.
+
+    Returns:
+
+        type: a class implementing the OnDA monitor on top of the parallelization
+        engine.
+
+    Raises:
+
+        :class:`~onda.utils.exceptions.OndaUnsupportedParallelizationLayerError`: if the
+            monitor class already derives from a different parallelization engine.
+    """
+    monitor_has_engine = issubclass(monitor_class, base.ParallelizationEngineBase)
+    if parallelization_layer is None:
+        if monitor_has_engine:
+            return monitor_class
+        parallelization_layer = import_parallelization_layer("mpi")
+    engine_class = getattr(parallelization_layer, "ParallelizationEngine")
+    if issubclass(monitor_class, engine_class):
+        return monitor_class
+    if monitor_has_engine:
+        raise exceptions.OndaUnsupportedParallelizationLayerError(
+            "The {0} class already derives from a different parallelization "
+            "engine.".format(monitor_class.__name__)
+        )
+
+    return type(
+        monitor_class.__name__,
+        (monitor_class, engine_class),
+        {"__module__": monitor_class.__module__},
+    )
+
+
 def get_event_handling_funcs(data_retrieval_layer):
     # type: (ModuleType) -> Dict[str, Callable]
     """
@@ -133,6 +196,9 @@ def get_event_handling_funcs(data_retrieval_layer):
     - 'close_event'
     - 'get_num_frames_in_event'
 
+    Additionally, it retrieves the optional 'get_num_events' function, if the Data
+    Retrieval Layer defines it. Otherwise, the value stored for this function is None.
+
     Arguments:
 
         data_retrieval_layer (ModuleType): the Data Retrieval Layer module.
@@ -164,6 +230,9 @@ def get_event_handling_funcs(data_retrieval_layer):
                 ),
                 cause=exc,
             )
+    event_handling_funcs["get_num_events"] = getattr(
+        data_retrieval_layer, "get_num_events", None
+    )
 
     return event_handling_funcs
 
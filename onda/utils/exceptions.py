@@ -87,6 +87,12 @@ class OndaWrongParameterTypeError(OndaException):
     """
 
 
+class OndaInvalidParameterValueError(OndaException):
+    """
+    Raised if the value of a configuration parameter is not valid.
+    """
+
+
 class OndaDataExtractionError(OndaException):
     """
     Raised if an error happens during data extraction.
@@ -117,6 +123,43 @@ class OndaMissingHdf5PathError(OndaException):
     """
 
 
+class OndaUnsupportedEventDistributionError(OndaException):
+    """
+    Raised if the Data Retrieval Layer does not support the requested event distribution
+    mode.
+    """
+
+
+class OndaUnsupportedParallelizationLayerError(OndaException):
+    """
+    Raised if the requested Parallelization Layer cannot be used.
+    """
+
+
+class OndaDetectorCalibrationError(OndaException):
+    """
+    Raised if an error happens while applying the detector calibration to a data frame.
+    """
+
+
+class OndaUnsupportedFrameEncodingError(OndaException):
+    """
+    Raised if the requested encoding for broadcasted data frames is not supported.
+    """
+
+
+class OndaRunningStatisticsError(OndaException):
+    """
+    Raised if the requested running statistics cannot be computed.
+    """
+
+
+class OndaUnsupportedWatchMethodError(OndaException):
+    """
+    Raised if the requested method for watching a directory tree is not supported.
+    """
+
+
 def onda_exception_handler(type_, value, traceback_):
     """
     Custom OnDA exception handler.
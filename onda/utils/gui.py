@@ -24,9 +24,9 @@ from __future__ import absolute_import, division, print_function
 
 import copy
 import time
-from typing import Any, Callable, Dict, List  # pylint: disable=unused-import
+from typing import Any, Callable, Dict, List, Union  # pylint: disable=unused-import
 
-from onda.utils import zmq_gui
+from onda.utils import named_tuples, zmq_gui
 
 try:
     from PyQt5 import QtCore, QtWidgets as qt_widget_module
@@ -71,9 +71,11 @@ class OndaGui(qt_widget_module.QMainWindow):
 
         Attributes:
 
-            received_data (List[Dict[bytes, Any]]): the latest data received from
-                an OnDA monitor. A list of aggregated event data entries, each stored
-                in a dictionary.
+            received_data (Union[List[Dict[bytes, Any]], \
+                :class:`~onda.utils.named_tuples.ColumnarData`]): the latest data
+                received from an OnDA monitor. A list of aggregated event data
+                entries, each stored in a dictionary, or a batch of aggregated events
+                in columnar format.
 
             is_gui_listening (bool): the state of the listening thread. True if the
                 GUI is currently listening to an OnDA monitor, False otherwise.
@@ -125,17 +127,23 @@ class OndaGui(qt_widget_module.QMainWindow):
             self._listening_thread_stop_processing.emit()
 
     def _data_received(self, received_data):
-        # type: (List[Dict[str, Any]]) -> None
+        # type: (Union[List[Dict[str, Any]], named_tuples.ColumnarData]) -> None
         # This function is called every time the listening thread receives data from an
         # OnDA monitor. The received data has the format of a list of event data
-        # entries, each stored in a dictionary.
-        self.received_data = copy.deepcopy(received_data)
+        # entries, each stored in a dictionary, or of a batch of events in columnar
+        # format. The columns are created on top of buffers owned by the received
+        # message, which are never reused, so they do not need to be copied.
+        if isinstance(received_data, named_tuples.ColumnarData):
+            self.received_data = received_data
+            timestamp = received_data.columns["timestamp"][-1]
+        else:
+            self.received_data = copy.deepcopy(received_data)
+            timestamp = self.received_data[-1][b"timestamp"]
 
         # Computes the estimated age of the received data and prints it into the status
         # bar (a GUI is supposed to be a Qt MainWindow widget, so it is supposed to
-        # have a status bar). The timestamp of the last event in the received list is
+        # have a status bar). The timestamp of the last event in the received data is
         # used to compute the age of the data.
-        timestamp = self.received_data[-1][b"timestamp"]
         timenow = time.time()
         self.statusBar().showMessage(
             "Estimated delay: {0} seconds".format(round(timenow - timestamp, 6))
@@ -17,19 +17,307 @@
 Utility functions for HDF5 files.
 
 This module contains utility functions that manipulate HDF5 files (load whole or
-partial data blocks, write to normal or VDS files, etc.).
+partial data blocks, write to normal or VDS files, etc.), and a reader that keeps a
+cache of open HDF5 files.
 """
 from __future__ import absolute_import, division, print_function
 
+import collections
+import os
 import sys
-from typing import Any  # pylint: disable=unused-import
+from typing import Any, List, Optional, Tuple  # pylint: disable=unused-import
 
 import h5py
+import numpy
 from future.utils import raise_from
 
 from onda.utils import exceptions
 
 
+class Hdf5Reader(object):
+    """
+    See documentation of the '__init__' function.
+    """
+
+    def __init__(self, max_open_files=16):
+        # type: (int) -> None
+        """
+        Cached reader of HDF5 files.
+
+        This class loads data blocks from HDF5 files, keeping the files open between
+        requests. A cache with a Least Recently Used (LRU) policy stores the handles of
+        the open files: when the number of open files exceeds the maximum size of the
+        cache, the file that has not been accessed for the longest time is closed.
+        Multiple data blocks, or multiple portions of the same data block, can be
+        loaded with a single call, and data can be read directly into buffers provided
+        by the caller, without allocating new memory.
+
+        The reader can be used as a context manager: all the files still open are
+        closed when the context is left.
+
+        Arguments:
+
+            max_open_files (int): the maximum number of HDF5 files that can be kept
+                open at the same time. Defaults to 16.
+        """
+        self._max_open_files = max(1, max_open_files)
+        self._file_handles = collections.OrderedDict()  # type: Any
+
+    def __enter__(self):
+        # type: () -> Hdf5Reader
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # type: (Any, Any, Any) -> None
+        self.close()
+
+    def close(self):
+        # type: () -> None
+        """
+        Closes all the HDF5 files currently kept open by the reader.
+        """
+        while self._file_handles:
+            _, fhandle = self._file_handles.popitem()
+            fhandle.close()
+
+    def get_data_block(self, hdf5_filename, hdf5_path):
+        # type: (str, str) -> Any
+        """
+        Gets a data block from an HDF5 file, without loading its content.
+
+        This function returns an object that gives access to the properties of a data
+        block (shape, data type, chunk layout, compression, etc.). The object is only
+        valid as long as the HDF5 file is kept open by the reader.
+
+        Arguments:
+
+            hdf_filename (str): the relative or absolute path to an HDF5 file
+                containing the data block.
+
+            hdf5_path (str): the internal HDF5 path to the data block.
+
+        Returns:
+
+            h5py.Dataset: the data block.
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaHdf5FileReadingError`: if any error
+                occurs while accessing the data block.
+        """
+        try:
+            return self._get_file_handle(hdf5_filename)[hdf5_path]
+        except (IOError, OSError, KeyError) as exc:
+            _raise_hdf5_reading_error(hdf5_filename, exc)
+
+    def load_data(self, hdf5_filename, hdf5_path, selection=None):
+        # type: (str, str, Optional[Tuple[slice]]) -> Any
+        """
+        Loads a data block from an HDF5 file.
+
+        This function works like the :func:`load_hdf5_data` function, but the HDF5
+        file is not closed after the data is read.
+
+        Arguments:
+
+            hdf_filename (str): the relative or absolute path to an HDF5 file
+                containing the data to load.
+
+            hdf5_path (str): the internal HDF5 path to the data block to load.
+
+            selection (Optional[Tuple[slice]]): the portion of content of the data
+                block to load, expressed as a list of slices along the axes of the
+                block. If this argument is None, the whole content of the data block
+                will be loaded. Defaults to None.
+
+        Returns:
+
+            Any: the data loaded from the HDF5 file.
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaHdf5FileReadingError`: if any error
+                occurs while reading the data from the file.
+        """
+        return self.load_multiple_data(
+            hdf5_filename=hdf5_filename, data_blocks=[(hdf5_path, selection)]
+        )[0]
+
+    def load_multiple_data(self, hdf5_filename, data_blocks):
+        # type: (str, List[Tuple[str, Optional[Tuple[slice]]]]) -> List[Any]
+        """
+        Loads several data blocks from an HDF5 file.
+
+        This function loads, with a single call, several data blocks, or several
+        portions of the same data block, from an HDF5 file.
+
+        Arguments:
+
+            hdf_filename (str): the relative or absolute path to an HDF5 file
+                containing the data to load.
+
+            data_blocks (List[Tuple[str, Optional[Tuple[slice]]]]): a list describing
+                the data to load. Each entry in the list is a tuple with two fields:
+
+                * The first field is the internal HDF5 path to a data block.
+
+                * The second field is the portion of content of the data block to
+                  load, expressed as a list of slices along the axes of the block, or
+                  None, if the whole content of the data block must be loaded.
+
+        Returns:
+
+            List[Any]: a list with the data loaded from the HDF5 file, in the same
+            order as the entries in the data_blocks argument.
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaHdf5FileReadingError`: if any error
+                occurs while reading the data from the file.
+        """
+        try:
+            fhandle = self._get_file_handle(hdf5_filename)
+            data = []  # type: List[Any]
+            for hdf5_path, selection in data_blocks:
+                if selection is None:
+                    data.append(fhandle[hdf5_path][:])
+                else:
+                    # TODO: Add boundary checks.
+                    data.append(fhandle[hdf5_path][selection])
+            return data
+        except (IOError, OSError, KeyError) as exc:
+            _raise_hdf5_reading_error(hdf5_filename, exc)
+
+    def read_data_into(self, hdf5_filename, hdf5_path, out, selection=None):
+        # type: (str, str, numpy.ndarray, Optional[Tuple[slice]]) -> numpy.ndarray
+        """
+        Reads a data block from an HDF5 file into an existing buffer.
+
+        This function reads the content of a data block, or a portion of it, directly
+        into a numpy array provided by the caller, without allocating any memory.
+
+        Arguments:
+
+            hdf_filename (str): the relative or absolute path to an HDF5 file
+                containing the data to load.
+
+            hdf5_path (str): the internal HDF5 path to the data block to load.
+
+            out (numpy.ndarray): a C-contiguous numpy array where the data will be
+                stored. The array must have the same shape as the data being read.
+
+            selection (Optional[Tuple[slice]]): the portion of content of the data
+                block to read, expressed as a list of slices along the axes of the
+                block. If this argument is None, the whole content of the data block
+                will be read. Defaults to None.
+
+        Returns:
+
+            numpy.ndarray: the buffer provided in the 'out' argument.
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaHdf5FileReadingError`: if any error
+                occurs while reading the data from the file.
+        """
+        try:
+            fhandle = self._get_file_handle(hdf5_filename)
+            if selection is None:
+                fhandle[hdf5_path].read_direct(out)
+            else:
+                fhandle[hdf5_path].read_direct(out, source_sel=selection)
+            return out
+        except (IOError, OSError, KeyError, TypeError) as exc:
+            _raise_hdf5_reading_error(hdf5_filename, exc)
+
+    def read_chunk_into(self, hdf5_filename, hdf5_path, chunk_offset, out):
+        # type: (str, str, Tuple[int, ...], numpy.ndarray) -> numpy.ndarray
+        """
+        Reads a chunk of a data block from an HDF5 file into an existing buffer.
+
+        This function reads a chunk of a chunked data block, bypassing the HDF5
+        library's data selection and chunk cache machinery. Only chunks of data blocks
+        stored without any filter (compression, shuffling, checksums, etc.) can be read
+        with this function.
+
+        Arguments:
+
+            hdf_filename (str): the relative or absolute path to an HDF5 file
+                containing the data to load.
+
+            hdf5_path (str): the internal HDF5 path to the data block to load.
+
+            chunk_offset (Tuple[int, ...]): the position of the first element of the
+                chunk in the data block, along each axis.
+
+            out (numpy.ndarray): a C-contiguous numpy array where the data will be
+                stored. The array must have the same shape and type as the chunk.
+
+        Returns:
+
+            numpy.ndarray: the buffer provided in the 'out' argument.
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaHdf5FileReadingError`: if any error
+                occurs while reading the data from the file, or if the chunk cannot be
+                read directly.
+        """
+        try:
+            dataset = self._get_file_handle(hdf5_filename)[hdf5_path]
+            if (
+                dataset.chunks is None
+                or dataset.id.get_create_plist().get_nfilters() != 0
+                or tuple(out.shape) != dataset.chunks
+                or out.dtype != dataset.dtype
+            ):
+                raise exceptions.OndaHdf5FileReadingError(
+                    "Cannot read a chunk of the {0} data block in the {1} HDF5 file "
+                    "directly into the provided buffer.".format(
+                        hdf5_path, hdf5_filename
+                    )
+                )
+            filter_mask, chunk = dataset.id.read_direct_chunk(tuple(chunk_offset))
+            if filter_mask != 0:
+                raise exceptions.OndaHdf5FileReadingError(
+                    "The chunk at offset {0} of the {1} data block in the {2} HDF5 file "
+                    "is stored with filters, and cannot be read directly.".format(
+                        tuple(chunk_offset), hdf5_path, hdf5_filename
+                    )
+                )
+            out.reshape(-1)[:] = numpy.frombuffer(chunk, dtype=dataset.dtype)
+            return out
+        except (IOError, OSError, KeyError, ValueError) as exc:
+            _raise_hdf5_reading_error(hdf5_filename, exc)
+
+    def _get_file_handle(self, hdf5_filename):
+        # type: (str) -> Any
+        # Returns the handle of an open HDF5 file, opening the file if needed and
+        # closing the least recently used file if the cache is full.
+        key = os.path.abspath(hdf5_filename)
+        fhandle = self._file_handles.pop(key, None)
+        if fhandle is None:
+            fhandle = h5py.File(name=hdf5_filename, mode="r")
+            if len(self._file_handles) >= self._max_open_files:
+                _, evicted_fhandle = self._file_handles.popitem(last=False)
+                evicted_fhandle.close()
+        self._file_handles[key] = fhandle
+        return fhandle
+
+
+def _raise_hdf5_reading_error(hdf5_filename, exc):
+    # type: (str, Exception) -> None
+    # Re-raises an error that occurred while reading an HDF5 file as an OnDA exception.
+    exc_type, exc_value = sys.exc_info()[:2]
+    raise_from(
+        exc=exceptions.OndaHdf5FileReadingError(
+            "The following error occurred while reading the {0} HDF5 "
+            "file: {1}: {2}".format(hdf5_filename, exc_type.__name__, exc_value)
+        ),
+        cause=exc,
+    )
+
+
 def load_hdf5_data(hdf5_filename, hdf5_path, selection=None):
     # type: (str, str, Opional[Tuple[slice]]) -> Any
     """
@@ -38,6 +326,8 @@ def load_hdf5_data(hdf5_filename, hdf5_path, selection=None):
     This function loads into memory the content of a data block located in an HDF5
     file. If the selection argument is provided, it defines the portion of the data
     block that will be read from the file, otherwise the whole block will be read.
+    The file is closed after the data has been read: the :class:`Hdf5Reader` class
+    should be used when several data blocks must be read from the same file.
 
     Arguments:
 
@@ -60,20 +350,7 @@ def load_hdf5_data(hdf5_filename, hdf5_path, selection=None):
         :class:`~onda.utils.exceptions.OndaHdf5FileReadingError`: if any error occurs
             while reading the data from the file.
     """
-    try:
-        with h5py.File(name=hdf5_filename, mode="r") as fhandle:
-            if selection is None:
-                data = fhandle[hdf5_path][:]
-            else:
-                # TODO: Add boundary checks.
-                data = fhandle[hdf5_path][selection]
-            return data
-    except (IOError, OSError, KeyError) as exc:
-        exc_type, exc_value = sys.exc_info()[:2]
-        raise_from(
-            exc=exceptions.OndaHdf5FileReadingError(
-                "The following error occurred while reading the {0} HDF5 "
-                "file: {1}: {2}".format(hdf5_filename, exc_type.__name__, exc_value)
-            ),
-            cause=exc,
+    with Hdf5Reader(max_open_files=1) as reader:
+        return reader.load_data(
+            hdf5_filename=hdf5_filename, hdf5_path=hdf5_path, selection=selection
         )
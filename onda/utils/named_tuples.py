@@ -29,14 +29,34 @@ Information about Bragg peaks found in a detector data frame (list of peaks).
 
 Arguments:
 
-    fs (List[float]): a list of fractional fs indexes locating the detected peaks
-        in the detector data frame.
+    fs (numpy.ndarray): the fractional fs indexes locating the detected peaks in the
+        detector data frame.
 
-    ss (List[float]): a list of fractional ss indexes locating the detected peaks
-        in the detector data frame.
+    ss (numpy.ndarray): the fractional ss indexes locating the detected peaks in the
+        detector data frame.
 
-    intensity (List[float]): a list of integrated intensities for the detected
-        peaks.
+    intensity (numpy.ndarray): the integrated intensities of the detected peaks.
+"""
+
+
+PeakListBatch = collections.namedtuple(
+    "PeakListBatch", ["frame_index", "fs", "ss", "intensity"]
+)
+"""
+Information about Bragg peaks found in a stack of detector data frames.
+
+Arguments:
+
+    frame_index (numpy.ndarray): the index, within the stack, of the frame in which
+        each peak was detected.
+
+    fs (numpy.ndarray): the fractional fs indexes locating the detected peaks in
+        their detector data frame.
+
+    ss (numpy.ndarray): the fractional ss indexes locating the detected peaks in
+        their detector data frame.
+
+    intensity (numpy.ndarray): the integrated intensities of the detected peaks.
 """
 
 
@@ -105,3 +125,18 @@ Arguments:
     node_rank (int): the rank, in the OnDA pool, of the worker node from which the data
         is transferred.
 """
+
+
+ColumnarData = collections.namedtuple("ColumnarData", ["columns", "metadata"])
+"""
+A batch of event data stored in columnar format.
+
+Arguments:
+
+    columns (Dict[str, numpy.ndarray]): a dictionary storing the data of the events in
+        the batch. Each entry in the dictionary stores a column of data, as a numpy
+        array.
+
+    metadata (Dict[str, Any]): a dictionary storing information that applies to all
+        the events in the batch.
+"""
@@ -0,0 +1,183 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Retrieval and prefetching of frame data.
+
+This module contains classes and functions that retrieve data from the frames of data
+events, optionally in the background, while the previously retrieved frames are being
+processed.
+"""
+from __future__ import absolute_import, division, print_function
+
+import sys
+import threading
+from typing import (  # pylint: disable=unused-import
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Optional,
+    Tuple,
+)
+
+from future.moves import queue
+from future.utils import raise_with_traceback
+
+from onda.utils import data_event, exceptions, timing  # pylint: disable=unused-import
+
+
+def generate_frame_data(
+    events,  # type: Iterable[data_event.DataEvent]
+    num_frames_in_event_to_process,  # type: Optional[int]
+    frames_in_event_to_skip,  # type: Tuple[int, ...]
+    stage_timer,  # type: timing.StageTimer
+    frame_must_be_skipped=None,  # type: Optional[Callable[[], bool]]
+):
+    # type: (...) -> Generator[Dict[str, Any], None, None]
+    """
+    Retrieves data from the frames of data events.
+
+    This function opens each data event, extracts data from the frames that must be
+    processed, and closes the event. Only the last 'num_frames_in_event_to_process'
+    frames in each event are processed. Frames from which data cannot be extracted are
+    skipped, after printing the error on the console.
+
+    Arguments:
+
+        events (Iterable[:class:`~onda.utils.data_event.DataEvent`]): the data events.
+
+        num_frames_in_event_to_process (Optional[int]): the number of frames, at the end
+            of each event, that must be processed. If this argument is None, all the
+            frames in the event are processed.
+
+        frames_in_event_to_skip (Tuple[int, ...]): the indexes of the frames that must
+            never be processed.
+
+        stage_timer (:class:`~onda.utils.timing.StageTimer`): the timer that measures
+            the time spent opening, closing and extracting data from the events.
+
+        frame_must_be_skipped (Optional[Callable[[], bool]]): a function called,
+            before extracting data from each frame, to decide whether the frame must
+            be skipped. If this argument is None, no frame is skipped. Defaults to
+            None.
+
+    Yields:
+
+        Dict[str, Any]: a dictionary storing the data extracted from a frame (see the
+        'extract_data' function of the :class:`~onda.utils.data_event.DataEvent`
+        class).
+    """
+    for event in events:
+        event.stage_timer = stage_timer
+        with stage_timer.stage("open_event"):
+            event.open_event()
+        n_frames_in_evt = event.get_num_frames_in_event()
+        if num_frames_in_event_to_process is not None:
+            num_frames_to_process = min(n_frames_in_evt, num_frames_in_event_to_process)
+        else:
+            num_frames_to_process = n_frames_in_evt
+        # Iterates over the last 'num_frames_to_process' frames in the event.
+        for frame_offset in range(-num_frames_to_process, 0):
+            current_frame = n_frames_in_evt + frame_offset
+            if current_frame in frames_in_event_to_skip:
+                continue
+            if frame_must_be_skipped is not None and frame_must_be_skipped():
+                continue
+            event.current_frame = current_frame
+            try:
+                data = event.extract_data()
+            except exceptions.OndaDataExtractionError as exc:
+                print(exc)
+                print("Skipping event...")
+                continue
+            yield data
+        with stage_timer.stage("close_event"):
+            event.close_event()
+
+
+class FramePrefetcher(object):
+    """
+    See documentation of the '__init__' function.
+    """
+
+    def __init__(self, frame_data, max_num_prefetched_frames, stage_timer):
+        # type: (Iterable[Dict[str, Any]], int, timing.StageTimer) -> None
+        """
+        Background prefetching of frame data.
+
+        This class retrieves frame data from an iterable (usually, the generator
+        returned by the :func:`generate_frame_data` function) in a background thread,
+        while the frames retrieved earlier are being processed. Retrieving data is
+        usually limited by I/O operations (reading files, receiving data over the
+        network), which do not prevent the processing code from running at the same
+        time. The prefetched frames are stored in a bounded queue, so that at most
+        'max_num_prefetched_frames' frames, plus the one being retrieved, are kept in
+        memory. The background thread waits when the queue is full.
+
+        An instance of this class is an iterator that yields the frame data in the
+        same order as the original iterable. Errors raised while retrieving the data
+        are raised again by the iterator. The time spent waiting for the prefetched
+        data is measured by the provided timer, as a stage named 'prefetch_wait'.
+        Since the original iterable is consumed in the background thread, any timer
+        that it uses must be different from the provided one (timers cannot be shared
+        between threads: see the :class:`~onda.utils.timing.StageTimer` class).
+
+        Arguments:
+
+            frame_data (Iterable[Dict[str, Any]]): the iterable that yields the frame
+                data.
+
+            max_num_prefetched_frames (int): the maximum number of frames that can be
+                retrieved in advance.
+
+            stage_timer (:class:`~onda.utils.timing.StageTimer`): the timer that
+                measures the time spent waiting for the prefetched data.
+        """
+        self._frame_data = frame_data
+        self._stage_timer = stage_timer
+        self._queue = queue.Queue(maxsize=max(1, max_num_prefetched_frames))
+        self._prefetching_thread = threading.Thread(target=self._prefetch)
+        self._prefetching_thread.daemon = True
+        self._prefetching_thread.start()
+
+    def __iter__(self):
+        # type: () -> FramePrefetcher
+        return self
+
+    def __next__(self):
+        # type: () -> Dict[str, Any]
+        with self._stage_timer.stage("prefetch_wait"):
+            item_type, item = self._queue.get()
+        if item_type == "data":
+            return item
+        if item_type == "error":
+            raise_with_traceback(item[1], item[2])
+        raise StopIteration
+
+    next = __next__  # Python 2 compatibility.
+
+    def _prefetch(self):
+        # type: () -> None
+        # Runs in the background thread: retrieves the frame data and puts it in the
+        # queue, followed by an end marker or by the error that stopped the retrieval.
+        try:
+            for data in self._frame_data:
+                self._queue.put(("data", data))
+        except Exception:  # pylint: disable=broad-except
+            self._queue.put(("error", sys.exc_info()))
+        else:
+            self._queue.put(("end", None))
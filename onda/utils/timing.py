@@ -0,0 +1,320 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Timing of the processing stages.
+
+This module contains classes and functions that measure how much time an OnDA monitor
+spends in each stage of the data processing.
+"""
+from __future__ import absolute_import, division, print_function
+
+import bisect
+import threading
+import timeit
+from typing import Any, Dict, List  # pylint: disable=unused-import
+
+from future.utils import iteritems
+
+
+# Upper edges (in seconds) of the bins of the timing histograms: eight bins per decade,
+# from 1 microsecond to 100 seconds. Longer durations fall in an additional last bin.
+STAGE_TIMING_BIN_EDGES = [10.0 ** (exponent / 8.0) for exponent in range(-48, 17)]
+
+
+class _StageContext(object):
+    # Context manager that measures the duration of a stage and adds it to the
+    # histogram of the stage. The lock protects the histograms of the timer that owns
+    # the context.
+
+    def __init__(self, histogram, lock):
+        # type: (Dict[str, Any], Any) -> None
+        self._histogram = histogram
+        self._lock = lock
+        self._start_time = 0.0
+
+    def __enter__(self):
+        # type: () -> None
+        self._start_time = timeit.default_timer()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # type: (Any, Any, Any) -> None
+        duration = timeit.default_timer() - self._start_time
+        with self._lock:
+            _add_measurement(histogram=self._histogram, duration=duration)
+
+
+class _NullContext(object):
+    # Context manager that does nothing, used when the timing is disabled.
+
+    def __enter__(self):
+        # type: () -> None
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # type: (Any, Any, Any) -> None
+        pass
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class StageTimer(object):
+    """
+    See documentation of the '__init__' function.
+    """
+
+    def __init__(self, enabled=True):
+        # type: (bool) -> None
+        """
+        Timer for the stages of the data processing.
+
+        This class measures the duration of named processing stages, and accumulates
+        the measurements into a histogram for each stage. The bins of the histograms
+        are logarithmically spaced, with upper edges given by the
+        STAGE_TIMING_BIN_EDGES list. A stage is timed by wrapping it in the context
+        manager returned by the :func:`stage` function:
+
+        .. code-block:: python
+
+            with stage_timer.stage("peak_finding"):
+                peak_list = peak_detection.find_peaks(data)
+
+        When the timer is disabled, the context manager does nothing, and the
+        overhead of the timing is negligible.
+
+        The stages timed by a timer must all run in the same thread, because the
+        context manager returned for each stage is reused. A thread that runs in the
+        background (for example, the one that prefetches frame data) must use its own
+        timer. The report of a timer, however, can be safely retrieved from any thread
+        (see the :func:`pop_report` function), and the reports of several timers can
+        be combined with the :func:`merge_stage_timing_reports` function.
+
+        Arguments:
+
+            enabled (bool): whether the timer actually measures the durations of the
+                stages. Defaults to True.
+
+        Attributes:
+
+            enabled (bool): whether the timer actually measures the durations of the
+                stages.
+        """
+        self.enabled = enabled
+        self._histograms = {}  # type: Dict[str, Dict[str, Any]]
+        self._contexts = {}  # type: Dict[str, _StageContext]
+        self._lock = threading.Lock()
+
+    def stage(self, stage_name):
+        # type: (str) -> Any
+        """
+        Returns a context manager that times a stage.
+
+        Arguments:
+
+            stage_name (str): the name of the stage.
+
+        Returns:
+
+            Any: a context manager that, on exit, adds the time spent within it to the
+            histogram of the stage.
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        try:
+            return self._contexts[stage_name]
+        except KeyError:
+            context = _StageContext(
+                histogram=self._get_histogram(stage_name), lock=self._lock
+            )
+            self._contexts[stage_name] = context
+            return context
+
+    def add_measurement(self, stage_name, duration):
+        # type: (str, float) -> None
+        """
+        Adds a duration, measured externally, to the histogram of a stage.
+
+        Arguments:
+
+            stage_name (str): the name of the stage.
+
+            duration (float): the duration of the stage, in seconds.
+        """
+        if self.enabled:
+            histogram = self._get_histogram(stage_name)
+            with self._lock:
+                _add_measurement(histogram=histogram, duration=duration)
+
+    def pop_report(self):
+        # type: () -> Dict[str, Dict[str, Any]]
+        """
+        Returns the histograms accumulated so far, and resets them.
+
+        This function can be called from any thread, including one that is not timing
+        the stages.
+
+        Returns:
+
+            Dict[str, Dict[str, Any]]: a dictionary whose keys are the names of the
+            stages that have been timed at least once, and whose values are
+            dictionaries describing the histograms of the stages. Each of them has the
+            following keys:
+
+            * 'counts': a list with the number of measurements in each bin. The list
+              has one more entry than the STAGE_TIMING_BIN_EDGES list.
+
+            * 'num_measurements': the total number of measurements.
+
+            * 'total_time': the sum of the measurements, in seconds.
+
+            * 'max_time': the longest measurement, in seconds.
+        """
+        with self._lock:
+            report = {
+                stage_name: dict(histogram)
+                for stage_name, histogram in iteritems(self._histograms)
+                if histogram["num_measurements"] > 0
+            }
+            for histogram in self._histograms.values():
+                _reset_histogram(histogram)
+
+        return report
+
+    def _get_histogram(self, stage_name):
+        # type: (str) -> Dict[str, Any]
+        # Returns the histogram of a stage, creating it if needed.
+        try:
+            return self._histograms[stage_name]
+        except KeyError:
+            with self._lock:
+                if stage_name not in self._histograms:
+                    histogram = {}  # type: Dict[str, Any]
+                    _reset_histogram(histogram)
+                    self._histograms[stage_name] = histogram
+                return self._histograms[stage_name]
+
+
+def merge_stage_timing_reports(reports):
+    # type: (List[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]
+    """
+    Merges several stage timing reports.
+
+    Arguments:
+
+        reports (List[Dict[str, Dict[str, Any]]]): a list of reports, as returned by
+            the :func:`StageTimer.pop_report` function.
+
+    Returns:
+
+        Dict[str, Dict[str, Any]]: a report, in the same format, whose histograms
+        contain the measurements from all the merged reports.
+    """
+    merged_report = {}  # type: Dict[str, Dict[str, Any]]
+    for report in reports:
+        for stage_name, histogram in iteritems(report):
+            if stage_name not in merged_report:
+                merged_report[stage_name] = {}
+                _reset_histogram(merged_report[stage_name])
+            merged_histogram = merged_report[stage_name]
+            merged_histogram["counts"] = [
+                merged_count + count
+                for merged_count, count in zip(
+                    merged_histogram["counts"], histogram["counts"]
+                )
+            ]
+            merged_histogram["num_measurements"] += histogram["num_measurements"]
+            merged_histogram["total_time"] += histogram["total_time"]
+            merged_histogram["max_time"] = max(
+                merged_histogram["max_time"], histogram["max_time"]
+            )
+
+    return merged_report
+
+
+def format_stage_timing_report(report):
+    # type: (Dict[str, Dict[str, Any]]) -> str
+    """
+    Formats a stage timing report for printing.
+
+    For each stage, the report lists the number of measurements, and the mean, median,
+    95th percentile and maximum of the measured durations, in milliseconds. The median
+    and the percentile are estimated from the histograms (as the geometric center of
+    the bin where they fall).
+
+    Arguments:
+
+        report (Dict[str, Dict[str, Any]]): a report, as returned by the
+            :func:`StageTimer.pop_report` function.
+
+    Returns:
+
+        str: a multi-line string with one line for each stage.
+    """
+    lines = ["Stage timings (ms): mean / median / 95th percentile / max (count)"]
+    for stage_name, histogram in sorted(iteritems(report)):
+        num_measurements = histogram["num_measurements"]
+        lines.append(
+            "    {0}: {1:.3f} / {2:.3f} / {3:.3f} / {4:.3f} ({5})".format(
+                stage_name,
+                1000.0 * histogram["total_time"] / num_measurements,
+                1000.0 * _get_percentile(histogram=histogram, percentile=50.0),
+                1000.0 * _get_percentile(histogram=histogram, percentile=95.0),
+                1000.0 * histogram["max_time"],
+                num_measurements,
+            )
+        )
+
+    return "\n".join(lines)
+
+
+def _add_measurement(histogram, duration):
+    # type: (Dict[str, Any], float) -> None
+    # Adds a measurement to a histogram.
+    histogram["counts"][bisect.bisect_left(STAGE_TIMING_BIN_EDGES, duration)] += 1
+    histogram["num_measurements"] += 1
+    histogram["total_time"] += duration
+    if duration > histogram["max_time"]:
+        histogram["max_time"] = duration
+
+
+def _reset_histogram(histogram):
+    # type: (Dict[str, Any]) -> None
+    # Empties a histogram, in place.
+    histogram["counts"] = [0] * (len(STAGE_TIMING_BIN_EDGES) + 1)
+    histogram["num_measurements"] = 0
+    histogram["total_time"] = 0.0
+    histogram["max_time"] = 0.0
+
+
+def _get_percentile(histogram, percentile):
+    # type: (Dict[str, Any], float) -> float
+    # Estimates a percentile of the measurements in a histogram, as the geometric
+    # center of the bin where the percentile falls. The estimate never exceeds the
+    # maximum measurement, which also represents the measurements beyond the last edge.
+    threshold = histogram["num_measurements"] * percentile / 100.0
+    cumulative_count = 0
+    for bin_index, count in enumerate(histogram["counts"]):
+        cumulative_count += count
+        if cumulative_count >= threshold and count > 0:
+            if 0 < bin_index < len(STAGE_TIMING_BIN_EDGES):
+                bin_center = (
+                    STAGE_TIMING_BIN_EDGES[bin_index - 1]
+                    * STAGE_TIMING_BIN_EDGES[bin_index]
+                ) ** 0.5
+                return min(bin_center, histogram["max_time"])
+            break
+
+    return histogram["max_time"]
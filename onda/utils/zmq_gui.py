@@ -21,15 +21,18 @@ data broadcasted by an OnDA monitor over a network connection.
 """
 from __future__ import absolute_import, division, print_function
 
+import zlib
 from builtins import str as unicode_str
 
-from typing import Optional  # pylint: disable=unused-import
+from typing import Any, Dict, List, Optional  # pylint: disable=unused-import
 
 import msgpack
 import msgpack_numpy
 import numpy
 import zmq
 
+from onda.utils import named_tuples
+
 try:
     from PyQt5 import QtCore
 except ImportError:
@@ -42,11 +45,13 @@ class ZmqDataListener(QtCore.QObject):
     See documentation for the '__init__' function.
     """
 
-    zmqmessage = QtCore.pyqtSignal(list)
+    zmqmessage = QtCore.pyqtSignal(object)
     """
     A Qt signal emitted when a message is received.
 
-    The signal brings the received data as payload.
+    The signal brings the received data as payload: a list of event data entries or,
+    for data broadcasted in columnar format, a
+    :class:`~onda.utils.named_tuples.ColumnarData` named tuple.
     """
 
     def __init__(self, hostname, port, tag):
@@ -56,10 +61,10 @@ class ZmqDataListener(QtCore.QObject):
 
         This class implements a ZMQ SUB socket that can be used to receive data. The
         socket receives and filters data tagged with a label, and has no queuing
-        system. It receives messages that follow the MessagePack protocol. This class
-        is designed to be run in a separate Qt thread. Every time a message is
-        received, this class emits a custom Qt signal that carries the received data as
-        payload.
+        system. It receives messages that follow the MessagePack protocol, or data in
+        columnar format, which is decoded without copying. This class is designed to
+        be run in a separate Qt thread. Every time a message is received, this class
+        emits a custom Qt signal that carries the received data as payload.
 
         Arguments:
 
@@ -132,14 +137,83 @@ class ZmqDataListener(QtCore.QObject):
         # Listens for data and emits a signal when data is received.
         socks = dict(self._zmq_poller.poll(0))
         if self._zmq_subscribe in socks and socks[self._zmq_subscribe] == zmq.POLLIN:
-            full_msg = self._zmq_subscribe.recv_multipart()
-            msgpack_msg = full_msg[1]
-
-            # Deserializes the message and emits the signal.
-            msg = msgpack.unpackb(msgpack_msg)
+            full_msg = self._zmq_subscribe.recv_multipart(copy=False)
+            if len(full_msg) > 2:
+                # Messages with more than two parts store data in columnar format
+                # (see the 'send_columnar_data' function in the
+                # onda.utils.zmq_monitor module). The columns are not copied: numpy
+                # arrays are created directly on top of the received buffers.
+                msg = _decode_columnar_message(full_msg[1:])
+            else:
+                # Deserializes the message, decoding the data frames encoded by the
+                # FrameEncoder class of the onda.utils.zmq_monitor module.
+                msg = _decode_frames(msgpack.unpackb(full_msg[1].bytes))
             self.zmqmessage.emit(msg)
 
 
+def _decode_columnar_message(message_parts):
+    # type: (List[Any]) -> named_tuples.ColumnarData
+    # Decodes a message in columnar format: a MessagePack header, followed by the raw
+    # content of each column.
+    header = msgpack.unpackb(message_parts[0].bytes, raw=False)
+    columns = {}
+    for (name, dtype, shape), part in zip(header["columns"], message_parts[1:]):
+        if numpy.prod(shape) == 0:
+            columns[name] = numpy.empty(shape, dtype=dtype)
+        else:
+            columns[name] = numpy.frombuffer(part.buffer, dtype=dtype).reshape(shape)
+    return named_tuples.ColumnarData(columns=columns, metadata=header["metadata"])
+
+
+def _decode_frames(message):
+    # type: (Any) -> Any
+    # Replaces, in each event data entry of a message, the encoded data frames with
+    # the decoded ones.
+    if not isinstance(message, list):
+        return message
+    for entry in message:
+        if not isinstance(entry, dict):
+            continue
+        for key, value in entry.items():
+            if isinstance(value, dict) and (
+                b"onda_frame_encoding" in value or "onda_frame_encoding" in value
+            ):
+                entry[key] = _decode_frame(value)
+    return message
+
+
+def _decode_frame(encoded_frame):
+    # type: (Dict[Any, Any]) -> numpy.ndarray
+    # Decodes a data frame encoded by the FrameEncoder class of the
+    # onda.utils.zmq_monitor module. Depending on the version of MessagePack, the
+    # strings in the message might be received as bytes.
+    fields = {}
+    for key, value in encoded_frame.items():
+        if isinstance(key, bytes):
+            key = key.decode()
+        if isinstance(value, bytes) and key != "data":
+            value = value.decode()
+        fields[key] = value
+    raw_data = fields["data"]
+    if fields["compression"] == "zlib":
+        raw_data = zlib.decompress(raw_data)
+    frame = numpy.frombuffer(raw_data, dtype=fields["payload_dtype"]).reshape(
+        fields["payload_shape"]
+    )
+    if fields["onda_frame_encoding"] == "int16":
+        # Pixels with non-finite values are stored as a sentinel value.
+        non_finite_pixels = frame == fields["non_finite_value"]
+        frame = frame * numpy.float32(fields["scale"]) + numpy.float32(fields["offset"])
+        frame[non_finite_pixels] = numpy.nan
+    bin_size = fields["bin_size"]
+    if bin_size > 1:
+        shape = fields["shape"]
+        frame = numpy.repeat(numpy.repeat(frame, bin_size, axis=0), bin_size, axis=1)[
+            : shape[0], : shape[1]
+        ]
+    return frame
+
+
 def _patched_encode(obj, chain=None):
     # This function is the 'encode' function from msgpack-numpy, patched to use the
     # 'tobytes' method as opposed to the 'data' one. This is needed for python 2
@@ -21,24 +21,29 @@ to external programs over a network connection.
 """
 from __future__ import absolute_import, division, print_function
 
+import collections
 import socket
 import sys
+import threading
+import zlib
 
-from typing import Optional  # pylint: disable=unused-import
+from typing import Any, Callable, Dict, Optional, Tuple  # pylint: disable=unused-import
 
 import msgpack
 import msgpack_numpy
 import numpy
 import zmq
 
+from onda.utils import exceptions
+
 
 class ZmqDataBroadcaster(object):
     """
     See documentation of the '__init__' function.
     """
 
-    def __init__(self, hostname=None, port=None):
-        # type: (Optional[str], Optional[int]) -> None
+    def __init__(self, hostname=None, port=None, max_queue_size=16):
+        # type: (Optional[str], Optional[int], int) -> None
         """
         ZMQ-based data-broadcasting socket for OnDA monitors.
 
@@ -48,6 +53,14 @@ class ZmqDataBroadcaster(object):
         data that has not been picked up by a receiver will be lost when the next
         broadcast takes place.
 
+        The data is not encoded and sent immediately, but handed over to a background
+        thread through a queue, so that the broadcasting functions return without
+        waiting. When the queue is full, the oldest message in it is dropped to make
+        room for the new one. Messages that cannot be encoded or sent are dropped as
+        well. The data must not be modified after it has been handed over to the
+        broadcaster: data stored in reused buffers must be copied before it is handed
+        over.
+
         Args:
 
             hostname (Optional[str]): the hostname or IP address where the socket will
@@ -55,6 +68,9 @@ class ZmqDataBroadcaster(object):
 
             port(Optional[int]): the port where the socket will be opened. If None, the
                 socket will be opened at port 12321. Defaults to None.
+
+            max_queue_size (int): the maximum number of messages waiting to be sent.
+                Defaults to 16.
         """
         self._context = zmq.Context()
         self._sock = self._context.socket(zmq.PUB)  # pylint: disable=no-member
@@ -79,13 +95,23 @@ class ZmqDataBroadcaster(object):
         print("Broadcasting data at {0}:{1}".format(bhostname, bport))
         sys.stdout.flush()
 
+        # After this point, the socket is only used by the sender thread.
+        self._max_queue_size = max(1, max_queue_size)
+        self._queue = collections.deque()  # type: Any
+        self._queue_condition = threading.Condition()
+        self._num_dropped_messages = 0
+        self._sender_thread = threading.Thread(target=self._send_queued_messages)
+        self._sender_thread.daemon = True
+        self._sender_thread.start()
+
     def send_data(self, tag, message):
         # type (str, Hashable) -> None
         """
         Broadcasts data from the ZMQ PUB socket.
 
         This function broadcasts the data in the form of a MessagePack object. The data
-        must be tagged with a label.
+        must be tagged with a label. The data is encoded and sent by a background
+        thread: this function returns immediately.
 
         Arguments:
 
@@ -93,9 +119,285 @@ class ZmqDataBroadcaster(object):
 
             message (Any): a MessagePack-compatible python object.
         """
-        self._sock.send(tag.encode(), zmq.SNDMORE)
+        self._enqueue_message(self._send_msgpack_message, (tag, message))
+
+    def send_columnar_data(self, tag, columns, metadata):
+        # type: (str, Dict[str, numpy.ndarray], Dict[str, Any]) -> None
+        """
+        Broadcasts data in columnar format from the ZMQ PUB socket.
+
+        This function broadcasts a batch of data stored as a set of columns, each of
+        them a numpy array, as a multipart ZMQ message. The first part of the message
+        is the label attached to the data. The second part is a MessagePack header,
+        storing the metadata of the batch and, for each column, its name, type and
+        shape. Each of the remaining parts stores the raw content of one column, in
+        the same order as in the header. The content of the columns is not copied
+        when the message is sent. The data must be tagged with a label. The data is
+        encoded and sent by a background thread: this function returns immediately.
+
+        Arguments:
+
+            tag (str): the label that will be attached to the broadcasted data.
+
+            columns (Dict[str, numpy.ndarray]): a dictionary storing the columns of
+                data to broadcast. At least one column must be present.
+
+            metadata (Dict[str, Any]): a dictionary with information that applies to
+                the whole batch. Its content must be MessagePack-compatible.
+        """
+        self._enqueue_message(self._send_columnar_message, (tag, columns, metadata))
+
+    def get_num_dropped_messages(self):
+        # type: () -> int
+        """
+        Returns the number of messages that were dropped.
+
+        Messages are dropped when the queue is full, or when they cannot be encoded or
+        sent.
+
+        Returns:
+
+            int: the number of messages dropped since the broadcaster was created.
+        """
+        return self._num_dropped_messages
+
+    def _enqueue_message(self, send_func, arguments):
+        # type: (Callable, Tuple[Any, ...]) -> None
+        # Hands a message over to the sender thread, dropping the oldest message in
+        # the queue if the queue is full.
+        with self._queue_condition:
+            if len(self._queue) >= self._max_queue_size:
+                self._queue.popleft()
+                self._num_dropped_messages += 1
+            self._queue.append((send_func, arguments))
+            self._queue_condition.notify()
+
+    def _send_queued_messages(self):
+        # type: () -> None
+        # Runs in the sender thread: waits for messages and sends them. A message that
+        # cannot be encoded or sent is dropped, so that the thread keeps running.
+        while True:
+            with self._queue_condition:
+                while not self._queue:
+                    self._queue_condition.wait()
+                send_func, arguments = self._queue.popleft()
+            try:
+                send_func(*arguments)
+            except Exception as exc:  # pylint: disable=broad-except
+                with self._queue_condition:
+                    self._num_dropped_messages += 1
+                print(
+                    "OnDA Warning: Cannot broadcast a message with tag {0}: {1}".format(
+                        arguments[0], exc
+                    )
+                )
+                sys.stdout.flush()
+
+    def _send_msgpack_message(self, tag, message):
+        # type: (str, Any) -> None
+        # Encodes a message using MessagePack and sends it. The message is encoded
+        # before anything is sent, so that no partial message is left in the socket if
+        # the encoding fails.
         msgpack_message = msgpack.packb(message)
-        self._sock.send(msgpack_message)
+        self._sock.send(tag.encode(), zmq.SNDMORE)
+        self._sock.send(msgpack_message, copy=False)
+
+    def _send_columnar_message(self, tag, columns, metadata):
+        # type: (str, Dict[str, numpy.ndarray], Dict[str, Any]) -> None
+        # Encodes the header of a message in columnar format and sends it, together
+        # with the content of the columns.
+        column_arrays = [numpy.ascontiguousarray(column) for column in columns.values()]
+        header = msgpack.packb(
+            {
+                "metadata": metadata,
+                "columns": [
+                    [name, array.dtype.str, list(array.shape)]
+                    for name, array in zip(columns.keys(), column_arrays)
+                ],
+            },
+            use_bin_type=True,
+        )
+        self._sock.send(tag.encode(), zmq.SNDMORE)
+        self._sock.send(header, zmq.SNDMORE)
+        for array in column_arrays[:-1]:
+            self._sock.send(array, zmq.SNDMORE, copy=False)
+        self._sock.send(column_arrays[-1], copy=False)
+
+
+# The value used by the 'int16' frame encoding for pixels with non-finite values.
+_INT16_NON_FINITE_VALUE = -32768
+
+
+class FrameEncoder(object):
+    """
+    See documentation of the '__init__' function.
+    """
+
+    def __init__(self, encoding="float32", bin_size=1, compression_level=0):
+        # type: (str, int, int) -> None
+        """
+        Encoding of detector data frames for broadcasting.
+
+        This class reduces the size of detector data frames before they are
+        broadcasted. A frame can be binned (each block of NxN pixels is replaced by
+        the average of its values), converted to a different data type, and
+        compressed with a fast lossless compressor (zlib). All the information needed
+        to decode the frame is stored together with the encoded data, and the frames
+        are automatically decoded, to their original shape, by the
+        :class:`~onda.utils.zmq_gui.ZmqDataListener` class.
+
+        The following data type conversions are supported:
+
+        * 'none': the data type of the frame is not changed.
+
+        * 'float32': the frame is converted to 32-bit floating point values.
+
+        * 'int16': the frame is quantized to 16-bit integers, linearly mapping the
+          range of the finite values in the frame to the range of 16-bit integers.
+          The smallest 16-bit integer is reserved for pixels with non-finite values
+          (NaN or infinity), which are decoded as NaN.
+
+        Arguments:
+
+            encoding (str): the data type conversion applied to the frame. Defaults to
+                'float32'.
+
+            bin_size (int): the size of the side of the blocks of pixels that are
+                binned together. If this argument is 1, the frame is not binned.
+                Defaults to 1.
+
+            compression_level (int): the zlib compression level, from 1 (fastest) to
+                9 (smallest). If this argument is 0, the frame is not compressed.
+                Defaults to 0.
+
+        Raises:
+
+            :class:`~onda.utils.exceptions.OndaUnsupportedFrameEncodingError`: if the
+                requested encoding is not supported.
+        """
+        if encoding not in ("none", "float32", "int16"):
+            raise exceptions.OndaUnsupportedFrameEncodingError(
+                "Frame encoding {0} is not supported.".format(encoding)
+            )
+        if bin_size < 1 or not 0 <= compression_level <= 9:
+            raise exceptions.OndaUnsupportedFrameEncodingError(
+                "Frame binning size {0} or compression level {1} is not "
+                "supported.".format(bin_size, compression_level)
+            )
+        self._encoding = encoding
+        self._bin_size = bin_size
+        self._compression_level = compression_level
+
+    def encode_frame(self, data):
+        # type: (numpy.ndarray) -> Dict[str, Any]
+        """
+        Encodes a detector data frame.
+
+        Arguments:
+
+            data (numpy.ndarray): the two-dimensional data frame to encode.
+
+        Returns:
+
+            Dict[str, Any]: a MessagePack-compatible dictionary storing the encoded
+            frame and the information needed to decode it.
+        """
+        encoded_frame = {
+            "onda_frame_encoding": self._encoding,
+            "shape": list(data.shape),
+            "bin_size": self._bin_size,
+        }  # type: Dict[str, Any]
+
+        if self._bin_size > 1:
+            # The frame is padded, repeating the values at the edges, so that its
+            # size is a multiple of the binning size along both axes.
+            bin_size = self._bin_size
+            data = numpy.pad(
+                data,
+                [(0, -axis_size % bin_size) for axis_size in data.shape],
+                mode="edge",
+            )
+            # Blocks containing both positive and negative infinities are averaged
+            # to NaN.
+            with numpy.errstate(invalid="ignore"):
+                data = data.reshape(
+                    data.shape[0] // bin_size,
+                    bin_size,
+                    data.shape[1] // bin_size,
+                    bin_size,
+                ).mean(axis=(1, 3), dtype=numpy.float32)
+
+        if self._encoding == "float32":
+            payload = numpy.ascontiguousarray(data, dtype=numpy.float32)
+        elif self._encoding == "int16":
+            data = numpy.asarray(data, dtype=numpy.float32)
+            # The range of the values is computed from the finite pixels only, so
+            # that a single infinite pixel does not flatten the rest of the frame.
+            # The non-finite pixels are stored as a sentinel value, outside of the
+            # range used for the finite ones.
+            finite_pixels = numpy.isfinite(data)
+            if finite_pixels.all():
+                finite_data = data
+            else:
+                finite_data = data[finite_pixels]
+            minimum = float(finite_data.min()) if finite_data.size else 0.0
+            maximum = float(finite_data.max()) if finite_data.size else 0.0
+            scale = (maximum - minimum) / 65534.0 if maximum > minimum else 1.0
+            # Values are decoded as payload * scale + offset.
+            offset = minimum + 32767.0 * scale
+            with numpy.errstate(invalid="ignore"):
+                payload = numpy.rint((data - offset) / scale)
+                payload = numpy.clip(payload, -32767, 32767, out=payload)
+            payload[~finite_pixels] = _INT16_NON_FINITE_VALUE
+            payload = payload.astype(numpy.int16)
+            encoded_frame["scale"] = scale
+            encoded_frame["offset"] = offset
+            encoded_frame["non_finite_value"] = _INT16_NON_FINITE_VALUE
+        else:
+            payload = numpy.ascontiguousarray(data)
+
+        encoded_frame["payload_dtype"] = payload.dtype.str
+        encoded_frame["payload_shape"] = list(payload.shape)
+        if self._compression_level > 0:
+            encoded_frame["compression"] = "zlib"
+            encoded_frame["data"] = zlib.compress(
+                payload.tobytes(), self._compression_level
+            )
+        else:
+            encoded_frame["compression"] = None
+            encoded_frame["data"] = payload.tobytes()
+        return encoded_frame
+
+    def defer_encoding(self, data):
+        # type: (numpy.ndarray) -> Any
+        """
+        Marks a detector data frame for encoding at broadcasting time.
+
+        The returned object can be included in a message sent with the 'send_data'
+        function of the :class:`ZmqDataBroadcaster` class. The frame is then encoded
+        by the broadcaster's background thread, when the message is serialized.
+
+        Arguments:
+
+            data (numpy.ndarray): the two-dimensional data frame to encode.
+
+        Returns:
+
+            Any: an object that is replaced by the encoded frame when the message is
+            serialized.
+        """
+        return _DeferredFrameEncoding(encoder=self, data=data)
+
+
+class _DeferredFrameEncoding(object):
+    # A data frame waiting to be encoded. This is not a named tuple, because
+    # MessagePack would serialize it as a list, without encoding the frame.
+    __slots__ = ("encoder", "data")
+
+    def __init__(self, encoder, data):
+        # type: (FrameEncoder, numpy.ndarray) -> None
+        self.encoder = encoder
+        self.data = data
 
 
 def _patched_encode(obj, chain=None):
@@ -122,6 +424,8 @@ def _patched_encode(obj, chain=None):
         return {b"nd": False, b"type": obj.dtype.str, b"data": obj.tobytes()}
     elif isinstance(obj, complex):
         return {b"complex": True, b"data": obj.__repr__()}
+    elif isinstance(obj, _DeferredFrameEncoding):
+        return obj.encoder.encode_frame(obj.data)
     else:
         return obj if chain is None else chain(obj)
 
@@ -0,0 +1,147 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Check and benchmark for the Agipd1MCalibration algorithm.
+
+This script writes a file with synthetic AGIPD 1M calibration constants, calibrates
+synthetic frames with the Agipd1MCalibration algorithm, and checks the result against
+the numpy.choose/numpy.median expression that the algorithm originally used. The time
+needed to calibrate a frame with both methods is then reported. Usage:
+python benchmark_agipd_calibration.py [--num-frames N]
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import timeit
+
+import click
+import h5py
+import numpy
+
+from onda.algorithms import calibration_algorithms
+from onda.utils import named_tuples
+
+
+def _reference_calibration(data, gain, cell, constants):
+    # Calibrates a frame using the expression originally used by the
+    # Agipd1MCalibration algorithm, with the constants laid out as in the calibration
+    # file: (stage, cell, module, ss, fs).
+    gain_state = numpy.zeros_like(data, dtype=int)
+    gain = gain.reshape(16, 512, 128)
+    gain_state[gain > constants["DigitalGainLevel"][1, cell]] = 1
+    gain_state[gain > constants["DigitalGainLevel"][2, cell]] = 2
+    gain_offset_correction = (
+        data
+        - numpy.choose(
+            gain_state,
+            tuple(constants["AnalogOffset"][stage, cell] for stage in range(3)),
+        )
+    ) * numpy.choose(
+        gain_state, tuple(constants["RelativeGain"][stage, cell] for stage in range(3))
+    )
+    masked_image = gain_offset_correction * constants["DetectorMask"]
+    median_mask = numpy.median(masked_image, axis=(1, 2))
+    return (gain_offset_correction - median_mask[:, None, None]).reshape(8192, 128)
+
+
+@click.command()
+@click.option("--num-frames", default=10, help="Number of frames to calibrate.")
+def main(num_frames):
+    # type: (int) -> None
+    """
+    Check and benchmark for the Agipd1MCalibration algorithm.
+    """
+    random_state = numpy.random.RandomState(0)
+    cellid_list = [0, 2]
+    num_cells = 3
+    shape = (3, num_cells, 16, 512, 128)
+    thresholds = numpy.empty(shape, dtype=numpy.int16)
+    thresholds[0] = 0
+    thresholds[1] = random_state.randint(4000, 5000, size=shape[1:])
+    thresholds[2] = random_state.randint(8000, 9000, size=shape[1:])
+    constants = {
+        "AnalogOffset": random_state.randint(500, 6000, size=shape).astype(numpy.int16),
+        "DigitalGainLevel": thresholds,
+        "RelativeGain": random_state.uniform(0.5, 50.0, size=shape).astype(
+            numpy.float32
+        ),
+        "DetectorMask": (random_state.uniform(size=(16, 512, 128)) > 0.05).astype(
+            numpy.int8
+        ),
+    }
+
+    frames = []
+    for index in range(num_frames):
+        cell = cellid_list[index % len(cellid_list)]
+        frames.append(
+            (
+                random_state.randint(0, 16384, size=(16, 512, 128)).astype(
+                    numpy.uint16
+                ),
+                random_state.randint(0, 12000, size=(16, 512, 128)).astype(
+                    numpy.uint16
+                ),
+                cell,
+            )
+        )
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        calibration_filename = os.path.join(temp_dir, "agipd_calibration.h5")
+        with h5py.File(calibration_filename, "w") as fhandle:
+            for name, value in constants.items():
+                fhandle["/" + name] = value
+        calibration = calibration_algorithms.Agipd1MCalibration(
+            calibration_filename=calibration_filename,
+            cellid_list=cellid_list,
+            cache_directory=temp_dir,
+        )
+
+        def _new(frame):
+            return calibration.apply_calibration(
+                named_tuples.DataAndCalibrationInfo(
+                    data=frame[0], info={"gain": frame[1], "cell": frame[2]}
+                )
+            )
+
+        def _old(frame):
+            return _reference_calibration(frame[0], frame[1], frame[2], constants)
+
+        for frame in frames:
+            numpy.testing.assert_allclose(
+                _new(frame), _old(frame), rtol=1e-5, atol=1e-1
+            )
+        print("Calibrated frames match the reference expression.")
+
+        times = []
+        for calibration_func in (_old, _new):
+            start_time = timeit.default_timer()
+            for frame in frames:
+                calibration_func(frame)
+            times.append((timeit.default_timer() - start_time) / len(frames))
+        print(
+            "old: {0:.2f} ms/frame, new: {1:.2f} ms/frame".format(
+                times[0] * 1000, times[1] * 1000
+            )
+        )
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,158 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Benchmark for the Correction algorithm.
+
+This script compares the Correction algorithm with the straightforward numpy
+expression that it replaces, reporting, for each combination of corrections, the time
+needed to correct a frame and the memory allocated while correcting it. Usage:
+python benchmark_correction.py [--num-frames N] [--frame-shape SS FS]
+"""
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import timeit
+import tracemalloc
+from typing import Tuple  # pylint: disable=unused-import
+
+import click
+import h5py
+import numpy
+
+from onda.algorithms import generic_algorithms
+
+
+def _reference_correction(data, mask, dark, gain):
+    # Applies the corrections using the expression originally used by the Correction
+    # algorithm, which creates a full-frame temporary array for each operation.
+    if mask is None:
+        mask = True
+    dark = dark * mask if dark is not None else False
+    gain = gain * mask if gain is not None else True
+    return (data * mask - dark) * gain
+
+
+def _measure(correction_func, frames):
+    # Returns the average time per frame and the peak memory allocated while
+    # correcting a single frame.
+    correction_func(frames[0])
+    start_time = timeit.default_timer()
+    for frame in frames:
+        correction_func(frame)
+    time_per_frame = (timeit.default_timer() - start_time) / len(frames)
+
+    tracemalloc.start()
+    correction_func(frames[0])
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return time_per_frame, peak_memory
+
+
+@click.command()
+@click.option("--num-frames", default=50, help="Number of frames to correct.")
+@click.option(
+    "--frame-shape", nargs=2, type=int, default=(4096, 1024), help="Frame shape."
+)
+def main(num_frames, frame_shape):
+    # type: (int, Tuple[int, int]) -> None
+    """
+    Benchmark for the Correction algorithm.
+    """
+    frame_shape = tuple(frame_shape)
+    random_state = numpy.random.RandomState(0)
+    distinct_frames = [
+        random_state.randint(0, 16384, size=frame_shape).astype(numpy.int16)
+        for _ in range(min(num_frames, 5))
+    ]
+    frames = [
+        distinct_frames[index % len(distinct_frames)] for index in range(num_frames)
+    ]
+    calibration = {
+        "mask": (random_state.uniform(size=frame_shape) > 0.01).astype(numpy.int8),
+        "dark": random_state.normal(1000.0, 10.0, size=frame_shape),
+        "gain": random_state.normal(1.0, 0.05, size=frame_shape),
+    }
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for name, value in calibration.items():
+            with h5py.File(os.path.join(temp_dir, name + ".h5"), "w") as fhandle:
+                fhandle["/data/data"] = value
+
+        frame_size_in_mb = frames[0].size * 4 / 1024.0 ** 2
+        print(
+            "Frame shape: {0}, {1} frames, float32 frame size: {2:.1f} MB".format(
+                frame_shape, len(frames), frame_size_in_mb
+            )
+        )
+        print(
+            "{0:<18}{1:>16}{2:>16}{3:>16}{4:>16}".format(
+                "Corrections",
+                "old (ms/frame)",
+                "new (ms/frame)",
+                "old (MB/frame)",
+                "new (MB/frame)",
+            )
+        )
+        for enabled in (
+            (),
+            ("mask",),
+            ("dark",),
+            ("mask", "dark"),
+            ("mask", "dark", "gain"),
+        ):
+            arguments = {}
+            for name in enabled:
+                arguments[name + "_filename"] = os.path.join(temp_dir, name + ".h5")
+                arguments[name + "_hdf5_path"] = "/data/data"
+            correction = generic_algorithms.Correction(**arguments)
+            reference = {
+                name: (calibration[name] if name in enabled else None)
+                for name in calibration
+            }
+
+            numpy.testing.assert_allclose(
+                correction.apply_correction(frames[0]),
+                _reference_correction(frames[0], **reference),
+                rtol=1e-5,
+                atol=1e-2,
+            )
+
+            old_time, old_memory = _measure(
+                lambda data, reference=reference: _reference_correction(
+                    data, **reference
+                ),
+                frames,
+            )
+            new_time, new_memory = _measure(correction.apply_correction, frames)
+            print(
+                "{0:<18}{1:>16.2f}{2:>16.2f}{3:>16.1f}{4:>16.1f}".format(
+                    "+".join(enabled) if enabled else "none",
+                    old_time * 1000,
+                    new_time * 1000,
+                    old_memory / 1024.0 ** 2,
+                    new_memory / 1024.0 ** 2,
+                )
+            )
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
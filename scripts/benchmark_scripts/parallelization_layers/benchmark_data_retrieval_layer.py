@@ -0,0 +1,220 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Synthetic Data Retrieval Layer for benchmarking the Parallelization Layers.
+
+This module contains a Data Retrieval Layer that generates synthetic detector frames
+in memory, without reading any data, so that the cost of transferring the processed
+data to the master node dominates the running time of the monitor. The source string
+is the number of events to generate.
+"""
+from __future__ import absolute_import, division, print_function
+
+import time
+from typing import Generator, Iterator, Optional  # pylint: disable=unused-import
+
+import numpy
+
+from onda.utils import (  # pylint: disable=unused-import
+    data_event,
+    dynamic_import,
+    parameters,
+)
+
+
+def initialize_event_source(source, node_pool_size, monitor_params):
+    # type: (str, int, parameters.MonitorParams) -> None
+    """
+    Initializes the synthetic event source.
+
+    There is no need to initialize the synthetic event source, so this function
+    actually does nothing.
+
+    Arguments:
+
+        source (str): the number of events to generate.
+
+        node_pool_size (int): the total number of nodes in the OnDA pool, including all
+            the worker nodes and the master node.
+
+        monitor_params (:class:`~onda.utils.parameters.MonitorParams`): an object
+            storing the OnDA monitor parameters from the configuration file.
+    """
+    del source
+    del node_pool_size
+    del monitor_params
+
+
+def event_generator(
+    source,  # type: str
+    node_rank,  # type: int
+    node_pool_size,  # type: int
+    monitor_params,  # type: parameters.MonitorParams
+    event_indexes=None,  # type: Optional[Iterator[int]]
+):
+    # type: (...) -> Generator[data_event.DataEvent, None, None]
+    """
+    Generates synthetic data events.
+
+    The events are split amongst the worker nodes in a round-robin fashion, unless the
+    'event_indexes' argument is provided.
+
+    Arguments:
+
+        source (str): the number of events to generate.
+
+        node_rank (int): the rank, in the OnDA pool, of the worker node calling the
+            function.
+
+        node_pool_size (int): the total number of nodes in the OnDA pool, including all
+            the worker nodes and the master node.
+
+        monitor_params (:class:`~onda.utils.parameters.MonitorParams`): an object
+            storing the OnDA monitor parameters from the configuration file.
+
+        event_indexes (Optional[Iterator[int]]): an iterator over the indexes of the
+            events that the worker node should process. Defaults to None.
+
+    Yields:
+
+        :class:`~onda.utils.data_event.DataEvent`: an object storing the event data.
+    """
+    data_retrieval_layer_filename = monitor_params.get_param(
+        group="Onda", parameter="data_retrieval_layer", type_=str, required=True
+    )
+    data_retrieval_layer = dynamic_import.import_data_retrieval_layer(
+        data_retrieval_layer_filename=data_retrieval_layer_filename
+    )
+    required_data = monitor_params.get_param(
+        group="Onda", parameter="required_data", type_=list, required=True
+    )
+    event = data_event.DataEvent(
+        event_handling_funcs=dynamic_import.get_event_handling_funcs(
+            data_retrieval_layer=data_retrieval_layer
+        ),
+        data_extraction_funcs=dynamic_import.get_data_extraction_funcs(
+            required_data=required_data, data_retrieval_layer=data_retrieval_layer
+        ),
+    )
+    frame_shape = monitor_params.get_param(
+        group="DataRetrievalLayer",
+        parameter="benchmark_frame_shape",
+        type_=list,
+        required=True,
+    )
+    event.framework_info["frame"] = numpy.random.random(frame_shape).astype(
+        numpy.float32
+    )
+
+    num_events = int(source)
+    if event_indexes is None:
+        event_indexes = iter(range(node_rank - 1, num_events, node_pool_size - 1))
+    for event_index in event_indexes:
+        if event_index >= num_events:
+            return
+        event.framework_info["event_index"] = event_index
+        yield event
+
+
+def open_event(event):
+    # type: (data_event.DataEvent) -> None
+    """
+    Opens a synthetic event.
+
+    Synthetic events do not need to be opened, so this function actually does nothing.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+    """
+    del event
+
+
+def close_event(event):
+    # type: (data_event.DataEvent) -> None
+    """
+    Closes a synthetic event.
+
+    Synthetic events do not need to be closed, so this function actually does nothing.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+    """
+    del event
+
+
+def get_num_frames_in_event(event):
+    # type: (data_event.DataEvent) -> int
+    """
+    Gets the number of frames in a synthetic event.
+
+    Each synthetic event contains exactly one frame.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+
+    Returns:
+
+        int: the number of frames in the event.
+    """
+    del event
+
+    return 1
+
+
+def detector_data(event):
+    # type: (data_event.DataEvent) -> numpy.ndarray
+    """
+    Gets the synthetic detector frame.
+
+    The same frame is returned for all events.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+
+    Returns:
+
+        numpy.ndarray: the detector frame.
+    """
+    return event.framework_info["frame"]
+
+
+def timestamp(event):
+    # type: (data_event.DataEvent) -> float
+    """
+    Gets the timestamp of a synthetic event.
+
+    The timestamp is the time at which the data is extracted from the event.
+
+    Arguments:
+
+        event (:class:`~onda.utils.data_event.DataEvent`): an object storing the event
+            data.
+
+    Returns:
+
+        float: the timestamp of the event.
+    """
+    del event
+
+    return time.time()
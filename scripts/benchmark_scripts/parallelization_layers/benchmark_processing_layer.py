@@ -0,0 +1,112 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Processing Layer for benchmarking the Parallelization Layers.
+
+This module contains an OnDA monitor that transfers every detector frame to the master
+node, where the transfer rate is measured.
+"""
+from __future__ import absolute_import, division, print_function
+
+import sys
+import time
+from typing import Any, Dict  # pylint: disable=unused-import
+
+from onda.utils import named_tuples, parameters  # pylint: disable=unused-import
+
+
+class OndaMonitor(object):
+    """
+    See documentation of the '__init__' function.
+    """
+
+    def __init__(self, source, monitor_parameters):
+        # type: (str, parameters.MonitorParams) -> None
+        """
+        An OnDA monitor for benchmarking the Parallelization Layers.
+
+        The worker nodes send each detector frame to the master node, which does
+        nothing with it. At the end of the processing, the master node reports the
+        number of frames received per second. The Parallelization Layer can be chosen
+        with the 'parallelization_layer' entry in the 'Onda' configuration parameter
+        group.
+
+        Arguments:
+
+            source (str): the number of events to generate.
+
+            monitor_parameters (:class:`~onda.utils.parameters.MonitorParams`): an
+                object storing the OnDA monitor parameters from the configuration file.
+        """
+        super(OndaMonitor, self).__init__(
+            process_func=self.process_data,
+            collect_func=self.collect_data,
+            source=source,
+            monitor_params=monitor_parameters,
+        )
+        self._num_received_frames = 0
+        self._start_time = None  # type: Any
+
+    def process_data(self, data):
+        # type: (Dict[str, Any]) -> named_tuples.ProcessedData
+        """
+        Sends the detector frame to the master node.
+
+        Arguments:
+
+            data (Dict[str, Any]): a dictionary containing the data retrieved by
+                OnDA.
+
+        Returns:
+
+            :class:`~onda.utils.named_tuples.ProcessedData`: a named tuple storing
+            the detector frame and its timestamp.
+        """
+        processed_data = {
+            "detector_data": data["detector_data"],
+            "timestamp": data["timestamp"],
+        }
+
+        return named_tuples.ProcessedData(data=processed_data, worker_rank=self.rank)
+
+    def collect_data(self, processed_data):
+        # type: (named_tuples.ProcessedData) -> None
+        """
+        Counts the detector frames received by the master node.
+
+        Arguments:
+
+            processed_data (:class:`~onda.utils.named_tuples.ProcessedData`): a named
+                tuple storing the data sent by a worker node.
+        """
+        if self._start_time is None:
+            self._start_time = time.time()
+        self._num_received_frames += 1
+
+    def end_processing(self):
+        # type: () -> None
+        """
+        Reports the rate at which frames have been received by the master node.
+        """
+        elapsed_time = time.time() - self._start_time
+        print(
+            "BENCHMARK: received {0} frames in {1:.2f} s ({2:.1f} frames/s).".format(
+                self._num_received_frames,
+                elapsed_time,
+                self._num_received_frames / elapsed_time,
+            )
+        )
+        sys.stdout.flush()
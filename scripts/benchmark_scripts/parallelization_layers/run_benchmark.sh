@@ -0,0 +1,38 @@
+#!/bin/bash
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+
+# Compares the throughput of the 'mpi' and 'multiproc' Parallelization Layers on the
+# current machine. Usage: run_benchmark.sh [NUM_WORKER_NODES] [NUM_EVENTS]
+NUM_WORKER_NODES=${1:-8}
+NUM_EVENTS=${2:-2000}
+cd "$(dirname "$0")"
+export PYTHONPATH=$(pwd):$PYTHONPATH
+
+sed "s/^num_worker_nodes = .*/num_worker_nodes = ${NUM_WORKER_NODES}/" \
+    benchmark_multiproc.toml > benchmark_multiproc_current.toml
+
+TIMEFORMAT="Total time (including start-up): %R s"
+
+echo "mpi Parallelization Layer (${NUM_WORKER_NODES} worker nodes):"
+time (mpirun -n $((NUM_WORKER_NODES + 1)) onda_monitor.py -c benchmark_mpi.toml \
+    ${NUM_EVENTS} | grep "BENCHMARK")
+
+echo "multiproc Parallelization Layer (${NUM_WORKER_NODES} worker nodes):"
+time (onda_monitor.py -c benchmark_multiproc_current.toml ${NUM_EVENTS} | \
+    grep "BENCHMARK")
+
+rm benchmark_multiproc_current.toml
@@ -0,0 +1,98 @@
+# This file is part of OnDA.
+#
+# OnDA is free software: you can redistribute it and/or modify it under the terms of
+# the GNU General Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# OnDA is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with OnDA.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
+# a research centre of the Helmholtz Association.
+"""
+Benchmark for the encoding of broadcasted detector frames.
+
+This script reports, for several combinations of data type conversion, binning and
+compression, the number of bytes that a detector frame occupies on the wire when it is
+broadcasted by an OnDA monitor, and the time needed to encode and serialize it. Usage:
+python benchmark_frame_encoding.py [--num-frames N] [--frame-shape SS FS]
+"""
+from __future__ import absolute_import, division, print_function
+
+import timeit
+from typing import Tuple  # pylint: disable=unused-import
+
+import click
+import msgpack
+import numpy
+
+from onda.utils import zmq_monitor
+
+
+@click.command()
+@click.option("--num-frames", default=20, help="Number of frames to encode.")
+@click.option(
+    "--frame-shape", nargs=2, type=int, default=(8192, 128), help="Frame shape."
+)
+def main(num_frames, frame_shape):
+    # type: (int, Tuple[int, int]) -> None
+    """
+    Benchmark for the encoding of broadcasted detector frames.
+    """
+    frame_shape = tuple(frame_shape)
+    random_state = numpy.random.RandomState(0)
+    # Simulated corrected frames: a noisy background with a few bright peaks.
+    frames = []
+    for _ in range(min(num_frames, 5)):
+        frame = random_state.normal(20.0, 5.0, size=frame_shape).astype(numpy.float32)
+        peak_positions = random_state.randint(0, frame.size, size=200)
+        frame.ravel()[peak_positions] += random_state.uniform(500, 5000, size=200)
+        frames.append(frame)
+    frames = [frames[index % len(frames)] for index in range(num_frames)]
+
+    print(
+        "Frame shape: {0}, {1} frames, float32 frame size: {2:.2f} MB".format(
+            frame_shape, num_frames, frames[0].nbytes / 1024.0 ** 2
+        )
+    )
+    print("{0:<36}{1:>16}{2:>16}".format("Encoding", "bytes on wire", "ms/frame"))
+    for encoding, bin_size, compression_level in (
+        (None, 1, 0),
+        ("float32", 1, 0),
+        ("float32", 1, 1),
+        ("int16", 1, 0),
+        ("int16", 1, 1),
+        ("float32", 2, 0),
+        ("int16", 2, 1),
+        ("int16", 4, 1),
+    ):
+        if encoding is None:
+            label = "unencoded"
+            encode_func = lambda data: data
+        else:
+            label = "{0}, bin {1}x{1}, zlib level {2}".format(
+                encoding, bin_size, compression_level
+            )
+            encode_func = zmq_monitor.FrameEncoder(
+                encoding=encoding,
+                bin_size=bin_size,
+                compression_level=compression_level,
+            ).defer_encoding
+
+        # The message is serialized in the same way as by the broadcasting socket.
+        num_bytes = len(msgpack.packb([{"detector_data": encode_func(frames[0])}]))
+        start_time = timeit.default_timer()
+        for frame in frames:
+            msgpack.packb([{"detector_data": encode_func(frame)}])
+        time_per_frame = (timeit.default_timer() - start_time) / len(frames)
+        print(
+            "{0:<36}{1:>16}{2:>16.2f}".format(label, num_bytes, time_per_frame * 1000)
+        )
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -25,9 +25,14 @@ import numpy
 from setuptools import Extension, setup
 
 ONDA_USE_CYTHON = os.getenv("ONDA_USE_CYTHON")
+ONDA_USE_OPENMP = os.getenv("ONDA_USE_OPENMP")
 
 ext = ".pyx" if ONDA_USE_CYTHON else ".c"  # pylint: disable=invalid-name
 
+# OpenMP support is optional: without it the peakfinder8 extension processes the
+# detector panels serially.
+openmp_flags = ["-fopenmp"] if ONDA_USE_OPENMP else []  # pylint: disable=invalid-name
+
 peakfinder8_ext = Extension(  # pylint: disable=invalid-name
     name="onda.algorithms.peakfinder8_extension.peakfinder8_extension",
     include_dirs=[numpy.get_include()],
@@ -42,6 +47,8 @@ peakfinder8_ext = Extension(  # pylint: disable=invalid-name
         "src/peakfinder8_extension/peakfinder8.cpp",
     ],
     language="c++",
+    extra_compile_args=openmp_flags,
+    extra_link_args=openmp_flags,
 )
 
 if ONDA_USE_CYTHON:
@@ -101,7 +108,7 @@ setup(
         "click>=7.0",
         "fabio>=0.9.0",
         "future>=0.17.1",
-        "h5py>=2.9.0",
+        "h5py>=2.10.0",
         "msgpack>=0.6.1",
         "msgpack-numpy>=0.4.4.3",
         "numpy>=1.16.4",
@@ -113,6 +120,7 @@ setup(
     ],
     extras_require={
         "monitor": [],
+        "inotify": ["inotify_simple>=1.1.8"],
         ":python_version < '3.4'": ["pathlib>=1.0.1"],
         "gui": ["pyqt5>=5.9.2", "pyqtgraph>=0.10.0"],
     },
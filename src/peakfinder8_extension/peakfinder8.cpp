@@ -21,6 +21,10 @@
 #include <stdio.h>
 #include <float.h>
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 #include "peakfinder8.hh"
 
 
@@ -88,6 +92,7 @@ struct peakfinder_intern_data
 	int *infs;
 	int *inss;
 	int *peak_pixels;
+	int num_used_search_entries;
 };
 
 
@@ -190,7 +195,7 @@ static void free_radial_stats(struct radial_stats *rstats)
 static void fill_radial_bins(float *data,
                              int w,
                              int h,
-                             float *r_map,
+                             int *r_bin,
                              char *mask,
                              float *rthreshold,
                              float *lthreshold,
@@ -208,7 +213,7 @@ static void fill_radial_bins(float *data,
 		for ( ifs=0; ifs<w ; ifs++ ) {
 			pidx = iss * w + ifs;
 			if ( mask[pidx] != 0 ) {
-				curr_r = (int)rint(r_map[pidx]);
+				curr_r = r_bin[pidx];
 				value = data[pidx];
 				if ( value < rthreshold[curr_r]
 				  && value > lthreshold[curr_r] )
@@ -263,21 +268,12 @@ static void compute_radial_stats(float *rthreshold,
 }
 
 
-static struct radial_stats *compute_radial_bins(float *data,
-                                                char *mask,
-                                                int num_pix,
-                                                float *r_map,
-                                                int iterations,
-                                                float min_snr,
-                                                float acd_threshold,
-                                                int num_pix_fs,
-                                                int num_pix_ss)
+static struct radial_stats *allocate_radial_stats_for_map(float *r_map,
+                                                          int num_pix_fs,
+                                                          int num_pix_ss)
 {
 	float max_r;
-	int it_counter;
-	int i;
 	int num_rad_bins;
-	struct radial_stats *rstats;
 
 	max_r = -1e9;
 
@@ -285,16 +281,35 @@ static struct radial_stats *compute_radial_bins(float *data,
 
 	num_rad_bins = (int)ceil(max_r) + 1;
 
-	// Allocate and zero arrays
-	rstats = allocate_radial_stats(num_rad_bins);
-	if ( rstats == NULL ) {
-		return NULL;
-	}
+	return allocate_radial_stats(num_rad_bins);
+}
 
-	for ( i=0; i<num_rad_bins; i++ ) {
-		rstats->rthreshold[i] = 1e9;
-		rstats->lthreshold[i] = -1e9;
-  	}
+
+static void fill_radial_stats(struct radial_stats *rstats,
+                              float *data,
+                              char *mask,
+                              int *r_bin,
+                              int iterations,
+                              float min_snr,
+                              float acd_threshold,
+                              int num_pix_fs,
+                              int num_pix_ss,
+                              int warm_start)
+{
+	int it_counter;
+	int i;
+	int num_rad_bins;
+
+	num_rad_bins = rstats->n_rad_bins;
+
+	// When warm-starting, the clipping starts from the thresholds computed for the
+	// previous frame, which are still stored in rstats
+	if ( !warm_start ) {
+		for ( i=0; i<num_rad_bins; i++ ) {
+			rstats->rthreshold[i] = 1e9;
+			rstats->lthreshold[i] = -1e9;
+	  	}
+	}
 
 	// Compute sigma and average of data values at each radius
 	// From this, compute the ADC threshold to be applied at each radius
@@ -310,7 +325,7 @@ static struct radial_stats *compute_radial_bins(float *data,
 		fill_radial_bins(data,
                          num_pix_fs,
                          num_pix_ss,
-		                 r_map,
+		                 r_bin,
 		                 mask,
 		                 rstats->rthreshold,
 		                 rstats->lthreshold,
@@ -328,7 +343,6 @@ static struct radial_stats *compute_radial_bins(float *data,
 		                     acd_threshold);
 
 	}
-	return rstats;
 }
 
 
@@ -452,14 +466,15 @@ static struct peakfinder_intern_data *allocate_peakfinder_intern_data(int data_s
 		return NULL;
 	}
 
-	intern_data->infs =(int *)calloc(data_size, sizeof(int));
+	// The region-growing loop reads one entry past the pixels found for a peak
+	intern_data->infs =(int *)calloc(data_size + 1, sizeof(int));
 	if ( intern_data->infs == NULL ) {
 		free(intern_data->pix_in_peak_map);
 		free(intern_data);
 		return NULL;
 	}
 
-	intern_data->inss =(int *)calloc(data_size, sizeof(int));
+	intern_data->inss =(int *)calloc(data_size + 1, sizeof(int));
 	if ( intern_data->inss == NULL ) {
 		free(intern_data->pix_in_peak_map);
 		free(intern_data->infs);
@@ -476,6 +491,8 @@ static struct peakfinder_intern_data *allocate_peakfinder_intern_data(int data_s
 		return NULL;
 	}
 
+	intern_data->num_used_search_entries = 0;
+
 	return intern_data;
 }
 
@@ -490,10 +507,166 @@ static void free_peakfinder_intern_data(struct peakfinder_intern_data *pfid)
 }
 
 
+// Per-thread version of the internal data: the pixel-in-peak map is shared between
+// all threads (each thread only touches the pixels of the panel it is processing),
+// while the search buffers are private and only need to be as large as a panel
+static struct peakfinder_intern_data *allocate_peakfinder_thread_data(char *pix_in_peak_map,
+                                                                      int panel_size,
+                                                                      int max_pix_count)
+{
+
+	struct peakfinder_intern_data *intern_data;
+
+	intern_data = (struct peakfinder_intern_data *)malloc(sizeof(struct peakfinder_intern_data));
+	if ( intern_data == NULL ) {
+		return NULL;
+	}
+
+	intern_data->pix_in_peak_map = pix_in_peak_map;
+
+	// The region-growing loop reads one entry past the pixels found for a peak
+	intern_data->infs =(int *)calloc(panel_size + 1, sizeof(int));
+	if ( intern_data->infs == NULL ) {
+		free(intern_data);
+		return NULL;
+	}
+
+	intern_data->inss =(int *)calloc(panel_size + 1, sizeof(int));
+	if ( intern_data->inss == NULL ) {
+		free(intern_data->infs);
+		free(intern_data);
+		return NULL;
+	}
+
+	intern_data->peak_pixels =(int *)calloc(max_pix_count, sizeof(int));
+	if ( intern_data->peak_pixels == NULL ) {
+		free(intern_data->infs);
+		free(intern_data->inss);
+		free(intern_data);
+		return NULL;
+	}
+
+	intern_data->num_used_search_entries = 0;
+
+	return intern_data;
+}
+
+
+static void free_peakfinder_thread_data(struct peakfinder_intern_data *pfid)
+{
+	free(pfid->peak_pixels);
+ 	free(pfid->infs);
+	free(pfid->inss);
+	free(pfid);
+}
+
+
+// Buffers used to process the panels in parallel: a peak list for each panel, and
+// search buffers for each thread
+struct peakfinder_parallel_data
+{
+	int num_panels;
+	int max_num_threads;
+	int *panel_peak_count;
+	struct peakfinder_peak_data **panel_pkdata;
+	struct peakfinder_intern_data **thread_pfinter;
+};
+
+
+static void free_peakfinder_parallel_data(struct peakfinder_parallel_data *pardata)
+{
+	int pi;
+	int ti;
+
+	if ( pardata->panel_pkdata != NULL ) {
+		for ( pi=0 ; pi<pardata->num_panels ; pi++ ) {
+			if ( pardata->panel_pkdata[pi] != NULL ) {
+				free_peak_data(pardata->panel_pkdata[pi]);
+			}
+		}
+	}
+	if ( pardata->thread_pfinter != NULL ) {
+		for ( ti=0 ; ti<pardata->max_num_threads ; ti++ ) {
+			if ( pardata->thread_pfinter[ti] != NULL ) {
+				free_peakfinder_thread_data(pardata->thread_pfinter[ti]);
+			}
+		}
+	}
+	free(pardata->panel_pkdata);
+	free(pardata->thread_pfinter);
+	free(pardata->panel_peak_count);
+	free(pardata);
+}
+
+
+static struct peakfinder_parallel_data *allocate_peakfinder_parallel_data(char *pix_in_peak_map,
+                                                                          int num_panels,
+                                                                          int panel_size,
+                                                                          int max_n_peaks,
+                                                                          int max_pix_count,
+                                                                          int max_num_threads)
+{
+	struct peakfinder_parallel_data *pardata;
+	int pi;
+	int ti;
+
+	pardata = (struct peakfinder_parallel_data *)calloc(1, sizeof(struct peakfinder_parallel_data));
+	if ( pardata == NULL ) {
+		return NULL;
+	}
+
+	pardata->num_panels = num_panels;
+	pardata->max_num_threads = max_num_threads;
+	pardata->panel_peak_count = (int *)calloc(num_panels, sizeof(int));
+	pardata->panel_pkdata = (struct peakfinder_peak_data **)calloc(num_panels,
+	                                                               sizeof(struct peakfinder_peak_data *));
+	pardata->thread_pfinter = (struct peakfinder_intern_data **)calloc(max_num_threads,
+	                                                                   sizeof(struct peakfinder_intern_data *));
+	if ( pardata->panel_peak_count == NULL || pardata->panel_pkdata == NULL
+	  || pardata->thread_pfinter == NULL ) {
+		free_peakfinder_parallel_data(pardata);
+		return NULL;
+	}
+
+	for ( pi=0 ; pi<num_panels ; pi++ ) {
+		pardata->panel_pkdata[pi] = allocate_peak_data(max_n_peaks);
+		if ( pardata->panel_pkdata[pi] == NULL ) {
+			free_peakfinder_parallel_data(pardata);
+			return NULL;
+		}
+	}
+
+	for ( ti=0 ; ti<max_num_threads ; ti++ ) {
+		pardata->thread_pfinter[ti] = allocate_peakfinder_thread_data(pix_in_peak_map,
+		                                                              panel_size,
+		                                                              max_pix_count);
+		if ( pardata->thread_pfinter[ti] == NULL ) {
+			free_peakfinder_parallel_data(pardata);
+			return NULL;
+		}
+	}
+
+	return pardata;
+}
+
+
+// The region-growing loop of the peak search reads, for each peak, one entry of the
+// search buffers past the pixels found for the peak. That entry is either zero or
+// left over from an earlier peak in the same frame. When the buffers are reused
+// across frames, the entries written for the previous frame must be cleared, so that
+// the search gives the same results as with freshly allocated buffers
+static void clear_search_buffers(struct peakfinder_intern_data *pfinter)
+{
+	memset(pfinter->infs, 0, pfinter->num_used_search_entries*sizeof(int));
+	memset(pfinter->inss, 0, pfinter->num_used_search_entries*sizeof(int));
+	pfinter->num_used_search_entries = 0;
+}
+
+
 
 static void peak_search(int p,
                         struct peakfinder_intern_data *pfinter,
-                        float *copy, char *mask, float *r_map,
+                        float *copy, char *mask, int *r_bin,
                         float *rthreshold, float *roffset,
                         int *num_pix_in_peak, int asic_size_fs,
                         int asic_size_ss, int aifs, int aiss,
@@ -525,7 +698,7 @@ static void peak_search(int p,
 		curr_ss = pfinter->inss[p] + search_ss[k] + aiss * asic_size_ss;
 		pi = curr_fs + curr_ss * num_pix_fs;
 
-		curr_radius = (int)rint(r_map[pi]);
+		curr_radius = r_bin[pi];
 		curr_threshold = rthreshold[curr_radius];
 
 		// Above threshold?
@@ -540,6 +713,9 @@ static void peak_search(int p,
 
 			pfinter->inss[*num_pix_in_peak] = pfinter->inss[p] + search_ss[k];
 			pfinter->infs[*num_pix_in_peak] = pfinter->infs[p] + search_fs[k];
+			if ( *num_pix_in_peak >= pfinter->num_used_search_entries ) {
+				pfinter->num_used_search_entries = *num_pix_in_peak + 1;
+			}
 			pfinter->pix_in_peak_map[pi] = 1;
 			if ( *num_pix_in_peak < max_pix_count ) {
 				  pfinter->peak_pixels[*num_pix_in_peak] = pi;
@@ -551,7 +727,7 @@ static void peak_search(int p,
 
 
 static void search_in_ring(int ring_width, int com_fs_int, int com_ss_int,
-                           float *copy, float *r_map,
+                           float *copy, int *r_bin,
                            float *rthreshold, float *roffset,
                            char *pix_in_peak_map, char *mask, int asic_size_fs,
                            int asic_size_ss, int aifs, int aiss,
@@ -601,7 +777,7 @@ static void search_in_ring(int ring_width, int com_fs_int, int com_ss_int,
 			curr_ss = com_ss_int + ssj + aiss * asic_size_ss;
 			pi = curr_fs + curr_ss * num_pix_fs;
 
-			curr_radius = (int)rint(r_map[pi]);
+			curr_radius = r_bin[pi];
 			curr_threshold = rthreshold[curr_radius];
 
 			// Intensity above background ??? just intensity?
@@ -632,7 +808,7 @@ static void search_in_ring(int ring_width, int com_fs_int, int com_ss_int,
 			*local_sigma = 0.01;
 		}
  	} else {
-		local_radius = (int)rint(r_map[(int)rint(com_idx)]);
+		local_radius = r_bin[com_idx];
 		*local_offset = roffset[local_radius];
 		*local_sigma = 0.01;
 	}
@@ -643,7 +819,7 @@ static void process_panel(int asic_size_fs, int asic_size_ss, int num_pix_fs,
                           int aiss, int aifs, float *rthreshold,
                           float *roffset, int *peak_count,
                           float *copy, struct peakfinder_intern_data *pfinter,
-                          float *r_map, char *mask, int *npix, float *com_fs,
+                          int *r_bin, char *mask, int *npix, float *com_fs,
                           float *com_ss, int *com_index, float *tot_i,
                           float *max_i, float *sigma, float *snr,
                           int min_pix_count, int max_pix_count,
@@ -663,7 +839,7 @@ static void process_panel(int asic_size_fs, int asic_size_ss, int num_pix_fs,
 			pxidx = (pxss + aiss * asic_size_ss) * num_pix_fs +
 			pxfs + aifs * asic_size_fs;
 
-			curr_rad = (int)rint(r_map[pxidx]);
+			curr_rad = r_bin[pxidx];
 			curr_thresh = rthreshold[curr_rad];
 
 			if ( copy[pxidx] > curr_thresh
@@ -703,7 +879,7 @@ static void process_panel(int asic_size_fs, int asic_size_ss, int num_pix_fs,
 					for ( p=0; p<=num_pix_in_peak; p++ ) { //changed from 1 to 0 by O.Y.
 						peak_search(p,
 						            pfinter, copy, mask,
-						            r_map,
+						            r_bin,
 						            rthreshold,
 						            roffset,
 						            &num_pix_in_peak,
@@ -744,7 +920,7 @@ static void process_panel(int asic_size_fs, int asic_size_ss, int num_pix_fs,
 
 				search_in_ring(ring_width, peak_com_fs_int,
 				               peak_com_ss_int,
-				               copy, r_map, rthreshold,
+				               copy, r_bin, rthreshold,
 				               roffset,
 				               pfinter->pix_in_peak_map,
 				               mask, asic_size_fs,
@@ -859,8 +1035,105 @@ static void process_panel(int asic_size_fs, int asic_size_ss, int num_pix_fs,
 }
 
 
+static void process_panels_in_parallel(float *roffset, float *rthreshold,
+                                       float *data, char *mask, int *r_bin,
+                                       struct peakfinder_parallel_data *pardata,
+                                       int asic_size_fs, int num_asics_fs,
+                                       int asic_size_ss, int num_asics_ss,
+                                       int max_n_peaks, int *num_found_peaks,
+                                       int *npix, float *com_fs,
+                                       float *com_ss, int *com_index, float *tot_i,
+                                       float *max_i, float *sigma, float *snr,
+                                       int min_pix_count, int max_pix_count,
+                                       int local_bg_radius, float min_snr,
+                                       int num_threads)
+{
+	int num_pix_fs;
+	int num_panels;
+	int pi, pki;
+	int peak_count;
+	int peaks_to_copy;
+	int *panel_peak_count;
+	struct peakfinder_peak_data **panel_pkdata;
+
+	num_pix_fs = asic_size_fs * num_asics_fs;
+	num_panels = num_asics_fs * num_asics_ss;
+
+	// Each panel stores its peaks in its own list. The lists are merged in panel
+	// order at the end, so that the order of the peaks does not depend on the
+	// scheduling of the threads. Each thread has its own search buffers, cleared at
+	// the start of each frame, so the leftover entry read past the pixels of a peak
+	// (see clear_search_buffers) can differ from the one read by the serial search,
+	// which depends on the peaks found in all the earlier panels. In rare cases, with
+	// many large peaks close together, the results can then differ from the serial
+	// ones. The lists and the search buffers of the threads are allocated only once,
+	// with the context
+	panel_peak_count = pardata->panel_peak_count;
+	panel_pkdata = pardata->panel_pkdata;
+	memset(panel_peak_count, 0, num_panels*sizeof(int));
+
+	#pragma omp parallel num_threads(num_threads)
+	{
+		struct peakfinder_intern_data *pfinter;
+		int pti;
+
+#ifdef _OPENMP
+		pfinter = pardata->thread_pfinter[omp_get_thread_num()];
+#else
+		pfinter = pardata->thread_pfinter[0];
+#endif
+		clear_search_buffers(pfinter);
+
+		#pragma omp for schedule(dynamic)
+		for ( pti=0 ; pti<num_panels ; pti++ ) {
+			struct peakfinder_peak_data *pkd;
+
+			pkd = panel_pkdata[pti];
+			process_panel(asic_size_fs, asic_size_ss, num_pix_fs,
+			              pti / num_asics_fs, pti % num_asics_fs,
+			              rthreshold, roffset,
+			              &panel_peak_count[pti], data, pfinter, r_bin, mask,
+			              pkd->npix, pkd->com_fs, pkd->com_ss, pkd->com_index,
+			              pkd->tot_i, pkd->max_i, pkd->sigma, pkd->snr,
+			              min_pix_count, max_pix_count, local_bg_radius,
+			              min_snr, max_n_peaks);
+		}
+	}
+
+	peak_count = 0;
+
+	for ( pi=0 ; pi<num_panels ; pi++ ) {
+
+		peaks_to_copy = panel_peak_count[pi];
+		if ( peaks_to_copy > max_n_peaks - peak_count ) {
+			peaks_to_copy = max_n_peaks - peak_count;
+		}
+		if ( peaks_to_copy < 0 ) {
+			peaks_to_copy = 0;
+		}
+
+		for ( pki=0 ; pki<peaks_to_copy ; pki++ ) {
+			npix[peak_count + pki] = panel_pkdata[pi]->npix[pki];
+			com_fs[peak_count + pki] = panel_pkdata[pi]->com_fs[pki];
+			com_ss[peak_count + pki] = panel_pkdata[pi]->com_ss[pki];
+			com_index[peak_count + pki] = panel_pkdata[pi]->com_index[pki];
+			tot_i[peak_count + pki] = panel_pkdata[pi]->tot_i[pki];
+			max_i[peak_count + pki] = panel_pkdata[pi]->max_i[pki];
+			sigma[peak_count + pki] = panel_pkdata[pi]->sigma[pki];
+			snr[peak_count + pki] = panel_pkdata[pi]->snr[pki];
+		}
+
+		// As in the serial search, the peaks that do not fit in the list are
+		// still counted
+		peak_count += panel_peak_count[pi];
+	}
+
+	*num_found_peaks = peak_count;
+}
+
+
 static int peakfinder8_base(float *roffset, float *rthreshold,
-                            float *data, char *mask, float *r_map,
+                            float *data, char *mask, int *r_bin,
                             int asic_size_fs, int num_asics_fs,
                             int asic_size_ss, int num_asics_ss,
                             int max_n_peaks, int *num_found_peaks,
@@ -869,123 +1142,323 @@ static int peakfinder8_base(float *roffset, float *rthreshold,
                             float *max_i, float *sigma, float *snr,
                             int min_pix_count, int max_pix_count,
                             int local_bg_radius, float min_snr,
-                            char* outliersMask)
+                            char* outliersMask, int num_threads,
+                            struct peakfinder_intern_data *pfinter,
+                            struct peakfinder_parallel_data *pardata)
 {
 
 	int num_pix_fs, num_pix_ss, num_pix_tot;
 	int aifs, aiss;
 	int peak_count;
-	struct peakfinder_intern_data *pfinter;
 
 	num_pix_fs = asic_size_fs * num_asics_fs;
 	num_pix_ss = asic_size_ss * num_asics_ss;
 	num_pix_tot = num_pix_fs * num_pix_ss;
 
-	pfinter = allocate_peakfinder_intern_data(num_pix_tot, max_pix_count);
-	if ( pfinter == NULL ) {
-		return 1;
-	}
+	// The internal data can be reused across frames: the pixel-in-peak map and the
+	// search buffers must be cleared before each search
+	memset(pfinter->pix_in_peak_map, 0, num_pix_tot*sizeof(char));
+	clear_search_buffers(pfinter);
 
-	peak_count = 0;
+	// The panels are processed in parallel only if the buffers for the parallel
+	// search have been allocated with the context (never without OpenMP support),
+	// and by at most as many threads as the buffers allow
+	if ( pardata != NULL && num_threads > pardata->max_num_threads ) {
+		num_threads = pardata->max_num_threads;
+	}
 
-	// Loop over modules (nxn array)
-	for ( aiss=0 ; aiss<num_asics_ss ; aiss++ ) {
-		for ( aifs=0 ; aifs<num_asics_fs ; aifs++ ) {                 // ??? to change to proper panels need
-			process_panel(asic_size_fs, asic_size_ss, num_pix_fs, // change copy, mask, r_map
-  			              aiss, aifs, rthreshold, roffset,
-			              &peak_count, data, pfinter, r_map, mask,
-			              npix, com_fs, com_ss, com_index, tot_i,
-			              max_i, sigma, snr, min_pix_count,
-			              max_pix_count, local_bg_radius, min_snr,
-			              max_n_peaks);
+	if ( pardata != NULL && num_threads > 1 ) {
+
+		process_panels_in_parallel(roffset, rthreshold, data, mask, r_bin,
+		                           pardata,
+		                           asic_size_fs, num_asics_fs,
+		                           asic_size_ss, num_asics_ss,
+		                           max_n_peaks, num_found_peaks,
+		                           npix, com_fs, com_ss, com_index, tot_i,
+		                           max_i, sigma, snr, min_pix_count,
+		                           max_pix_count, local_bg_radius, min_snr,
+		                           num_threads);
+
+	} else {
+
+		peak_count = 0;
+
+		// Loop over modules (nxn array)
+		for ( aiss=0 ; aiss<num_asics_ss ; aiss++ ) {
+			for ( aifs=0 ; aifs<num_asics_fs ; aifs++ ) {                 // ??? to change to proper panels need
+				process_panel(asic_size_fs, asic_size_ss, num_pix_fs, // change copy, mask, r_map
+	  			              aiss, aifs, rthreshold, roffset,
+				              &peak_count, data, pfinter, r_bin, mask,
+				              npix, com_fs, com_ss, com_index, tot_i,
+				              max_i, sigma, snr, min_pix_count,
+				              max_pix_count, local_bg_radius, min_snr,
+				              max_n_peaks);
+			}
 		}
+		*num_found_peaks = peak_count;
 	}
-	*num_found_peaks = peak_count;
 
 	if (outliersMask != NULL) {
 		memcpy(outliersMask, pfinter->pix_in_peak_map, num_pix_tot*sizeof(char));
 	}
 
-	free_peakfinder_intern_data(pfinter);
+	return 0;
+}
+
+// Peaks found by the batched search in a stack of frames, stored one frame after the
+// other. The arrays are grown when needed, and never shrunk, so that they are only
+// reallocated when a stack has more peaks than all the previous ones
+struct peakfinder8_batch_peaks
+{
+	long capacity;
+	float *com_x;
+	float *com_y;
+	float *tot_i;
+	long *com_index;
+	float *npix;
+	float *max_i;
+	float *sigma;
+	float *snr;
+};
+
+
+static int grow_array(void **array, size_t size)
+{
+	void *grown_array;
+
+	grown_array = realloc(*array, size);
+	if ( grown_array == NULL ) {
+		return 1;
+	}
+	*array = grown_array;
 
 	return 0;
 }
 
-// Cheetah Peakfinder8
-// Count peaks by searching for connected pixels above threshold
-// Includes modifications during Cherezov December 2014 LE80
-// Anton Barty
-int peakfinder8(tPeakList *peaklist, float *data, char *mask, float *pix_r,
-                long asic_nx, long asic_ny, long nasics_x, long nasics_y,
-                float ADCthresh, float hitfinderMinSNR,
-                long hitfinderMinPixCount, long hitfinderMaxPixCount,
-                long hitfinderLocalBGRadius, char* outliersMask)
+
+static int reserve_batch_peaks(struct peakfinder8_batch_peaks *bpeaks, long num_peaks)
+{
+	long capacity;
+
+	if ( num_peaks <= bpeaks->capacity ) {
+		return 0;
+	}
+
+	capacity = 2 * bpeaks->capacity;
+	if ( capacity < num_peaks ) {
+		capacity = num_peaks;
+	}
+
+	// The arrays that have already been grown are kept if a later one cannot be:
+	// they are just larger than needed
+	if ( grow_array((void **)&bpeaks->com_x, capacity*sizeof(float))
+	  || grow_array((void **)&bpeaks->com_y, capacity*sizeof(float))
+	  || grow_array((void **)&bpeaks->tot_i, capacity*sizeof(float))
+	  || grow_array((void **)&bpeaks->com_index, capacity*sizeof(long))
+	  || grow_array((void **)&bpeaks->npix, capacity*sizeof(float))
+	  || grow_array((void **)&bpeaks->max_i, capacity*sizeof(float))
+	  || grow_array((void **)&bpeaks->sigma, capacity*sizeof(float))
+	  || grow_array((void **)&bpeaks->snr, capacity*sizeof(float)) ) {
+		return 1;
+	}
+	bpeaks->capacity = capacity;
+
+	return 0;
+}
+
+
+static void free_batch_peaks(struct peakfinder8_batch_peaks *bpeaks)
+{
+	free(bpeaks->com_x);
+	free(bpeaks->com_y);
+	free(bpeaks->tot_i);
+	free(bpeaks->com_index);
+	free(bpeaks->npix);
+	free(bpeaks->max_i);
+	free(bpeaks->sigma);
+	free(bpeaks->snr);
+}
+
+
+// Persistent peakfinder8 context
+// Stores everything that does not change from frame to frame: the mask, the radius
+// map, the radial bin of each pixel, and the buffers used by the search, which are
+// allocated only once
+struct peakfinder8_context
 {
+	long asic_nx;
+	long asic_ny;
+	long nasics_x;
+	long nasics_y;
+	long num_pix_tot;
+	long max_num_peaks;
+	long max_pix_count;
+	char *mask;
+	int *pix_rbin;
+	int has_thresholds;
 	struct radial_stats *rstats;
 	struct peakfinder_peak_data *pkdata;
-	int iterations;
+	struct peakfinder_intern_data *pfinter;
+	struct peakfinder_parallel_data *pardata;
+	struct peakfinder8_batch_peaks batch_peaks;
+};
+
+
+tPeakfinder8Context *allocatePeakfinder8Context(char *mask, float *pix_r,
+                                                long asic_nx, long asic_ny,
+                                                long nasics_x, long nasics_y,
+                                                long maxNumPeaks,
+                                                long hitfinderMaxPixCount,
+                                                int maxNumThreads)
+{
+	tPeakfinder8Context *context;
 	int num_pix_fs, num_pix_ss;
-	int num_pix_tot;
-	int max_num_peaks;
-	int num_found_peaks;
-	int ret;
-	int pki;
-	int peaks_to_add;
+	long pidx;
 
-	max_num_peaks = peaklist->nPeaks_max;
+	context = (tPeakfinder8Context *)calloc(1, sizeof(tPeakfinder8Context));
+	if ( context == NULL ) {
+		return NULL;
+	}
 
-	// Derived values
 	num_pix_fs = asic_nx * nasics_x;
 	num_pix_ss = asic_ny * nasics_y;
-	num_pix_tot = num_pix_fs * num_pix_ss;
 
-	// Compute radial statistics as 1 function (O.Y.)
-	iterations = 5;
-	rstats = compute_radial_bins(data, mask, num_pix_tot, pix_r,
-	                             iterations, hitfinderMinSNR, ADCthresh,
-	                             num_pix_fs, num_pix_ss);
+	context->asic_nx = asic_nx;
+	context->asic_ny = asic_ny;
+	context->nasics_x = nasics_x;
+	context->nasics_y = nasics_y;
+	context->num_pix_tot = num_pix_fs * num_pix_ss;
+	context->max_num_peaks = maxNumPeaks;
+	context->max_pix_count = hitfinderMaxPixCount;
+	context->mask = mask;
+	context->has_thresholds = 0;
+
+	context->pix_rbin = (int *)malloc(context->num_pix_tot*sizeof(int));
+	context->rstats = allocate_radial_stats_for_map(pix_r, num_pix_fs, num_pix_ss);
+	context->pkdata = allocate_peak_data(maxNumPeaks);
+	context->pfinter = allocate_peakfinder_intern_data(context->num_pix_tot,
+	                                                   hitfinderMaxPixCount);
+	if ( context->pix_rbin == NULL || context->rstats == NULL
+	  || context->pkdata == NULL || context->pfinter == NULL ) {
+		freePeakfinder8Context(context);
+		return NULL;
+	}
 
-	pkdata = allocate_peak_data(max_num_peaks);
-	if ( pkdata == NULL ) {
-		free_radial_stats(rstats);
-		return 1;
+#ifndef _OPENMP
+	// Without OpenMP support the panels can only be processed serially
+	maxNumThreads = 1;
+#endif
+
+	// The buffers used to process the panels in parallel are only needed when more
+	// than one thread can be used, and when there is more than one panel
+	if ( maxNumThreads > 1 && nasics_x * nasics_y > 1 ) {
+		context->pardata = allocate_peakfinder_parallel_data(context->pfinter->pix_in_peak_map,
+		                                                     nasics_x * nasics_y,
+		                                                     asic_nx * asic_ny,
+		                                                     maxNumPeaks,
+		                                                     hitfinderMaxPixCount,
+		                                                     maxNumThreads);
+		if ( context->pardata == NULL ) {
+			freePeakfinder8Context(context);
+			return NULL;
+		}
+	}
+
+	for ( pidx=0 ; pidx<context->num_pix_tot ; pidx++ ) {
+		context->pix_rbin[pidx] = (int)rint(pix_r[pidx]);
 	}
 
-	num_found_peaks = 0;
-
-	ret = peakfinder8_base(rstats->roffset,
-	                       rstats->rthreshold,
-	                       data,
-	                       mask,
-	                       pix_r,
-	                       asic_nx, nasics_x,
-	                       asic_ny, nasics_y,
-	                       max_num_peaks  ,
-	                       &num_found_peaks,
-	                       pkdata->npix,
-	                       pkdata->com_fs,
-	                       pkdata->com_ss,
-	                       pkdata->com_index,
-	                       pkdata->tot_i,
-	                       pkdata->max_i,
-	                       pkdata->sigma,
-	                       pkdata->snr,
-	                       hitfinderMinPixCount,
-	                       hitfinderMaxPixCount,
-	                       hitfinderLocalBGRadius,
-	                       hitfinderMinSNR,
-	                       outliersMask);
+	return context;
+}
 
+
+void freePeakfinder8Context(tPeakfinder8Context *context)
+{
+	if ( context->pardata != NULL ) free_peakfinder_parallel_data(context->pardata);
+	if ( context->pfinter != NULL ) free_peakfinder_intern_data(context->pfinter);
+	if ( context->pkdata != NULL ) free_peak_data(context->pkdata);
+	free_batch_peaks(&context->batch_peaks);
+	if ( context->rstats != NULL ) free_radial_stats(context->rstats);
+	free(context->pix_rbin);
+	free(context);
+}
+
+
+// Searches for peaks in a single frame using the buffers in the context. The peaks
+// are left in context->pkdata
+static int search_frame(tPeakfinder8Context *context, float *data,
+                        float ADCthresh, float hitfinderMinSNR,
+                        long hitfinderMinPixCount, long hitfinderLocalBGRadius,
+                        int warmStart, int numThreads, char *outliersMask,
+                        int *num_found_peaks)
+{
+	int iterations;
+	int warm_start;
+
+	// A warm start needs the thresholds of a previous frame. It needs fewer clipping
+	// iterations, as the thresholds are usually already close to the final ones
+	warm_start = warmStart && context->has_thresholds;
+	iterations = warm_start ? 2 : 5;
+
+	fill_radial_stats(context->rstats, data, context->mask, context->pix_rbin,
+	                  iterations, hitfinderMinSNR, ADCthresh,
+	                  context->asic_nx * context->nasics_x,
+	                  context->asic_ny * context->nasics_y, warm_start);
+	context->has_thresholds = 1;
+
+	*num_found_peaks = 0;
+
+	return peakfinder8_base(context->rstats->roffset,
+	                        context->rstats->rthreshold,
+	                        data,
+	                        context->mask,
+	                        context->pix_rbin,
+	                        context->asic_nx, context->nasics_x,
+	                        context->asic_ny, context->nasics_y,
+	                        context->max_num_peaks,
+	                        num_found_peaks,
+	                        context->pkdata->npix,
+	                        context->pkdata->com_fs,
+	                        context->pkdata->com_ss,
+	                        context->pkdata->com_index,
+	                        context->pkdata->tot_i,
+	                        context->pkdata->max_i,
+	                        context->pkdata->sigma,
+	                        context->pkdata->snr,
+	                        hitfinderMinPixCount,
+	                        context->max_pix_count,
+	                        hitfinderLocalBGRadius,
+	                        hitfinderMinSNR,
+	                        outliersMask,
+	                        numThreads,
+	                        context->pfinter,
+	                        context->pardata);
+}
+
+
+int peakfinder8_with_context(tPeakfinder8Context *context, tPeakList *peaklist,
+                             float *data, float ADCthresh, float hitfinderMinSNR,
+                             long hitfinderMinPixCount, long hitfinderLocalBGRadius,
+                             int warmStart, int numThreads, char* outliersMask)
+{
+	struct peakfinder_peak_data *pkdata;
+	int num_found_peaks;
+	int ret;
+	int pki;
+	int peaks_to_add;
+
+	ret = search_frame(context, data, ADCthresh, hitfinderMinSNR,
+	                   hitfinderMinPixCount, hitfinderLocalBGRadius, warmStart,
+	                   numThreads, outliersMask, &num_found_peaks);
 	if ( ret != 0 ) {
-		free_radial_stats(rstats);
-		free_peak_data(pkdata);
 		return 1;
 	}
 
+	pkdata = context->pkdata;
 	peaks_to_add = num_found_peaks;
 
-	if ( num_found_peaks > max_num_peaks ) {
-		peaks_to_add = max_num_peaks;
+	if ( num_found_peaks > peaklist->nPeaks_max ) {
+		peaks_to_add = peaklist->nPeaks_max;
 	}
 
 	for ( pki=0 ; pki<peaks_to_add ; pki++ ) {
@@ -1002,7 +1475,122 @@ int peakfinder8(tPeakList *peaklist, float *data, char *mask, float *pix_r,
 
 	peaklist->nPeaks = peaks_to_add;
 
-	free_radial_stats(rstats);
-	free_peak_data(pkdata);
 	return 0;
 }
+
+
+// Cheetah Peakfinder8
+// Count peaks by searching for connected pixels above threshold
+// Includes modifications during Cherezov December 2014 LE80
+// Anton Barty
+int peakfinder8(tPeakList *peaklist, float *data, char *mask, float *pix_r,
+                long asic_nx, long asic_ny, long nasics_x, long nasics_y,
+                float ADCthresh, float hitfinderMinSNR,
+                long hitfinderMinPixCount, long hitfinderMaxPixCount,
+                long hitfinderLocalBGRadius, char* outliersMask, int numThreads)
+{
+	tPeakfinder8Context *context;
+	int ret;
+
+	context = allocatePeakfinder8Context(mask, pix_r, asic_nx, asic_ny, nasics_x,
+	                                     nasics_y, peaklist->nPeaks_max,
+	                                     hitfinderMaxPixCount, numThreads);
+	if ( context == NULL ) {
+		return 1;
+	}
+
+	ret = peakfinder8_with_context(context, peaklist, data, ADCthresh,
+	                               hitfinderMinSNR, hitfinderMinPixCount,
+	                               hitfinderLocalBGRadius, 0, numThreads,
+	                               outliersMask);
+
+	freePeakfinder8Context(context);
+	return ret;
+}
+
+
+// Batched version of peakfinder8
+// Searches for peaks in a stack of frames that share the mask and radius map stored
+// in the context. The peaks found in each frame (at most the maximum number of peaks
+// of the context per frame) are stored in the context, one frame after the other,
+// and can be retrieved with getPeakfinder8BatchPeaks. The number of peaks stored for
+// each frame is written in numPeaksInFrame.
+int peakfinder8_batch(tPeakfinder8Context *context, long numFrames, float *data,
+                      float ADCthresh, float hitfinderMinSNR,
+                      long hitfinderMinPixCount, long hitfinderLocalBGRadius,
+                      int warmStart, int numThreads, long *numPeaksInFrame)
+{
+	struct peakfinder_peak_data *pkdata;
+	struct peakfinder8_batch_peaks *bpeaks;
+	long frame;
+	long num_written_peaks;
+	int num_found_peaks;
+	int ret;
+	int pki;
+	int peaks_to_add;
+
+	pkdata = context->pkdata;
+	bpeaks = &context->batch_peaks;
+	num_written_peaks = 0;
+
+	for ( frame=0 ; frame<numFrames ; frame++ ) {
+
+		ret = search_frame(context, data + frame * context->num_pix_tot, ADCthresh,
+		                   hitfinderMinSNR, hitfinderMinPixCount,
+		                   hitfinderLocalBGRadius, warmStart, numThreads, NULL,
+		                   &num_found_peaks);
+		if ( ret != 0 ) {
+			return 1;
+		}
+
+		peaks_to_add = num_found_peaks;
+
+		if ( num_found_peaks > context->max_num_peaks ) {
+			peaks_to_add = context->max_num_peaks;
+		}
+
+		if ( reserve_batch_peaks(bpeaks, num_written_peaks + peaks_to_add) != 0 ) {
+			return 1;
+		}
+
+		for ( pki=0 ; pki<peaks_to_add ; pki++ ) {
+
+			bpeaks->com_x[num_written_peaks] = pkdata->com_fs[pki];
+			bpeaks->com_y[num_written_peaks] = pkdata->com_ss[pki];
+			bpeaks->tot_i[num_written_peaks] = pkdata->tot_i[pki];
+			bpeaks->com_index[num_written_peaks] = pkdata->com_index[pki];
+			bpeaks->npix[num_written_peaks] = pkdata->npix[pki];
+			bpeaks->max_i[num_written_peaks] = pkdata->max_i[pki];
+			bpeaks->sigma[num_written_peaks] = pkdata->sigma[pki];
+			bpeaks->snr[num_written_peaks] = pkdata->snr[pki];
+			num_written_peaks++;
+		}
+
+		numPeaksInFrame[frame] = peaks_to_add;
+	}
+
+	return 0;
+}
+
+
+// Copies the first numPeaks peaks found by the last batched search into the output
+// arrays, which must have room for numPeaks entries
+void getPeakfinder8BatchPeaks(tPeakfinder8Context *context, long numPeaks,
+                              float *peakComX, float *peakComY,
+                              float *peakTotalIntensity, long *peakComIndex,
+                              float *peakNpix, float *peakMaxIntensity,
+                              float *peakSigma, float *peakSnr)
+{
+	struct peakfinder8_batch_peaks *bpeaks;
+
+	bpeaks = &context->batch_peaks;
+
+	memcpy(peakComX, bpeaks->com_x, numPeaks*sizeof(float));
+	memcpy(peakComY, bpeaks->com_y, numPeaks*sizeof(float));
+	memcpy(peakTotalIntensity, bpeaks->tot_i, numPeaks*sizeof(float));
+	memcpy(peakComIndex, bpeaks->com_index, numPeaks*sizeof(long));
+	memcpy(peakNpix, bpeaks->npix, numPeaks*sizeof(float));
+	memcpy(peakMaxIntensity, bpeaks->max_i, numPeaks*sizeof(float));
+	memcpy(peakSigma, bpeaks->sigma, numPeaks*sizeof(float));
+	memcpy(peakSnr, bpeaks->snr, numPeaks*sizeof(float));
+}
@@ -52,6 +52,31 @@ int peakfinder8(tPeakList *peaklist, float *data, char *mask, float *pix_r,
                 long asic_nx, long asic_ny, long nasics_x, long nasics_y,
                 float ADCthresh, float hitfinderMinSNR,
 				long hitfinderMinPixCount, long hitfinderMaxPixCount,
-				long hitfinderLocalBGRadius, char* outliersMask);
+				long hitfinderLocalBGRadius, char* outliersMask, int numThreads);
+
+typedef struct peakfinder8_context tPeakfinder8Context;
+
+tPeakfinder8Context *allocatePeakfinder8Context(char *mask, float *pix_r,
+                                                long asic_nx, long asic_ny,
+                                                long nasics_x, long nasics_y,
+                                                long maxNumPeaks,
+                                                long hitfinderMaxPixCount,
+                                                int maxNumThreads);
+void freePeakfinder8Context(tPeakfinder8Context *context);
+
+int peakfinder8_with_context(tPeakfinder8Context *context, tPeakList *peaklist,
+                             float *data, float ADCthresh, float hitfinderMinSNR,
+                             long hitfinderMinPixCount, long hitfinderLocalBGRadius,
+                             int warmStart, int numThreads, char* outliersMask);
+
+int peakfinder8_batch(tPeakfinder8Context *context, long numFrames, float *data,
+                      float ADCthresh, float hitfinderMinSNR,
+                      long hitfinderMinPixCount, long hitfinderLocalBGRadius,
+                      int warmStart, int numThreads, long *numPeaksInFrame);
+void getPeakfinder8BatchPeaks(tPeakfinder8Context *context, long numPeaks,
+                              float *peakComX, float *peakComY,
+                              float *peakTotalIntensity, long *peakComIndex,
+                              float *peakNpix, float *peakMaxIntensity,
+                              float *peakSigma, float *peakSnr);
 
 #endif // PEAKFINDER8_H
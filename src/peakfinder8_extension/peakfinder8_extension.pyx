@@ -13,7 +13,6 @@
 #
 # Copyright 2014-2019 Deutsches Elektronen-Synchrotron DESY,
 # a research centre of the Helmholtz Association.
-from libcpp.vector cimport vector
 from libc.stdlib cimport malloc, free
 from libc.stdint cimport int8_t
 
@@ -55,63 +54,103 @@ cdef extern from "peakfinder8.hh":
                     long asic_nx, long asic_ny, long nasics_x, long nasics_y,
                     float ADCthresh, float hitfinderMinSNR,
                     long hitfinderMinPixCount, long hitfinderMaxPixCount,
-                    long hitfinderLocalBGRadius, char *outliersMask)
+                    long hitfinderLocalBGRadius, char *outliersMask,
+                    int numThreads) nogil
+
+    ctypedef struct tPeakfinder8Context:
+        pass
+
+    tPeakfinder8Context *allocatePeakfinder8Context(char *mask, float *pix_r,
+                                                    long asic_nx, long asic_ny,
+                                                    long nasics_x, long nasics_y,
+                                                    long maxNumPeaks,
+                                                    long hitfinderMaxPixCount,
+                                                    int maxNumThreads)
+    void freePeakfinder8Context(tPeakfinder8Context *context)
+
+    int peakfinder8_with_context(tPeakfinder8Context *context,
+                                 tPeakList *peaklist, float *data, float ADCthresh,
+                                 float hitfinderMinSNR, long hitfinderMinPixCount,
+                                 long hitfinderLocalBGRadius, int warmStart,
+                                 int numThreads, char* outliersMask) nogil
+
+    int peakfinder8_batch(tPeakfinder8Context *context, long numFrames, float *data,
+                          float ADCthresh, float hitfinderMinSNR,
+                          long hitfinderMinPixCount, long hitfinderLocalBGRadius,
+                          int warmStart, int numThreads,
+                          long *numPeaksInFrame) nogil
+
+    void getPeakfinder8BatchPeaks(tPeakfinder8Context *context, long numPeaks,
+                                  float *peakComX, float *peakComY,
+                                  float *peakTotalIntensity, long *peakComIndex,
+                                  float *peakNpix, float *peakMaxIntensity,
+                                  float *peakSigma, float *peakSnr)
+
+
+cdef tuple _peak_list_to_arrays(tPeakList *peak_list, long num_peaks):
+    # Copies the first num_peaks entries of the peak list into numpy arrays. The data
+    # is written directly into the arrays, without creating a Python object for each
+    # peak.
+    peak_list_x = numpy.empty(num_peaks, dtype=numpy.float32)
+    peak_list_y = numpy.empty(num_peaks, dtype=numpy.float32)
+    peak_list_value = numpy.empty(num_peaks, dtype=numpy.float32)
+    peak_list_index = numpy.empty(num_peaks, dtype="l")
+    peak_list_npix = numpy.empty(num_peaks, dtype=numpy.float32)
+    peak_list_maxi = numpy.empty(num_peaks, dtype=numpy.float32)
+    peak_list_sigma = numpy.empty(num_peaks, dtype=numpy.float32)
+    peak_list_snr = numpy.empty(num_peaks, dtype=numpy.float32)
+
+    cdef float[::1] x_view = peak_list_x
+    cdef float[::1] y_view = peak_list_y
+    cdef float[::1] value_view = peak_list_value
+    cdef long[::1] index_view = peak_list_index
+    cdef float[::1] npix_view = peak_list_npix
+    cdef float[::1] maxi_view = peak_list_maxi
+    cdef float[::1] sigma_view = peak_list_sigma
+    cdef float[::1] snr_view = peak_list_snr
+    cdef long i
+
+    for i in range(num_peaks):
+        x_view[i] = peak_list.peak_com_x[i]
+        y_view[i] = peak_list.peak_com_y[i]
+        value_view[i] = peak_list.peak_totalintensity[i]
+        index_view[i] = peak_list.peak_com_index[i]
+        npix_view[i] = peak_list.peak_npix[i]
+        maxi_view[i] = peak_list.peak_maxintensity[i]
+        sigma_view[i] = peak_list.peak_sigma[i]
+        snr_view[i] = peak_list.peak_snr[i]
+
+    return (peak_list_x, peak_list_y, peak_list_value, peak_list_index,
+            peak_list_npix, peak_list_maxi, peak_list_sigma, peak_list_snr)
 
 
 def peakfinder_8(int max_num_peaks, float[:,::1] data, char[:,::1] mask,
                  float[:,::1] pix_r, long asic_nx, long asic_ny, long nasics_x,
                  long nasics_y, float adc_thresh, float hitfinder_min_snr,
                  long hitfinder_min_pix_count, long hitfinder_max_pix_count,
-                 long hitfinder_local_bg_radius):
+                 long hitfinder_local_bg_radius, int num_threads=1):
 
     cdef tPeakList peak_list
     allocatePeakList(&peak_list, max_num_peaks)
 
-    peakfinder8(&peak_list, &data[0, 0], &mask[0,0], &pix_r[0, 0], asic_nx, asic_ny,
-                nasics_x, nasics_y, adc_thresh, hitfinder_min_snr,
-                hitfinder_min_pix_count, hitfinder_max_pix_count,
-                hitfinder_local_bg_radius, NULL)
-
-    cdef int i
-    cdef float peak_x, peak_y, peak_value
-    cdef vector[double] peak_list_x
-    cdef vector[double] peak_list_y
-    cdef vector[long] peak_list_index
-    cdef vector[double] peak_list_value
-    cdef vector[double] peak_list_npix
-    cdef vector[double] peak_list_maxi
-    cdef vector[double] peak_list_sigma
-    cdef vector[double] peak_list_snr
+    # The GIL is released during the peak search. If the extension has been compiled
+    # with OpenMP support, the ASIC panels are processed using num_threads threads.
+    with nogil:
+        peakfinder8(&peak_list, &data[0, 0], &mask[0,0], &pix_r[0, 0], asic_nx,
+                    asic_ny, nasics_x, nasics_y, adc_thresh, hitfinder_min_snr,
+                    hitfinder_min_pix_count, hitfinder_max_pix_count,
+                    hitfinder_local_bg_radius, NULL, num_threads)
 
     num_peaks = peak_list.nPeaks
 
     if num_peaks > max_num_peaks:
         num_peaks = max_num_peaks
 
-    for i in range(0, num_peaks):
-
-        peak_x = peak_list.peak_com_x[i]
-        peak_y = peak_list.peak_com_y[i]
-        peak_index = peak_list.peak_com_index[i]
-        peak_value = peak_list.peak_totalintensity[i]
-        peak_npix = peak_list.peak_npix[i]
-        peak_maxi = peak_list.peak_maxintensity[i]
-        peak_sigma = peak_list.peak_sigma[i]
-        peak_snr = peak_list.peak_snr[i]
-
-        peak_list_x.push_back(peak_x)
-        peak_list_y.push_back(peak_y)
-        peak_list_index.push_back(peak_index)
-        peak_list_value.push_back(peak_value)
-        peak_list_npix.push_back(peak_npix)
-        peak_list_maxi.push_back(peak_maxi)
-        peak_list_sigma.push_back(peak_sigma)
-        peak_list_snr.push_back(peak_snr)
+    peaks = _peak_list_to_arrays(&peak_list, num_peaks)
 
     freePeakList(peak_list)
 
-    return (peak_list_x, peak_list_y, peak_list_value, peak_list_index,
-            peak_list_npix, peak_list_maxi, peak_list_sigma, peak_list_snr)
+    return peaks
 
 
 def peakfinder_8_with_pixel_information(int max_num_peaks, float[:,::1] data,
@@ -122,55 +161,194 @@ def peakfinder_8_with_pixel_information(int max_num_peaks, float[:,::1] data,
                                         long hitfinder_min_pix_count,
                                         long hitfinder_max_pix_count,
                                         long hitfinder_local_bg_radius,
-                                        char[:,::1] outlier_mask):
+                                        char[:,::1] outlier_mask,
+                                        int num_threads=1):
 
     cdef tPeakList peak_list
     allocatePeakList(&peak_list, max_num_peaks)
 
-    peakfinder8(&peak_list, &data[0, 0], &mask[0, 0], &pix_r[0, 0], asic_nx, asic_ny,
-                nasics_x, nasics_y, adc_thresh, hitfinder_min_snr,
-                hitfinder_min_pix_count, hitfinder_max_pix_count,
-                hitfinder_local_bg_radius, &outlier_mask[0, 0])
-
-    cdef int i
-    cdef float peak_x, peak_y, peak_value
-    cdef vector[double] peak_list_x
-    cdef vector[double] peak_list_y
-    cdef vector[long] peak_list_index
-    cdef vector[double] peak_list_value
-    cdef vector[double] peak_list_npix
-    cdef vector[double] peak_list_maxi
-    cdef vector[double] peak_list_sigma
-    cdef vector[double] peak_list_snr
+    with nogil:
+        peakfinder8(&peak_list, &data[0, 0], &mask[0, 0], &pix_r[0, 0], asic_nx,
+                    asic_ny, nasics_x, nasics_y, adc_thresh, hitfinder_min_snr,
+                    hitfinder_min_pix_count, hitfinder_max_pix_count,
+                    hitfinder_local_bg_radius, &outlier_mask[0, 0], num_threads)
 
     num_peaks = peak_list.nPeaks
 
     if num_peaks > max_num_peaks:
         num_peaks = max_num_peaks
 
-    for i in range(0, num_peaks):
-
-        peak_x = peak_list.peak_com_x[i]
-        peak_y = peak_list.peak_com_y[i]
-        peak_index = peak_list.peak_com_index[i]
-        peak_value = peak_list.peak_totalintensity[i]
-        peak_npix = peak_list.peak_npix[i]
-        peak_maxi = peak_list.peak_maxintensity[i]
-        peak_sigma = peak_list.peak_sigma[i]
-        peak_snr = peak_list.peak_snr[i]
-
-        peak_list_x.push_back(peak_x)
-        peak_list_y.push_back(peak_y)
-        peak_list_index.push_back(peak_index)
-        peak_list_value.push_back(peak_value)
-        peak_list_npix.push_back(peak_npix)
-        peak_list_maxi.push_back(peak_maxi)
-        peak_list_sigma.push_back(peak_sigma)
-        peak_list_snr.push_back(peak_snr)
+    peaks = _peak_list_to_arrays(&peak_list, num_peaks)
 
     freePeakList(peak_list)
 
-    return (peak_list_x, peak_list_y, peak_list_value, peak_list_index,
-            peak_list_npix, peak_list_maxi, peak_list_sigma, peak_list_snr)
+    return peaks
+
+
+cdef class Peakfinder8Context:
+    """
+    Persistent peakfinder8 search context.
+
+    The context stores the mask, the radius map and the search parameters, and
+    allocates all the buffers needed by the algorithm only once, when it is created.
+    The radial bin of each pixel is also computed only once. The same context can then
+    be used to search for peaks in any number of frames with the same shape as the
+    mask. If warm_start is True, the iterative estimation of the radial background
+    in each frame starts from the thresholds computed for the previous frame, and
+    needs fewer iterations. The context must not be used from more than one thread
+    at the same time.
+    """
+
+    cdef tPeakfinder8Context *_context
+    cdef char[:,::1] _mask
+    cdef float[:,::1] _pix_r
+    cdef int _max_num_peaks
+    cdef float _adc_thresh
+    cdef float _hitfinder_min_snr
+    cdef long _hitfinder_min_pix_count
+    cdef long _hitfinder_local_bg_radius
+    cdef int _num_threads
+    cdef int _warm_start
+    cdef tPeakList _peak_list
+    cdef int _peak_list_allocated
+
+    def __cinit__(self, int max_num_peaks, char[:,::1] mask, float[:,::1] pix_r,
+                  long asic_nx, long asic_ny, long nasics_x, long nasics_y,
+                  float adc_thresh, float hitfinder_min_snr,
+                  long hitfinder_min_pix_count, long hitfinder_max_pix_count,
+                  long hitfinder_local_bg_radius, int num_threads=1,
+                  bint warm_start=False):
+
+        self._context = NULL
+        self._peak_list_allocated = 0
+
+        if (mask.shape[0] != asic_ny * nasics_y or mask.shape[1] != asic_nx * nasics_x
+                or pix_r.shape[0] != mask.shape[0] or pix_r.shape[1] != mask.shape[1]):
+            raise ValueError(
+                "The shape of the mask and of the radius map does not match the "
+                "detector layout."
+            )
+
+        # The context keeps references to the mask and to the radius map, whose
+        # memory is used directly by the C++ code.
+        self._mask = mask
+        self._pix_r = pix_r
+        self._max_num_peaks = max_num_peaks
+        self._adc_thresh = adc_thresh
+        self._hitfinder_min_snr = hitfinder_min_snr
+        self._hitfinder_min_pix_count = hitfinder_min_pix_count
+        self._hitfinder_local_bg_radius = hitfinder_local_bg_radius
+        self._num_threads = num_threads
+        self._warm_start = warm_start
+
+        self._context = allocatePeakfinder8Context(
+            &self._mask[0, 0], &self._pix_r[0, 0], asic_nx, asic_ny, nasics_x,
+            nasics_y, max_num_peaks, hitfinder_max_pix_count, num_threads
+        )
+        if self._context == NULL:
+            raise MemoryError("Cannot allocate memory for the peakfinder8 context.")
+
+        allocatePeakList(&self._peak_list, max_num_peaks)
+        self._peak_list_allocated = 1
+
+    def __dealloc__(self):
+        if self._context != NULL:
+            freePeakfinder8Context(self._context)
+        if self._peak_list_allocated:
+            freePeakList(self._peak_list)
+
+    def find_peaks(self, float[:,::1] data):
+
+        cdef int ret
+
+        if data.shape[0] != self._mask.shape[0] or data.shape[1] != self._mask.shape[1]:
+            raise ValueError("The shape of the data does not match the mask.")
+
+        with nogil:
+            ret = peakfinder8_with_context(self._context, &self._peak_list,
+                                           &data[0, 0], self._adc_thresh,
+                                           self._hitfinder_min_snr,
+                                           self._hitfinder_min_pix_count,
+                                           self._hitfinder_local_bg_radius,
+                                           self._warm_start, self._num_threads, NULL)
+
+        if ret != 0:
+            raise MemoryError("Cannot allocate memory for the peakfinder8 search.")
+
+        return _peak_list_to_arrays(&self._peak_list, self._peak_list.nPeaks)
+
+    def find_peaks_in_batch(self, float[:,:,::1] data):
+
+        cdef long num_frames = data.shape[0]
+        cdef long num_peaks
+        cdef int ret
+
+        if data.shape[1] != self._mask.shape[0] or data.shape[2] != self._mask.shape[1]:
+            raise ValueError("The shape of the data does not match the mask.")
+
+        # The peaks of all the frames are stored one frame after the other, and the
+        # frame_index array records the index of the frame in which each peak was
+        # found. The context collects the peaks during the search: the output arrays
+        # are then allocated with the size given by the number of peaks found in each
+        # frame.
+        num_peaks_in_frame = numpy.zeros(num_frames, dtype="l")
+
+        if num_frames > 0 and self._max_num_peaks > 0:
+            ret = self._search_batch(data, num_peaks_in_frame)
+            if ret != 0:
+                raise MemoryError("Cannot allocate memory for the peakfinder8 search.")
+
+        num_peaks = num_peaks_in_frame.sum()
+        frame_index = numpy.repeat(numpy.arange(num_frames), num_peaks_in_frame)
+        peak_list_x = numpy.empty(num_peaks, dtype=numpy.float32)
+        peak_list_y = numpy.empty(num_peaks, dtype=numpy.float32)
+        peak_list_value = numpy.empty(num_peaks, dtype=numpy.float32)
+        peak_list_index = numpy.empty(num_peaks, dtype="l")
+        peak_list_npix = numpy.empty(num_peaks, dtype=numpy.float32)
+        peak_list_maxi = numpy.empty(num_peaks, dtype=numpy.float32)
+        peak_list_sigma = numpy.empty(num_peaks, dtype=numpy.float32)
+        peak_list_snr = numpy.empty(num_peaks, dtype=numpy.float32)
+
+        if num_peaks > 0:
+            self._get_batch_peaks(num_peaks, peak_list_x, peak_list_y, peak_list_value,
+                                  peak_list_index, peak_list_npix, peak_list_maxi,
+                                  peak_list_sigma, peak_list_snr)
+
+        return (frame_index, peak_list_x, peak_list_y, peak_list_value,
+                peak_list_index, peak_list_npix, peak_list_maxi, peak_list_sigma,
+                peak_list_snr)
+
+    cdef int _search_batch(self, float[:,:,::1] data, long[::1] num_peaks_in_frame):
+
+        cdef int ret
+
+        with nogil:
+            ret = peakfinder8_batch(self._context, data.shape[0], &data[0, 0, 0],
+                                    self._adc_thresh, self._hitfinder_min_snr,
+                                    self._hitfinder_min_pix_count,
+                                    self._hitfinder_local_bg_radius,
+                                    self._warm_start, self._num_threads,
+                                    &num_peaks_in_frame[0])
+
+        return ret
+
+    cdef void _get_batch_peaks(self, long num_peaks, float[::1] x, float[::1] y,
+                               float[::1] value, long[::1] index, float[::1] npix,
+                               float[::1] maxi, float[::1] sigma, float[::1] snr):
+
+        getPeakfinder8BatchPeaks(self._context, num_peaks, &x[0], &y[0], &value[0],
+                                 &index[0], &npix[0], &maxi[0], &sigma[0], &snr[0])
+
+
+def peakfinder_8_batch(int max_num_peaks, float[:,:,::1] data, char[:,::1] mask,
+                       float[:,::1] pix_r, long asic_nx, long asic_ny, long nasics_x,
+                       long nasics_y, float adc_thresh, float hitfinder_min_snr,
+                       long hitfinder_min_pix_count, long hitfinder_max_pix_count,
+                       long hitfinder_local_bg_radius, int num_threads=1):
 
+    context = Peakfinder8Context(max_num_peaks, mask, pix_r, asic_nx, asic_ny,
+                                 nasics_x, nasics_y, adc_thresh, hitfinder_min_snr,
+                                 hitfinder_min_pix_count, hitfinder_max_pix_count,
+                                 hitfinder_local_bg_radius, num_threads)
 
+    return context.find_peaks_in_batch(data)